@@ -1,6 +1,7 @@
 # The MIT License (MIT).
 # Copyright (c) 2015, Nicolas Sebrecht & contributors.
 
+from imapfw import runtime
 from imapfw.interface import implements, checkInterfaces
 from imapfw.conf import Parser
 
@@ -31,32 +32,56 @@ class UnitTests(object):
     def init(self, parser: Parser) -> None:
         import unittest
 
+        # Catch data that could not be passed to other workers.
+        runtime.concurrency.setQueueValidation(True)
+
         self._suite = unittest.TestSuite()
 
         # Load all available unit tests.
         from imapfw.testing.concurrency import TestConcurrency
         from imapfw.testing.rascal import TestRascal
         from imapfw.testing.folder import TestFolder
+        from imapfw.testing.imap import TestImap, TestImapDriver
+        from imapfw.testing.imap import TestFetchParser
         from imapfw.testing.message import TestMessage, TestMessages
         from imapfw.testing.maildir import TestMaildirDriver
         from imapfw.testing.edmp import TestEDMP
+        from imapfw.testing.engine import TestSyncAccounts, TestSyncFolders
+        from imapfw.testing.state import TestFolderHistory, TestFolderState
+        from imapfw.testing.state import TestMaildirIndex
         from imapfw.testing.types import TestTypeAccount, TestTypeRepository
         from imapfw.testing.architect import TestArchitect, TestDriverArchitect
         from imapfw.testing.architect import TestDriversArchitect
+        from imapfw.testing.architect import TestDriverPool
+        from imapfw.testing.architect import TestFolderScheduler
+        from imapfw.testing.architect import TestSyncArchitect
+        from imapfw.testing.architect import TestSyncAccountsArchitect
         from imapfw.testing.architect import TestEngineArchitect
 
         self._suite.addTest(unittest.makeSuite(TestConcurrency))
         self._suite.addTest(unittest.makeSuite(TestRascal))
         self._suite.addTest(unittest.makeSuite(TestFolder))
+        self._suite.addTest(unittest.makeSuite(TestImap))
+        self._suite.addTest(unittest.makeSuite(TestImapDriver))
+        self._suite.addTest(unittest.makeSuite(TestFetchParser))
         self._suite.addTest(unittest.makeSuite(TestMessage))
         self._suite.addTest(unittest.makeSuite(TestMessages))
         self._suite.addTest(unittest.makeSuite(TestMaildirDriver))
         self._suite.addTest(unittest.makeSuite(TestEDMP))
+        self._suite.addTest(unittest.makeSuite(TestSyncAccounts))
+        self._suite.addTest(unittest.makeSuite(TestSyncFolders))
+        self._suite.addTest(unittest.makeSuite(TestFolderHistory))
+        self._suite.addTest(unittest.makeSuite(TestFolderState))
+        self._suite.addTest(unittest.makeSuite(TestMaildirIndex))
         self._suite.addTest(unittest.makeSuite(TestTypeAccount))
         self._suite.addTest(unittest.makeSuite(TestTypeRepository))
         self._suite.addTest(unittest.makeSuite(TestArchitect))
         self._suite.addTest(unittest.makeSuite(TestDriverArchitect))
         self._suite.addTest(unittest.makeSuite(TestDriversArchitect))
+        self._suite.addTest(unittest.makeSuite(TestDriverPool))
+        self._suite.addTest(unittest.makeSuite(TestFolderScheduler))
+        self._suite.addTest(unittest.makeSuite(TestSyncArchitect))
+        self._suite.addTest(unittest.makeSuite(TestSyncAccountsArchitect))
         self._suite.addTest(unittest.makeSuite(TestEngineArchitect))
 
     def run(self) -> None:
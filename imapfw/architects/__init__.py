@@ -2,5 +2,5 @@
 from .architect import Architect
 from .engine import EngineArchitect
 from .account import SyncArchitect, SyncAccountsArchitect
-from .folder import SyncFolderArchitect, SyncFoldersArchitect
-from .driver import DriverArchitect, DriversArchitect
+from .folder import SyncFolderArchitect, FolderScheduler
+from .driver import DriverArchitect, DriversArchitect, DriverPool
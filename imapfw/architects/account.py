@@ -25,90 +25,80 @@ from imapfw import runtime
 from imapfw.engines import SyncAccounts
 from imapfw.runners import topRunner
 from imapfw.edmp import newEmitterReceiver
+from imapfw.state import FolderHistory
 
-from .engine import EngineArchitect
-from .folder import SyncFoldersArchitect
+from .architect import Architect
+from .folder import FolderScheduler
+from .driver import DriverPool
 from .debug import debugArchitect
 
 # Annotations.
-from imapfw.annotation import Iterable
-from imapfw.edmp import Queue
+from imapfw.annotation import Dict, Function, Iterable, List
+from imapfw.edmp import Emitter, Queue
 from imapfw.types.folder import Folders
 
 
 @debugArchitect
 class SyncArchitect(object):
-    """Architect designed to sync one account."""
+    """Architect designed to sync accounts, one after the other.
+
+    The events of the engines are sent to the monitor of the caller which
+    forwards them to the methods of this architect. The account engine doesn't
+    wait for the folders of an account: the architect is done once the engine
+    is done and all the scheduled folders are synced."""
 
     def __init__(self, workerName: str, accountTasks: Queue,
-            accountEngineName: str, folderEngineName: str):
+            accountEngineName: str, folderEngineName: str,
+            folderScheduler: FolderScheduler, driverPool: DriverPool,
+            monitor: Emitter):
         self.workerName = workerName
         self.accountTasks = accountTasks
         self.accountEngineName = accountEngineName
         self.folderEngineName = folderEngineName
+        self.folderScheduler = folderScheduler
+        self.driverPool = driverPool
+        self.monitor = monitor
 
-        self.engineArch = None
-        self.foldersArch = None
-        self.receiver = None
+        self.architect = None
+        self.leftArch = None
+        self.rightArch = None
         self.engine = None
+        self.engineExitCode = None # Set once the engine is done.
         self.exitCode = -1 # Let caller know we are busy.
         self.foldersExitCode = -1 # Max from all folders architects.
-        self.syncFoldersDone = False
-
-    def _on_accountEngineDone(self, exitCode: int) -> None:
-        """React to `done` event for the account engine.
-
-        This event is triggered when the sync engine has no more task to
-        process. Stop worker and set exit code."""
-
-        # Set exit code.
-        self._setExitCode(exitCode)
-        self._setExitCode(self.foldersExitCode)
-        # Stop both drivers.
-        self.engineArch.getLeftEmitter().stop()
-        self.engineArch.getRightEmitter().stop()
-        # Stop current engine.
-        self.engineArch.stop()
+        self.keys = set() # Scheduler keys of the folders not synced yet.
+        self.scheduled = 0 # Number of scheduled accounts, to name the keys.
 
-    def _on_areSyncFoldersDone(self) -> bool:
-        return self.syncFoldersDone
+    def _checkDone(self) -> None:
+        if self.engineExitCode is not None and len(self.keys) < 1:
+            self._setExitCode(self.engineExitCode)
+            self._setExitCode(self.foldersExitCode)
 
-    def _on_syncFolders(self, accountName: str, maxFolderWorkers: int,
-            folders: Folders) -> None:
-        """Start syncing of folders in async mode."""
-
-        self.syncFoldersDone = False
-        self.foldersArch = SyncFoldersArchitect(self.workerName, accountName)
-        # Let the foldersArchitect re-use our drivers.
-        self.foldersArch.start(
-            maxFolderWorkers,
-            folders,
-            self.engineArch.getLeftEmitter(),
-            self.engineArch.getRightEmitter(),
-            )
+    def _on_foldersDone(self, key: str, exitCode: int) -> None:
+        self.keys.discard(key)
+        self.foldersExitCode = max(exitCode, self.foldersExitCode)
+        self._checkDone()
 
     def _setExitCode(self, exitCode: int) -> None:
         self.exitCode = max(exitCode, self.exitCode)
 
-    def init(self) -> None:
-        """Initialize the architect. Helps to compose components easily."""
-
-        self.engineArch = EngineArchitect(self.workerName)
-        self.engineArch.init()
-
-        self.receiver, emitter = newEmitterReceiver(self.workerName)
+    def accountEngineDone(self, exitCode: int, repositoryNames: tuple) -> None:
+        """React to `done` event for the account engine.
 
-        # Setup events handling.
-        self.receiver.accept('areSyncFoldersDone', self._on_areSyncFoldersDone)
-        self.receiver.accept('accountEngineDone', self._on_accountEngineDone)
-        self.receiver.accept('syncFolders', self._on_syncFolders)
+        This event is triggered when the sync engine has no more task to
+        process. Stop worker and set exit code. The drivers are given back to
+        the pool, still connected to the repositories of the last account."""
 
-        self.engine = SyncAccounts(
-            self.workerName,
-            emitter,
-            self.engineArch.getLeftEmitter(),
-            self.engineArch.getRightEmitter(),
-            )
+        # Stop current engine.
+        self.architect.stop()
+        if repositoryNames is not None:
+            leftName, rightName = repositoryNames
+            self.driverPool.giveBack(leftName, self.leftArch)
+            self.driverPool.giveBack(rightName, self.rightArch)
+        self.leftArch = self.rightArch = None
+        # Set exit code once the folders are done.
+        self.engineExitCode = exitCode
+        self._checkDone()
 
     def getExitCode(self) -> int:
         """Caller must monitor the exit code to know when we are done.
@@ -117,89 +107,172 @@ class SyncArchitect(object):
         - zero: finished without error.
         - positive: got error(s)."""
 
-        try:
-            self.receiver.react()
-            if self.foldersArch is not None:
-                exitCode = self.foldersArch.getExitCode()
-                if exitCode >= 0:
-                    # Folders are all done.
-                    self.foldersArch = None
-                    self.syncFoldersDone = True
-                    self.foldersExitCode = max(exitCode, self.foldersExitCode)
+        return self.exitCode
 
-        except Exception as e:
-            #TODO: honor rascal.
-            runtime.ui.critical("%s got unexpected error '%s'"%
-                (self.workerName, e))
-            runtime.ui.exception(e)
-            # Stop here.
-            self.engineArch.kill()
-            if self.foldersArch is not None:
-                self.foldersArch.kill()
-            self._setExitCode(10) # See manual.
+    def init(self) -> None:
+        """Initialize the architect. Helps to compose components easily."""
 
-        return self.exitCode
+        # The accounts are not known yet: the drivers are built by the engine
+        # for each account.
+        self.leftArch = self.driverPool.lease(None)
+        self.rightArch = self.driverPool.lease(None)
+
+        self.engine = SyncAccounts(
+            self.workerName,
+            self.monitor,
+            self.leftArch.getEmitter(),
+            self.rightArch.getEmitter(),
+            )
+
+    def kill(self) -> None:
+        """Stop here on unexpected error."""
+
+        #TODO: honor rascal.
+        if self.architect is not None and self.engineExitCode is None:
+            self.architect.kill()
+        for driverArch in [self.leftArch, self.rightArch]:
+            if driverArch is not None: # Not given back.
+                self.driverPool.drop(driverArch)
+        self.leftArch = self.rightArch = None
+        # Stop the folder workers syncing our folders.
+        for key in self.keys:
+            self.folderScheduler.cancel(key)
+        self.keys = set()
+        self._setExitCode(10) # See manual.
 
     def start(self) -> None:
-        assert self.engineArch is not None
+        assert self.engine is not None
 
-        self.engineArch.start(
+        self.architect = Architect(self.workerName)
+        self.architect.start(
             topRunner,
             (self.workerName, self.engine.run, self.accountTasks),
             )
 
+    def syncFolders(self, accountName: str, folders: Folders,
+            fingerprints: Dict[str, List]) -> None:
+        """Start syncing of folders in async mode."""
+
+        key = "%s.%i"% (self.workerName, self.scheduled)
+        self.scheduled += 1
+        self.keys.add(key)
+        self.folderScheduler.schedule(key, accountName, folders,
+            lambda exitCode: self._on_foldersDone(key, exitCode),
+            fingerprints)
+
 
 class SyncAccountsArchitect(object):
     """Architect to sync multiple accounts.
 
-    Handles a collection of SyncArchitect."""
+    Handles a collection of SyncArchitect.
+
+    The engines of all the workers send their events to one monitor. The main
+    worker sleeps until an event is received."""
 
     def __init__(self, accountList: Iterable[str]):
         self.accountList = accountList
 
-        self.syncArchs = [] # List of SyncArchitect.
+        self.syncArchs = {} # SyncArchitect by worker name.
         self.exitCode = -1
         self.accountTasks = None
+        # The engines of all the accounts lease their drivers from here.
+        self.driverPool = DriverPool('Pool')
+        self.receiver, self.monitor = newEmitterReceiver('Monitor')
+        self.history = FolderHistory(runtime.rascal.getStatePath())
+        self.history.load()
+        self.folderScheduler = FolderScheduler(self.driverPool, self.monitor,
+            self.history)
+
+        self.receiver.accept('accountEngineDone', self._on_accountEngineDone)
+        self.receiver.accept('folderDone', self._on_folderDone)
+        self.receiver.accept('syncFolders', self._on_syncFolders)
+
+    def _on_accountEngineDone(self, workerName: str, exitCode: int,
+            repositoryNames: tuple) -> None:
+        syncArch = self.syncArchs[workerName]
+        self._supervise(syncArch, syncArch.accountEngineDone, exitCode,
+            repositoryNames)
+
+    def _on_folderDone(self, workerName: str, exitCode: int) -> None:
+        self.folderScheduler.folderDone(workerName, exitCode)
+        # The last folder of an account might complete its architect.
+        for syncArch in list(self.syncArchs.values()):
+            self._checkExitCode(syncArch)
+
+    def _on_syncFolders(self, workerName: str, accountName: str,
+            folders: Folders, fingerprints: Dict[str, List]) -> None:
+        syncArch = self.syncArchs[workerName]
+        self._supervise(syncArch, syncArch.syncFolders, accountName, folders,
+            fingerprints)
+
+    def _supervise(self, syncArch: SyncArchitect, method: Function, *args):
+        """Call the method of the architect and update the exit code."""
+
+        result = None
+        try:
+            result = method(*args)
+        except Exception as e:
+            runtime.ui.critical("%s got unexpected error '%s'"%
+                (syncArch.workerName, e))
+            runtime.ui.exception(e)
+            syncArch.kill()
+
+        self._checkExitCode(syncArch)
+        return result
+
+    def _checkExitCode(self, syncArch: SyncArchitect) -> None:
+        exitCode = syncArch.getExitCode()
+        if exitCode >= 0:
+            self.exitCode = max(exitCode, self.exitCode)
+            self.syncArchs.pop(syncArch.workerName)
+
+    def kill(self) -> None:
+        """Kill all the workers and the drivers."""
+
+        for syncArch in list(self.syncArchs.values()):
+            syncArch.kill()
+            self._checkExitCode(syncArch)
+        self.folderScheduler.kill()
+        self.driverPool.kill()
 
     def start(self, maxConcurrentAccounts: int) -> None:
         """Starts the concurrents architects (workers).
 
         They are all created now."""
 
-        # The account names are the tasks for the account workers.
+        # The account names are the tasks for the account workers. Each worker
+        # stops on its own None.
         accountTasks = runtime.concurrency.createQueue()
         for name in self.accountList:
             accountTasks.put(name)
-
-        # Avoid race condition: an empty queue would let account workers to quit
-        # without processing the content. We have to make sure the queue is not
-        # empty before using them. accountList can't be empty as defined by the
-        # argument parser.
-        while accountTasks.empty():
-            pass
-        # Oops! This is still racy! This assumes that the NEXT task is available
-        # once the previous run is done. This should be reasonable assumption,
-        # though...
+        for i in range(maxConcurrentAccounts):
+            accountTasks.put(None)
 
         # Setup the architecture.
         for i in range(maxConcurrentAccounts):
             workerName = "Account.%i"% i
 
+            # The engine waits for replies of the monitor: its own emitter.
             syncArch = SyncArchitect(workerName, accountTasks,
-                'SyncAccountEngine', 'SyncFolderEngine')
+                'SyncAccountEngine', 'SyncFolderEngine', self.folderScheduler,
+                self.driverPool, self.receiver.newEmitter())
             syncArch.init()
             syncArch.start() # Async.
-            self.syncArchs.append(syncArch)
+            self.syncArchs[workerName] = syncArch
 
     def run(self) -> int:
-        # Monitor the architects.
-        while len(self.syncArchs) > 0:
-            for architect in self.syncArchs:
-                exitCode = architect.getExitCode()
-                if exitCode >= 0:
-                    if exitCode > self.exitCode:
-                        self.exitCode = exitCode
-                    self.syncArchs.remove(architect)
+        # Sleep until the architects are done.
+        try:
+            while len(self.syncArchs) > 0:
+                self.receiver.react(timeout=None)
+        except BaseException:
+            # Don't leave workers behind (KeyboardInterrupt, bugs, ...).
+            self.kill()
+            raise
+
+        self.folderScheduler.stop()
+        self.driverPool.stop()
+        self.history.save()
 
         if self.exitCode < 0:
             return 99 # See manual.
@@ -11,8 +11,10 @@ def debugArchitect(cls):
     def debugWrapper(func):
         @functools.wraps(func)
         def debugMethod(*args, **kwargs):
-            runtime.ui.debugC(ARC, "D: %s.%s: %s %s"%
-                    (cls.__name__, func.__name__, repr(args[1:]), repr(kwargs)))
+            if runtime.ui.isDebugEnabled(ARC):
+                runtime.ui.debugC(ARC, "D: %s.%s: %s %s"%
+                        (cls.__name__, func.__name__, repr(args[1:]),
+                        repr(kwargs)))
             result = func(*args, **kwargs)
             return result
 
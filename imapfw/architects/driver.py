@@ -159,3 +159,83 @@ class DriversArchitect(object):
     def stop(self) -> None:
         for architect in self.driverArchitects.values():
             architect.stop()
+
+
+class DriverPoolInterface(Interface):
+    """Pool of long-lived driver workers.
+
+    Drivers are leased for a repository and given back once done. An idle
+    driver is leased again for the same repository so that it doesn't have to
+    be built and connected again."""
+
+    scope = Interface.INTERNAL
+
+    def drop(self, driverArch: DriverArchitect) -> None:
+        """Kill a leased driver. It won't be given back."""
+
+    def giveBack(self, repositoryName: str,
+            driverArch: DriverArchitect) -> None:
+        """Make the driver available again."""
+
+    def kill(self) -> None:
+        """Kill the workers."""
+
+    def lease(self, repositoryName: str) -> DriverArchitect:
+        """Return an idle driver for this repository, start one if none.
+
+        The repository name is None for a driver which will be built for any
+        repository."""
+
+    def stop(self) -> None:
+        """Logout and stop the workers."""
+
+
+@checkInterfaces()
+@implements(DriverPoolInterface)
+class DriverPool(object):
+    def __init__(self, workerName: str):
+        self.workerName = workerName
+
+        self.driverArchitects = [] # All the started drivers.
+        self.idle = {} # Idle drivers by repository name.
+
+    def _debug(self, msg) -> None:
+        runtime.ui.debugC(ARC, "%s %s"% (self.workerName, msg))
+
+    def drop(self, driverArch: DriverArchitect) -> None:
+        self._debug("drop(%s)"% driverArch.workerName)
+        driverArch.kill()
+        self.driverArchitects.remove(driverArch)
+
+    def giveBack(self, repositoryName: str,
+            driverArch: DriverArchitect) -> None:
+        self._debug("giveBack(%s, %s)"% (repositoryName, driverArch.workerName))
+        self.idle.setdefault(repositoryName, []).append(driverArch)
+
+    def kill(self) -> None:
+        for architect in self.driverArchitects:
+            architect.kill()
+        self.driverArchitects = []
+        self.idle = {}
+
+    def lease(self, repositoryName: str) -> DriverArchitect:
+        idle = self.idle.get(repositoryName)
+        if idle:
+            driverArch = idle.pop()
+        else:
+            workerName = "%s.Driver.%i"% (self.workerName,
+                len(self.driverArchitects))
+            driverArch = DriverArchitect(workerName)
+            driverArch.init()
+            driverArch.start()
+            self.driverArchitects.append(driverArch)
+
+        self._debug("lease(%s): %s"% (repositoryName, driverArch.workerName))
+        return driverArch
+
+    def stop(self) -> None:
+        for architect in self.driverArchitects:
+            architect.getEmitter().logout()
+            architect.stop()
+        self.driverArchitects = []
+        self.idle = {}
@@ -1,176 +1,287 @@
 # The MIT License (MIT).
 # Copyright (c) 2015-2016, Nicolas Sebrecht & contributors.
 
+"""
+
+The folders of all the accounts are synced by one pool of folder workers.
+
+The account engines hand their folders over to the scheduler. Each folder is a
+task sent to an idle folder worker, whatever the account. The number of
+folders synced at the same time for a repository is bounded by its
+'max_connections'.
+
+The folders taking the longest time to sync are started first so that they
+don't stretch the end of the run (longest processing time first). The
+estimate is the time it took in the previous run, see `imapfw.state`. Folders
+never synced come first.
+
+"""
+
+import time
+from collections import deque
+
 from imapfw import runtime
 
 from imapfw.constants import ARC
-from imapfw.edmp import newEmitterReceiver
 from imapfw.runners import topRunner
 from imapfw.engines import SyncFolders
+from imapfw.state import FolderHistory
+from imapfw.types.account import loadAccount
 
-from .driver import DriverArchitect, ReuseDriverArchitect
 from .architect import Architect
 
 # Annotations.
+from imapfw.annotation import Dict, Function, List
 from imapfw.edmp import Emitter
-from imapfw.concurrency import Queue
-from imapfw.types.folder import Folders
+from imapfw.types.folder import Folder, Folders
+from imapfw.types.repository import Repository
+from .driver import DriverPool
 
 
 class SyncFolderArchitect(object):
-    """Architect to manage a folder worker."""
+    """Architect to manage a folder worker.
 
-    def __init__(self, workerName, accountName: str):
+    The worker and its drivers live until the end of the run or until the
+    worker is needed for other repositories. Folders of any account with the
+    same repositories are sent to the worker."""
+
+    def __init__(self, workerName, driverPool: DriverPool, monitor: Emitter):
         self.workerName = workerName
-        self.accountName = accountName
+        self.driverPool = driverPool
+        self.monitor = monitor
 
-        self._debug("__init__(%s, %s)"% (workerName, accountName))
+        self._debug("__init__(%s)"% workerName)
 
-        self.worker = None
-        self.receiver = None
         self.architect = None
+        self.folderTasks = None
         self.leftArch = None
         self.rightArch = None
-        self.exitCode = -1
-        # Engine might handle both driver.
-        self.reuseLeft = False
-        self.reuseRight = False
+        self.repositoryNames = None # Repositories of the drivers.
 
     def _debug(self, msg) -> None:
         runtime.ui.debugC(ARC, "%s folderArchitect %s"% (self.workerName, msg))
 
-    def _on_stop(self, exitCode: int) -> None:
-        self._debug("stop(%i)"% exitCode)
-        """Stop architects when approppriate.
-
-        When the account engine started us with both side drivers we must NOT
-        stop them so that the account engine can reuse them."""
-
-        if self.reuseLeft is False:
-            self.leftArch.stop()
-        if self.reuseRight is False:
-            self.rightArch.stop()
-        self.architect.stop()
-        self._setExitCode(exitCode)
-
-    def _setExitCode(self, exitCode: int) -> None:
-        self._debug("_setExitCode(%i)"% exitCode)
-        self.exitCode = max(exitCode, self.exitCode)
-
-    def getExitCode(self) -> int:
-        try:
-            self.receiver.react()
-        except Exception as e:
-            runtime.ui.critical("folder receiver [%s] got unexpected error: %s"%
-                (self.workerName, e))
-            runtime.ui.exception(e)
-            self.kill()
-            self._setExitCode(10) # See manual.
-        return self.exitCode
-
     def kill(self) -> None:
+        """Kill the worker and its drivers which can't be trusted anymore."""
+
         self._debug("kill()")
 
-        self.leftArch.stop()
-        self.rightArch.stop()
         self.architect.kill()
+        self.driverPool.drop(self.leftArch)
+        self.driverPool.drop(self.rightArch)
 
-    def start(self, folderTasks: Queue,
-            left: Emitter, right: Emitter) -> None:
+    def start(self, repositoryNames: tuple) -> None:
+        self._debug("start(%s)"% repr(repositoryNames))
 
-        self._debug("start()")
+        self.repositoryNames = repositoryNames
+        leftName, rightName = repositoryNames
+        self.leftArch = self.driverPool.lease(leftName)
+        self.rightArch = self.driverPool.lease(rightName)
 
-        self.architect = Architect(self.workerName)
+        self.folderTasks = runtime.concurrency.createQueue()
 
-        if left is None:
-            self.leftArch = DriverArchitect("%s.Driver.0"% self.workerName)
-            self.leftArch.init()
-            self.leftArch.start()
-            left = self.leftArch.getEmitter()
-        else:
-            self.reuseLeft = True
-            self.leftArch = ReuseDriverArchitect(left)
-        if right is None:
-            self.rightArch = DriverArchitect("%s.Driver.1"% self.workerName)
-            self.rightArch.init()
-            self.rightArch.start()
-            right = self.rightArch.getEmitter()
-        else:
-            self.reuseRight = True
-            self.rightArch = ReuseDriverArchitect(right)
-
-        receiver, emitter = newEmitterReceiver(self.workerName)
-        receiver.accept('stop', self._on_stop)
-        self.receiver = receiver
-
-        engine = SyncFolders(self.workerName, emitter, left, right,
-            self.accountName)
+        engine = SyncFolders(self.workerName, self.monitor,
+            self.leftArch.getEmitter(), self.rightArch.getEmitter())
 
+        self.architect = Architect(self.workerName)
         self.architect.start(
             topRunner,
-            (self.workerName, engine.run, folderTasks),
+            (self.workerName, engine.run, self.folderTasks),
             )
 
+    def stop(self) -> None:
+        """Stop the worker and give the drivers back, still connected."""
 
-class SyncFoldersArchitect(object):
-    """Handle a collection of FolderArchitect instances.
-
-    Must be used in a per-account basis."""
-
-    def __init__(self, accountWorkerName: str, accountName: str):
-        self.accountName = accountName
-        self.accountWorkerName = accountWorkerName
-
-        self.folderArchitects = []
-        self.exitCode = -1
+        self._debug("stop()")
 
+        self.folderTasks.put(None)
+        self.architect.stop()
+        leftName, rightName = self.repositoryNames
+        self.driverPool.giveBack(leftName, self.leftArch)
+        self.driverPool.giveBack(rightName, self.rightArch)
+
+    def syncFolder(self, accountName: str, folder: Folder,
+            repositoryNames: tuple) -> None:
+        self._debug("syncFolder(%s, %s)"% (accountName, folder))
+
+        # The engine was started with the drivers of these repositories.
+        assert repositoryNames == self.repositoryNames
+        self.folderTasks.put((accountName, folder))
+
+
+class FolderScheduler(object):
+    """Dispatch the folders of all the accounts to the folder workers.
+
+    Live in the main worker. The folder engines report each synced folder to
+    the monitor which calls `folderDone`."""
+
+    def __init__(self, driverPool: DriverPool, monitor: Emitter,
+            history: FolderHistory=None):
+        self.driverPool = driverPool
+        self.monitor = monitor
+        self.history = history
+        if history is None:
+            self.history = FolderHistory()
+
+        self.folderArchitects = {} # SyncFolderArchitect by worker name.
+        self.started = 0 # Folder workers started, to name them.
+        self.idle = [] # Idle SyncFolderArchitect.
+        self.running = {} # Running task by worker name.
+        self.pending = deque() # Tasks of all the accounts, longest first.
+        self.accounts = {} # State of the accounts being synced, by key.
+        self.connections = {} # Running folders by repository name.
+        self.maxConnections = {} # By repository name.
 
     def _debug(self, msg) -> None:
-        runtime.ui.debugC(ARC, "%s foldersArchitect %s %s"%
-            (self.accountWorkerName, self.accountName, msg))
-
-    def _setExitCode(self, exitCode) -> None:
-        self._debug("_setExitCode(%i)"% exitCode)
-        if exitCode > self.exitCode:
-            self.exitCode = exitCode
-
-    def getExitCode(self) -> int:
-        for folderArchitect in self.folderArchitects:
-            exitCode = folderArchitect.getExitCode()
-            if exitCode >= 0:
-                self.folderArchitects.remove(folderArchitect)
-                self._setExitCode(exitCode)
-                self._debug("%i architect(s) remaining"%
-                    len(self.folderArchitects))
-
-        if len(self.folderArchitects) < 1:
-            return self.exitCode
-        else:
-            return -1 # Let caller know workers are busy.
+        runtime.ui.debugC(ARC, "folderScheduler %s"% msg)
+
+    def _dispatch(self) -> None:
+        """Send the pending tasks to the idle workers, in order.
+
+        A task is delayed while any of its repositories has no connection
+        left or while the same folder is synced by another worker."""
+
+        syncing = [(task[1], task[2]) for task in self.running.values()]
+        for task in list(self.pending):
+            (key, accountName, folder, repositoryNames, estimate,
+                fingerprints) = task
+            if (accountName, folder) in syncing:
+                continue
+            if not all(self.connections[name] < self.maxConnections[name]
+                    for name in repositoryNames):
+                continue
+
+            folderArchitect = self._getIdle(repositoryNames)
+            self.pending.remove(task)
+            for name in repositoryNames:
+                self.connections[name] += 1
+            self.running[folderArchitect.workerName] = (key, accountName,
+                folder, repositoryNames, time.monotonic(), fingerprints)
+            syncing.append((accountName, folder))
+            folderArchitect.syncFolder(accountName, folder, repositoryNames)
+
+    def _getIdle(self, repositoryNames: tuple) -> SyncFolderArchitect:
+        """Return an idle worker with drivers for these repositories. Start a
+        new worker if none.
+
+        An idle worker of other repositories is replaced: its drivers are
+        given back to the pool under the names they were leased for."""
+
+        for folderArchitect in self.idle:
+            if folderArchitect.repositoryNames == repositoryNames:
+                self.idle.remove(folderArchitect)
+                return folderArchitect
+
+        if len(self.idle) > 0:
+            folderArchitect = self.idle.pop(0)
+            folderArchitect.stop()
+            del self.folderArchitects[folderArchitect.workerName]
+
+        workerName = "Folder.%i"% self.started
+        self.started += 1
+        folderArchitect = SyncFolderArchitect(workerName, self.driverPool,
+            self.monitor)
+        folderArchitect.start(repositoryNames)
+        self.folderArchitects[workerName] = folderArchitect
+        return folderArchitect
+
+    def _setMaxConnections(self, repository: Repository) -> None:
+        name = repository.getClassName()
+        if name not in self.maxConnections:
+            try:
+                maxConnections = int(repository.conf.get('max_connections'))
+            except (AttributeError, TypeError):
+                maxConnections = 999 # Same default as the rascal.
+            self.maxConnections[name] = max(1, maxConnections)
+            self.connections[name] = 0
+
+    def cancel(self, key: str) -> None:
+        """Drop the pending folders of this account and kill the workers
+        syncing its folders."""
+
+        self._debug("cancel(%s)"% key)
+        for task in list(self.pending):
+            if task[0] == key:
+                self.pending.remove(task)
+        self.accounts.pop(key, None)
+
+        for workerName, task in list(self.running.items()):
+            if task[0] != key:
+                continue
+            self.running.pop(workerName)
+            for name in task[3]:
+                self.connections[name] -= 1
+            self.folderArchitects.pop(workerName).kill()
+        self._dispatch()
+
+    def folderDone(self, workerName: str, exitCode: int) -> None:
+        if workerName not in self.running:
+            return # Killed while syncing.
+        (key, accountName, folder, repositoryNames, startTime,
+            fingerprints) = self.running.pop(workerName)
+        for name in repositoryNames:
+            self.connections[name] -= 1
+        self.idle.append(self.folderArchitects[workerName])
+        if exitCode == 0:
+            # The fingerprints are the ones before the sync: the folder is
+            # synced again next time if changed meanwhile.
+            self.history.record(accountName, folder,
+                time.monotonic() - startTime, fingerprints)
+
+        account = self.accounts.get(key)
+        if account is not None: # Not cancelled.
+            account['exitCode'] = max(exitCode, account['exitCode'])
+            account['remaining'] -= 1
+            self._debug("%s: %i folder(s) remaining"%
+                (key, account['remaining']))
+            if account['remaining'] < 1:
+                self.accounts.pop(key)
+                account['done'](account['exitCode'])
+
+        self._dispatch()
 
     def kill(self) -> None:
         self._debug("kill()")
-        for folderArchitect in self.folderArchitects:
+        for folderArchitect in self.folderArchitects.values():
             folderArchitect.kill()
-            self.folderArchitects.remove(folderArchitect)
+        self.folderArchitects = {}
+
+    def schedule(self, key: str, accountName: str, folders: Folders,
+            done: Function, fingerprints: Dict[str, List]=None) -> None:
+        """Sync the folders of the account.
+
+        The key identifies this sync of the account. done is called with the
+        exit code once all the folders are synced. The fingerprints of both
+        sides by folder name are recorded in the history once synced."""
+
+        self._debug("schedule(%s, %s, %s)"% (key, accountName, folders))
 
-    def start(self, maxFolderWorkers: int, folders: Folders,
-            left: Emitter=None, right: Emitter=None) -> None:
+        if len(folders) < 1:
+            done(0)
+            return
 
-        self._debug("start(%i, %s, %s, %s)"% (maxFolderWorkers,
-            folders, repr(left), repr(right)))
+        account = loadAccount(accountName)
+        repositories = (account.fw_getLeft(), account.fw_getRight())
+        for repository in repositories:
+            self._setMaxConnections(repository)
+        repositoryNames = tuple(r.getClassName() for r in repositories)
 
-        folderTasks = runtime.concurrency.createQueue()
+        self.accounts[key] = {
+            'remaining': len(folders),
+            'exitCode': 0,
+            'done': done,
+            }
         for folder in folders:
-            folderTasks.put(folder)
-        # Avoid race conditions. See .account.SyncAccountsArchitect.
-        while folderTasks.empty():
-            pass
-
-        for i in range(maxFolderWorkers):
-            workerName = "%s.Folder.%i"% (self.accountWorkerName, i)
-
-            folderArchitect = SyncFolderArchitect(workerName, self.accountName)
-            folderArchitect.start(folderTasks, left, right)
-            left, right = None, None # Don't re-use drivers too much. :-)
-            self.folderArchitects.append(folderArchitect)
+            estimate = self.history.getEstimate(accountName, folder)
+            self.pending.append((key, accountName, folder, repositoryNames,
+                estimate, (fingerprints or {}).get(folder.getName())))
+        # Unknown folders first, then the longest. Sort is stable.
+        self.pending = deque(sorted(self.pending,
+            key=lambda task: (task[4] is not None, -(task[4] or 0))))
+        self._dispatch()
+
+    def stop(self) -> None:
+        self._debug("stop()")
+        for folderArchitect in self.folderArchitects.values():
+            folderArchitect.stop()
+        self.folderArchitects = {}
@@ -16,6 +16,12 @@ Using the concurrency module
 The main entry point is the :func:`Concurrency` factory. The returned
 backend satisfy the interface :class:`ConcurrencyInterface`.
 
+Large data (e.g. message bodies) should be wrapped with
+`createPayload` before being sent to another worker. With multiprocessing, large
+payloads are put in shared memory and only a small descriptor goes through the
+queue. The receiver gets the data as a memoryview with `getView` and must call
+`release` when done.
+
 The :func:`WorkerSafe` decorator allows to easily make any existing callable
 concurrency-safe.
 
@@ -44,10 +50,15 @@ class WorkerInterface(object):
 
 
 class QueueInterface(object):
-    def empty(self):        raise NotImplementedError
-    def get(self):          raise NotImplementedError
-    def get_nowait(self):   raise NotImplementedError
-    def put(self):          raise NotImplementedError
+    def empty(self):                raise NotImplementedError
+    def get(self, timeout=None):    raise NotImplementedError
+    def get_nowait(self):           raise NotImplementedError
+    def put(self):                  raise NotImplementedError
+
+
+class PayloadInterface(object):
+    def getView(self):  raise NotImplementedError
+    def release(self):  raise NotImplementedError
 
 
 class LockInterface(object):
@@ -57,9 +68,11 @@ class LockInterface(object):
 
 class ConcurrencyInterface(object):
     def createLock(self):                   raise NotImplementedError
+    def createPayload(self):                raise NotImplementedError
     def createQueue(self):                  raise NotImplementedError
     def createWorker(self):                 raise NotImplementedError
     def getCurrentWorkerNameFunction(self): raise NotImplementedError
+    def setQueueValidation(self):           raise NotImplementedError
 
 
 def WorkerSafe(lock) -> LockInterface:
@@ -88,6 +101,74 @@ class LockBase(LockInterface):
         self.lock.release()
 
 
+PAYLOAD_MIN_SHARED_SIZE = 64 * 1024
+"""Smaller payloads are cheaper to copy through the queues."""
+
+
+class InlinePayload(PayloadInterface):
+    """Payload passed by the queue itself."""
+
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def getView(self) -> memoryview:
+        return memoryview(self._data)
+
+    def release(self) -> None:
+        self._data = None
+
+
+class SharedPayload(PayloadInterface):
+    """Payload stored in shared memory.
+
+    Only the name of the shared memory block goes through the queues. The
+    receiver gets a view on the block without copy and must release the
+    payload once done. The view must not be used after release."""
+
+    def __init__(self, data: bytes):
+        from multiprocessing.shared_memory import SharedMemory
+
+        shm = SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        self._name = shm.name
+        self._size = len(data)
+        shm.close() # Block stays available until unlinked by release().
+        # The block stays registered to the resource tracker shared by the
+        # workers until release(): the tracker unlinks the blocks never
+        # released at the end of the run.
+
+        self._shm = None
+        self._view = None
+
+    def __getstate__(self):
+        return {'_name': self._name, '_size': self._size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._view = None
+
+    def getView(self) -> memoryview:
+        from multiprocessing.shared_memory import SharedMemory
+
+        if self._view is None:
+            self._shm = SharedMemory(name=self._name)
+            self._view = self._shm.buf[:self._size]
+        return self._view
+
+    def release(self) -> None:
+        from multiprocessing.shared_memory import SharedMemory
+
+        if self._shm is None:
+            self._shm = SharedMemory(name=self._name)
+        else:
+            self._view.release()
+            self._view = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+
 class ThreadingBackend(ConcurrencyInterface):
     """
     Handling signals with threading
@@ -104,6 +185,9 @@ class ThreadingBackend(ConcurrencyInterface):
     Kills everything (the process is killed, so the threads).
     """
 
+    def __init__(self):
+        self.validateQueues = False
+
     def createWorker(self, name, target, args):
         from threading import Thread
 
@@ -158,9 +242,16 @@ class ThreadingBackend(ConcurrencyInterface):
 
         return TLock(Lock())
 
+    def createPayload(self, data: bytes) -> PayloadInterface:
+        """Workers share the memory: pass a reference to the data."""
+
+        return InlinePayload(data)
+
     def createQueue(self):
         from queue import Queue, Empty # Thread-safe.
 
+        backend = self
+
         class TQueue(QueueInterface):
             def __init__(self):
                 self._queue = Queue()
@@ -168,8 +259,15 @@ class ThreadingBackend(ConcurrencyInterface):
             def empty(self):
                 return self._queue.empty()
 
-            def get(self):
-                return self._queue.get()
+            def get(self, timeout=None):
+                """Block until an item is available.
+
+                Return None if timeout (in seconds) is reached."""
+
+                try:
+                    return self._queue.get(timeout=timeout)
+                except Empty:
+                    return None
 
             def get_nowait(self):
                 try:
@@ -178,9 +276,10 @@ class ThreadingBackend(ConcurrencyInterface):
                     return None
 
             def put(self, data):
-                # Fail now if data can't be pickled. Otherwise, error will be
-                # raised at random time.
-                pickle.dumps(data)
+                # Nothing is serialized with threading. In validation mode,
+                # fail like multiprocessing would if data can't be pickled.
+                if backend.validateQueues is True:
+                    pickle.dumps(data)
                 self._queue.put(data)
 
         return TQueue()
@@ -192,6 +291,14 @@ class ThreadingBackend(ConcurrencyInterface):
             return current_thread().name
         return currentWorkerName
 
+    def setQueueValidation(self, validate: bool) -> None:
+        """Check that data put in the queues can be pickled.
+
+        Usefull for testing: code working with threading must work with
+        multiprocessing, too."""
+
+        self.validateQueues = validate
+
 
 class MultiProcessingBackend(ConcurrencyInterface):
     """
@@ -211,7 +318,7 @@ class MultiProcessingBackend(ConcurrencyInterface):
     """
 
     def createWorker(self, name, target, args):
-        from multiprocessing import Process
+        from multiprocessing import Process, resource_tracker
 
         class Worker(WorkerInterface):
             def __init__(self, name, target, args):
@@ -234,6 +341,9 @@ class MultiProcessingBackend(ConcurrencyInterface):
                 runtime.ui.debugC(WRK, "%s killed"% self._name)
 
             def start(self):
+                # The workers must share the resource tracker of this process
+                # for the payloads created and released by different workers.
+                resource_tracker.ensure_running()
                 self._process.start()
                 runtime.ui.debugC(WRK, "%s started"% self._name)
 
@@ -261,6 +371,13 @@ class MultiProcessingBackend(ConcurrencyInterface):
 
         return MLock(Lock())
 
+    def createPayload(self, data: bytes) -> PayloadInterface:
+        """Put large data in shared memory to not send it through the pipes."""
+
+        if len(data) < PAYLOAD_MIN_SHARED_SIZE:
+            return InlinePayload(data)
+        return SharedPayload(data)
+
     def createQueue(self):
         from multiprocessing import Queue
         import queue
@@ -272,20 +389,27 @@ class MultiProcessingBackend(ConcurrencyInterface):
             def empty(self):
                 return self._queue.empty()
 
-            def get(self):
-                return self._queue.get()
+            def get(self, timeout=None):
+                """Block until an item is available.
+
+                Return None if timeout (in seconds) is reached."""
+
+                try:
+                    return pickle.loads(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    return None
 
             def get_nowait(self):
                 try:
-                    return self._queue.get_nowait()
+                    return pickle.loads(self._queue.get_nowait())
                 except queue.Empty:
                     return None
 
             def put(self, data):
-                # Fail now if data can't be pickled. Otherwise, error will be
-                # raised at random time.
-                pickle.dumps(data)
-                self._queue.put(data)
+                # Serialize now so that errors are raised here rather than at
+                # random time by the feeder thread of the queue. Pickling the
+                # bytes again in the feeder thread is only a copy.
+                self._queue.put(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
 
         return MQueue()
 
@@ -296,6 +420,10 @@ class MultiProcessingBackend(ConcurrencyInterface):
             return current_process().name
         return currentWorkerName
 
+    def setQueueValidation(self, validate: bool) -> None:
+        """Data is always serialized once when put in the queues."""
+
+        pass
 
 
 ConcurrencyBackends = {
@@ -1,6 +1,7 @@
 # The MIT License (MIT).
 # Copyright (c) 2015, Nicolas Sebrecht & contributors.
 
+from imapfw import runtime
 from imapfw.types.folder import Folders, Folder
 from imapfw.types.message import Messages, Message
 
@@ -21,6 +22,11 @@ class FakeDriver(Controller):
         'folders': [b'INBOX', b'INBOX/maidir_archives']
     }
 
+    def __init__(self, *args):
+        super(FakeDriver, self).__init__(*args)
+        self._folders = {} # Appended (attributes, body) by UID, by folder.
+        self._selected = {} # Of the selected folder.
+
     def __getattr__(self, name):
         if name.startswith('fw_'):
             return getattr(self.driver, name)
@@ -28,12 +34,25 @@ class FakeDriver(Controller):
                 (self.getClassName(), name))
         raise AttributeError(message)
 
-    def _folders(self):
+    def _getFolders(self):
         folders = Folders()
         for folderName in self.conf.get('folders'):
-            folders.append(Folder(folderName))
+            folder = Folder(folderName)
+            folder.setFingerprint([0]) # Fake folders never change.
+            folders.append(folder)
         return folders
 
+    def appendMessages(self, messages, payloads):
+        uids = []
+        uid = max(self._selected.keys(), default=0)
+        for message, payload in zip(messages.values(), payloads):
+            uid += 1
+            self._selected[uid] = (message.getAttributes(),
+                bytes(payload.getView()))
+            payload.release()
+            uids.append(uid)
+        return uids
+
     def connect(self):
         return True
 
@@ -46,12 +65,34 @@ class FakeDriver(Controller):
     def getDriverClassName(self):
         return self.driver.getClassName()
 
+    def getBodies(self, messages):
+        found = self.getMessages(Messages(*[Message(uid)
+            for uid in messages.keys() if uid in self._selected]), None)
+        payloads = [runtime.concurrency.createPayload(self._selected[uid][1])
+            for uid in found.keys()]
+        return found, payloads
+
     def getFolders(self):
-        return self._folders()
+        return self._getFolders()
+
+    def getHighestModSeq(self):
+        return None # No CONDSTORE.
+
+    def getMessages(self, messages, attributes):
+        for uid in messages.keys():
+            if uid in self._selected:
+                messages.setAttributes(uid, self._selected[uid][0])
+        return messages
 
     def getNamespace(self):
         return "TODO" #TODO
 
+    def getUIDNext(self):
+        return 1 #TODO
+
+    def getUIDValidity(self):
+        return 1 #TODO
+
     def getRepositoryName(self):
         return self.repositoryName
 
@@ -70,5 +111,17 @@ class FakeDriver(Controller):
     def search(self, conditions):
         return Messages() #TODO
 
+    def searchUID(self, conditions):
+        minUID = conditions.getMinUID() or 1
+        return self.getMessages(Messages(*[Message(uid)
+            for uid in self._selected.keys() if uid >= minUID]), None)
+
     def select(self, folder):
-        return True #TODO
+        self._selected = self._folders.setdefault(folder.getName(), {})
+        return len(self._selected)
+
+    def setFlags(self, messages):
+        for uid, message in messages.items():
+            if uid in self._selected:
+                self._selected[uid][0].setFlags(
+                    message.getAttributes().getFlags())
@@ -1,12 +1,15 @@
 # The MIT License (MIT).
 # Copyright (c) 2015, Nicolas Sebrecht & contributors.
 
+from imapfw import runtime
 from imapfw.imap import Imap as ImapBackend
 from imapfw.interface import adapts, checkInterfaces
 
 from .driver import Driver, DriverInterface
 
 # Annotations.
+from imapfw.annotation import Dict, List, Tuple
+from imapfw.concurrency.concurrency import PayloadInterface
 from imapfw.imap import SearchConditions, FetchAttributes
 from imapfw.types.folder import Folders, Folder
 from imapfw.types.message import Messages
@@ -25,17 +28,83 @@ class Imap(Driver):
         super(Imap, self).__init__(*args)
         self.imap = ImapBackend(self.conf.get('backend'))
 
-    def connect(self):
+    def appendMessages(self, messages: Messages,
+            payloads: List[PayloadInterface]) -> List[int]:
+        """Append the messages to the selected folder. Return their new UIDs.
+
+        The payloads are the bodies of the messages, in the same order; they
+        are released once sent, or on error."""
+
+        try:
+            bodies = [bytes(payload.getView()) for payload in payloads]
+        finally:
+            for payload in payloads:
+                payload.release()
+        return self.imap.appendMessages(messages, bodies)
+
+    def connect(self) -> None:
+        """Connect, login and enable the extensions used by the engines.
+
+        Compression is enabled if the 'compress' option is True."""
+
         host = self.conf.get('host')
         port = int(self.conf.get('port'))
-        return self.imap.connect(host, port)
+        self.imap.connect(host, port)
+        self.login()
+
+        capability = self.imap.getCapability()
+        if self.conf.get('compress') is True:
+            if 'COMPRESS=DEFLATE' in capability:
+                self.imap.enableCompression()
+
+        # Only ask for the flags changed since the previous sync.
+        extensions = [name for name in ['CONDSTORE', 'QRESYNC']
+            if name in capability]
+        if len(extensions) > 0:
+            self.imap.enable(extensions)
+
+    def getBodies(self, messages: Messages
+            ) -> Tuple[Messages, List[PayloadInterface]]:
+        """Return the messages found with their attributes and the payloads
+        of their bodies, in the same order."""
+
+        attributes = FetchAttributes()
+        attributes.setDefaults()
+        attributes.enableBODY()
+        messages = self.imap.getMessages(messages, attributes)
+
+        found = Messages()
+        payloads = []
+        for uid, message in messages.items():
+            body = message.getAttributes().getLiteral('BODY[]')
+            if body is None:
+                continue # Expunged.
+            message.getAttributes().setLiteral('BODY[]', None)
+            found.add(message)
+            payloads.append(runtime.concurrency.createPayload(body))
+        return found, payloads
 
     def getCapability(self):
         return self.imap.getCapability()
 
+    def getChangedMessages(self, modSeq: int) -> Tuple[Messages, List[int]]:
+        return self.imap.getChangedMessages(modSeq)
+
+    def getCompressionRatios(self) -> Dict[str, float]:
+        return self.imap.getCompressionRatios()
+
     def getFolders(self) -> Folders:
         return self.imap.getFolders()
 
+    def getHighestModSeq(self) -> int:
+        return self.imap.getHighestModSeq()
+
+    def getUIDNext(self) -> int:
+        return self.imap.getUIDNext()
+
+    def getUIDValidity(self) -> int:
+        return self.imap.getUIDValidity()
+
     def getMessages(self, messages: Messages,
             attributes: FetchAttributes) -> Messages:
 
@@ -47,7 +116,7 @@ class Imap(Driver):
     def login(self) -> None:
         user = self.conf.get('username')
         password = self.conf.get('password')
-        return self.imap.login(user, password)
+        self.imap.login(user, password)
 
     def logout(self) -> None:
         self.imap.logout()
@@ -55,9 +124,12 @@ class Imap(Driver):
     def searchUID(self, conditions: SearchConditions=SearchConditions()):
         return self.imap.searchUID(conditions)
 
-    def select(self, folder: Folder) -> None:
+    def select(self, folder: Folder) -> int:
         return self.imap.select(folder)
 
+    def setFlags(self, messages: Messages) -> None:
+        return self.imap.setFlags(messages)
+
     #def append(self, server,  mail):
         #response = server.append(mail)
         #return response
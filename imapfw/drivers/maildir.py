@@ -21,16 +21,49 @@
 # THE SOFTWARE.
 
 import os
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 from imapfw import runtime
 from imapfw.toolkit import expandPath
 from imapfw.error import DriverFatalError
 from imapfw.constants import DRV
 from imapfw.types.folder import Folders, Folder
+from imapfw.types.message import Messages, Message
+from imapfw.state import MaildirIndex
 from imapfw.interface import adapts, checkInterfaces
 
 from .driver import Driver, DriverInterface
 
+# Annotations.
+from io import BufferedWriter
+from imapfw.annotation import Dict, Iterable, List, Tuple
+from imapfw.concurrency.concurrency import PayloadInterface
+from imapfw.imap import SearchConditions, FetchAttributes
+
+
+# Flags of the info part of the filenames (':2,') and their IMAP names.
+MAILDIR_FLAGS = {
+    'D': '\\Draft',
+    'F': '\\Flagged',
+    'R': '\\Answered',
+    'S': '\\Seen',
+    'T': '\\Deleted',
+}
+
+# The letters of the IMAP flags.
+FLAGS_LETTERS = {flag: letter for letter, flag in MAILDIR_FLAGS.items()}
+
+DURABILITIES = ['message', 'batch', 'none']
+
+# The files of a batch are kept open until synced.
+APPEND_MAX_OPEN_FILES = 256
+
+UID_cre = re.compile(r',U=(?P<uid>\d+)')
+SIZE_cre = re.compile(r',S=(?P<size>\d+)')
 
 
 #TODO: remove this later: the DriverInterface must define the interfaces of
@@ -44,70 +77,335 @@ class Maildir(Driver):
 
     def __init__(self, *args):
         super(Maildir, self).__init__(*args)
-        self._folders = None
+        self._folderName = None # Of the selected folder.
+        self._folderPath = None
+        self._entries = None # Index entries of the selected folder, by UID.
+        self._durability = 'batch' # Set from the conf by connect().
+        self._deliveries = 0 # Number of messages written.
+        # Characters of the hostname not allowed in the unique names.
+        self._hostname = socket.gethostname().replace('/', '\\057'
+            ).replace(':', '\\072')
 
     def _debug(self, msg):
         runtime.ui.debugC(DRV, "driver of %s %s"% (self.getRepositoryName(), msg))
 
-    def _recursiveScanMaildir(self, relativePath=None):
-        """Scan the Maildir recusively.
+    def _getFolderPath(self, folder: Folder) -> str:
+        maildirPath = self.conf.get('path')
+        if folder.getName() == '/':
+            return maildirPath
+        sep = self.conf.get('sep') or '/'
+        return os.path.join(maildirPath, sep.join(folder.getName().split('/')))
 
-        Updates self._folders with what is found in the configured maildir path.
-        TODO: fix encoding.
+    def _scanDirectory(self, fullPath: str) -> Tuple[List[int], List[str]]:
+        """Return the fingerprint and the sorted subdirectories of a directory.
+
+        The fingerprint is None if the directory is not a folder (with cur, new
+        and tmp)."""
 
-        :args:
-        - maildirPath: path to the Maildir (as defined in the conf).
+        special = {} # DirEntry of cur, new and tmp.
+        children = []
+        with os.scandir(fullPath) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                if entry.name in ['cur', 'new', 'tmp']:
+                    special[entry.name] = entry
+                else:
+                    children.append(entry.name)
+
+        fingerprint = None
+        if len(special) == 3:
+            # Adding, removing or renaming (flags) a mail changes the mtimes.
+            fingerprint = [
+                special['cur'].stat().st_mtime_ns,
+                special['new'].stat().st_mtime_ns,
+                ]
+        return fingerprint, sorted(children)
+
+    def _scanFolders(self) -> Iterable[Folder]:
+        """Yield the folders found in the configured maildir path.
+
+        Whether an entry is a directory is known from the listing of
+        os.scandir(), without stat() on most filesystems. The directories are
+        scanned by the pool of threads as soon as they are known while the
+        folders are yielded depth-first, in order. The configured path might
+        not be a real maildir but a base path of maildirs.
+        TODO: fix encoding.
         """
 
-        def isFolder(path):
-            return (os.path.isdir(os.path.join(path, 'cur')) and
-                os.path.isdir(os.path.join(path, 'new')) and
-                os.path.isdir(os.path.join(path, 'tmp'))
-                )
+        maildirPath = self.conf.get('path')
+        sep = self.conf.get('sep')
+
+        with self._createPool() as pool:
+            # Relative paths to yield with their scan, None for the root.
+            pending = [(None, pool.submit(self._scanDirectory, maildirPath))]
+            while len(pending) > 0:
+                relativePath, scan = pending.pop()
+                fingerprint, children = scan.result()
+
+                if fingerprint is not None:
+                    #TODO: get encoding from conf.
+                    if relativePath is None:
+                        # We are the root of the maildir. Fix the name to '/'.
+                        folder = Folder('/', encoding='UTF-8')
+                    else:
+                        # Fix separator to '/' ASAP. ,-)
+                        folder = Folder('/'.join(relativePath.split(sep)),
+                            encoding='UTF-8')
+                    folder.setFingerprint(fingerprint)
+                    yield folder
+
+                    if sep != '/': # Nested folders are not allowed.
+                        continue
+                elif relativePath is not None:
+                    continue # Only the root might be a base path of maildirs.
+
+                # Depth-first, in order.
+                for directory in reversed(children):
+                    if relativePath is not None:
+                        directory = os.path.join(relativePath, directory)
+                    pending.append((directory, pool.submit(
+                        self._scanDirectory,
+                        os.path.join(maildirPath, directory))))
+
+    def _buildMessages(self, entries: Dict[int, list]) -> Messages:
+        messages = Messages()
+        flagsByLetters = {} # Most of the messages share a few flags.
+        for uid, (filename, letters, size, internaldate) in entries.items():
+            message = Message(uid)
+            attributes = message.getAttributes()
+            flags = flagsByLetters.get(letters)
+            if flags is None:
+                # Lowercase letters are keywords.
+                flags = [MAILDIR_FLAGS[letter]
+                    for letter in letters if letter in MAILDIR_FLAGS]
+                flagsByLetters[letters] = flags
+            attributes.setFlags(list(flags))
+            attributes.setSize(size)
+            if internaldate is not None:
+                attributes.setInternaldate(
+                    datetime.fromtimestamp(internaldate, timezone.utc))
+            messages.data[uid] = message
+        return messages
+
+    def _createPool(self) -> ThreadPoolExecutor:
+        """Return a pool of threads to scan the directories.
+
+        On network filesystems, the scans are mostly waiting for the server."""
+
+        try:
+            scanThreads = int(self.conf.get('scan_threads'))
+        except TypeError:
+            scanThreads = 4
+        return ThreadPoolExecutor(max_workers=max(1, scanThreads))
+
+    def _fsyncDirectory(self, path: str) -> None:
+        """Make the renames in the directory durable."""
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _getFingerprint(self) -> List[int]:
+        """Return the mtimes of cur and new of the selected folder, None if
+        the folder does not exist."""
+
+        try:
+            return [os.stat(os.path.join(self._folderPath, subdirectory)
+                ).st_mtime_ns for subdirectory in ['cur', 'new']]
+        except FileNotFoundError:
+            return None
+
+    def _getIndex(self) -> MaildirIndex:
+        statePath = None
+        if runtime.rascal is not None: # Not loaded by the unit tests.
+            statePath = runtime.rascal.getStatePath()
+        return MaildirIndex(statePath, self.getRepositoryName(),
+            self._folderName)
+
+    def _getUniqueName(self, timestamp: int) -> str:
+        """Return a unique name for a new message, starting with the time of
+        delivery."""
+
+        self._deliveries += 1
+        return "%i.M%iP%iQ%i.%s"% (timestamp, time.time_ns() // 1000 % 10**6,
+            os.getpid(), self._deliveries, self._hostname)
+
+    def _loadEntries(self) -> Dict[int, list]:
+        """Return the index entries of the selected folder.
+
+        The index is used if the folder did not change since it was saved.
+        Otherwise, the folder is scanned and the index saved again. The
+        messages are only built when asked for."""
+
+        fingerprint = self._getFingerprint()
+        index = self._getIndex()
+        entries = index.load(fingerprint)
+        if entries is None:
+            entries = self._scanMessages()
+            index.save(fingerprint, entries)
+        else:
+            self._debug("using the index of %s"% self._folderPath)
+        return entries
+
+    def _scanMessages(self) -> Dict[int, list]:
+        """Return the index entries of the selected folder.
+
+        cur and new are scanned by the pool of threads."""
 
-        def scanChildren(path, relativePath):
-            for directory in os.listdir(path):
-                if directory in ['cur', 'new', 'tmp']:
-                    continue # Ignore special directories ASAP.
+        entries = {}
+        with self._createPool() as pool:
+            for subdirectoryEntries in pool.map(self._scanSubdirectory,
+                    ['cur', 'new']):
+                entries.update(subdirectoryEntries)
 
-                folderPath = os.path.join(path, directory)
-                if not os.path.isdir(folderPath):
+        self._debug("found %i messages in %s"% (len(entries),
+            self._folderPath))
+        return entries
+
+    def _scanSubdirectory(self, subdirectory: str) -> Dict[int, list]:
+        """Return the index entries of cur or new of the selected folder.
+
+        Everything comes from the filenames: the UID from the ',U=' token, the
+        flags from the ':2,' info, the size from the ',S=' token and the
+        internaldate from the time of delivery in the unique name. No file is
+        opened. The files without UID are ignored.
+        """
+
+        entries = {}
+        path = os.path.join(self._folderPath, subdirectory)
+        try:
+            scandir = os.scandir(path)
+        except FileNotFoundError:
+            return entries # Folder not created yet.
+        with scandir:
+            for entry in scandir:
+                name = entry.name
+                base, _, letters = name.partition(':2,')
+                match = UID_cre.search(base)
+                if match is None:
                     continue
 
-                if relativePath is None:
-                    newRelativePath = directory
+                size = None
+                if ',S=' in base:
+                    sizeMatch = SIZE_cre.search(base)
+                    if sizeMatch is not None:
+                        size = int(sizeMatch.group('size'))
+                internaldate, _, _ = base.partition('.')
+                if internaldate.isdigit():
+                    internaldate = int(internaldate)
                 else:
-                    newRelativePath = os.path.join(relativePath, directory)
+                    internaldate = None
+                entries[int(match.group('uid'))] = ["%s/%s"% (subdirectory,
+                    name), letters, size, internaldate]
+        return entries
 
-                self._recursiveScanMaildir(newRelativePath) # Recurse!
+    def _syncFiles(self, pending: List[Tuple[BufferedWriter, str]]) -> None:
+        """Sync the files written in tmp to disk, close and move them to their
+        relative path, then sync the directories."""
 
-        # Fix local variables to their default values if needed.
-        maildirPath = self.conf.get('path')
-        sep = self.conf.get('sep')
+        if len(pending) < 1:
+            return
+        directories = set()
+        for fd, _ in pending:
+            fd.flush()
+            os.fsync(fd.fileno())
+            fd.close()
+        for fd, relativePath in pending:
+            path = os.path.join(self._folderPath, relativePath)
+            os.rename(fd.name, path)
+            directories.add(os.path.dirname(path))
+        for directory in sorted(directories):
+            self._fsyncDirectory(directory)
 
-        # Set the fullPath.
-        if relativePath is None:
-            fullPath = maildirPath
-        else:
-            fullPath = os.path.join(maildirPath, relativePath)
-
-        if isFolder(fullPath):
-            #TODO: get encoding from conf.
-            if relativePath is None:
-                # We are the root of the maildir. Fix the name to '/'.
-                folder = Folder('/', encoding='UTF-8')
-            else:
-                # Fix separator to '/' ASAP. ,-)
-                folder = Folder('/'.join(relativePath.split(sep)), encoding='UTF-8')
-            self._folders.append(folder)
-
-            if sep == '/': # Recurse if nested folders are allowed.
-                scanChildren(fullPath, relativePath)
-        else:
-            # The maildirPath as given by the user might not be a real maildir
-            # but a base path of maildirs. Scan this path.
-            if relativePath is None:
-                scanChildren(fullPath, relativePath)
+    def appendMessages(self, messages: Messages,
+            payloads: List[PayloadInterface]) -> List[int]:
+        """Write a batch of messages in the selected folder. Return their new
+        UIDs, in the same order.
+
+        The payloads are the bodies of the messages, in the same order; they
+        are released once written, or on error. The new UIDs follow the
+        highest UID of the folder. The UIDs, the flags, the sizes and the
+        internaldates of the messages are kept in the filenames.
+
+        The messages are written in tmp then renamed to cur, or to new if they
+        have no flag. The 'durability' option of the conf tells when the data
+        is synced to disk:
+        - 'message': each message, before it is renamed;
+        - 'batch' (default): all the files once written, then the directories
+          once all the files are renamed; by APPEND_MAX_OPEN_FILES files at
+          most;
+        - 'none': left to the OS.
+        """
+
+        tmpPath = os.path.join(self._folderPath, 'tmp')
+        pending = [] # (file, relative path) of the files in tmp, still open.
+        entries = {}
+        written = 0 # Number of payloads written and released.
+        uid = max(self._entries.keys(), default=0)
+        try:
+            for message, payload in zip(messages.values(), payloads):
+                uid += 1
+                attributes = message.getAttributes()
+                view = payload.getView()
+                size = view.nbytes
+
+                letters = ''.join(sorted(FLAGS_LETTERS[flag]
+                    for flag in attributes.getFlags() if flag in FLAGS_LETTERS))
+                internaldate = attributes.getInternaldate()
+                if internaldate is None:
+                    timestamp = int(time.time())
+                else:
+                    timestamp = int(internaldate.timestamp())
+
+                name = "%s,U=%i,S=%i"% (self._getUniqueName(timestamp), uid,
+                    size)
+                if len(letters) > 0:
+                    relativePath = "cur/%s:2,%s"% (name, letters)
+                else:
+                    relativePath = "new/%s"% name
+
+                fd = open(os.path.join(tmpPath, name), 'xb')
+                pending.append((fd, relativePath))
+                fd.write(view)
+                payload.release()
+                written += 1
+                entries[uid] = [relativePath, letters, size, timestamp]
+
+                if self._durability == 'none':
+                    fd.close()
+                    os.rename(fd.name,
+                        os.path.join(self._folderPath, relativePath))
+                    pending = []
+                elif self._durability == 'message' or \
+                        len(pending) >= APPEND_MAX_OPEN_FILES:
+                    self._syncFiles(pending)
+                    pending = []
+            self._syncFiles(pending)
+            pending = []
+
+        finally:
+            # On error, don't leave the files of the batch in tmp; the files
+            # already renamed stay in the folder and keep their UID.
+            removed = set()
+            for fd, relativePath in pending:
+                fd.close()
+                try:
+                    os.unlink(fd.name)
+                except FileNotFoundError:
+                    continue # Renamed.
+                removed.add(relativePath)
+            for payload in payloads[written:]:
+                payload.release()
+            for uid, entry in entries.items():
+                if entry[0] not in removed:
+                    self._entries[uid] = entry
+
+        self._debug("appended %i messages to %s"% (len(entries),
+            self._folderPath))
+        return list(entries.keys())
 
     def connect(self):
         path = expandPath(self.conf.get('path'))
@@ -121,17 +419,117 @@ class Maildir(Driver):
         if not os.path.isdir(path):
             raise DriverFatalError("path is not a directory: %s"% path)
         self.conf['path'] = path # Record expanted path.
+
+        self._durability = self.conf.get('durability') or 'batch'
+        if self._durability not in DURABILITIES:
+            raise DriverFatalError("unknown durability '%s', expected one of"
+                " %s"% (self._durability, ', '.join(DURABILITIES)))
         return True
 
     def getFolders(self):
-        self._folders = Folders() # Erase whatever we had.
         self._debug('scanning folders')
-        self._recursiveScanMaildir() # Put result into self._folders.
-        return self._folders
+        return Folders(*self._scanFolders())
 
-    def select(self, mailbox):
-        #TODO
-        return True
+    def getBodies(self, messages: Messages
+            ) -> Tuple[Messages, List[PayloadInterface]]:
+        """Return the messages found with their attributes and the payloads
+        of their bodies, in the same order."""
+
+        entries = {}
+        payloads = []
+        for uid in messages.keys():
+            entry = self._entries.get(uid)
+            if entry is None:
+                continue
+            try:
+                with open(os.path.join(self._folderPath, entry[0]),
+                        'rb') as fd:
+                    body = fd.read()
+            except FileNotFoundError:
+                continue # Removed or renamed since the scan.
+            entries[uid] = entry
+            payloads.append(runtime.concurrency.createPayload(body))
+        return self._buildMessages(entries), payloads
+
+    def getHighestModSeq(self):
+        return None # No CONDSTORE.
+
+    def getUIDNext(self) -> int:
+        """None: the engine lists all the messages of the Maildir folders to
+        find the new ones."""
+
+        return None
+
+    def getUIDValidity(self) -> int:
+        """None: the UIDs are kept in the filenames and never change."""
+
+        return None
+
+    def getMessages(self, messages: Messages,
+            attributes: FetchAttributes) -> Messages:
+        """Set the attributes known from the filenames."""
+
+        known = self._buildMessages({uid: self._entries[uid]
+            for uid in messages.keys() if uid in self._entries})
+        for uid in known.keys():
+            messages.setAttributes(uid, known.getAttributes(uid))
+        return messages
+
+    def searchUID(self, conditions: SearchConditions=SearchConditions()
+            ) -> Messages:
+        """Return the messages matching the conditions.
+
+        The conditions are checked on the index entries: only the messages
+        found are built."""
+
+        minUID = conditions.getMinUID()
+        maxSize = conditions.getMaxSize()
+        found = {}
+        for uid, entry in self._entries.items():
+            if minUID is not None and uid < minUID:
+                continue
+            size = entry[2]
+            if maxSize is not None and size is not None and size >= maxSize:
+                continue
+            found[uid] = entry
+        return self._buildMessages(found)
+
+    def setFlags(self, messages: Messages) -> None:
+        """Set the system flags of the messages to the flags of their
+        attributes by renaming the files to cur. The keywords (lowercase
+        letters) are kept."""
+
+        directories = set()
+        for uid, message in messages.items():
+            entry = self._entries.get(uid)
+            if entry is None:
+                continue
+            filename, letters, size, internaldate = entry
+            letters = ''.join(sorted([FLAGS_LETTERS[flag]
+                for flag in message.getAttributes().getFlags()
+                if flag in FLAGS_LETTERS] +
+                [letter for letter in letters if letter not in MAILDIR_FLAGS]))
+            base = os.path.basename(filename).partition(':2,')[0]
+            relativePath = "cur/%s:2,%s"% (base, letters)
+            if relativePath != filename:
+                os.rename(os.path.join(self._folderPath, filename),
+                    os.path.join(self._folderPath, relativePath))
+                directories.update([os.path.dirname(filename), 'cur'])
+            self._entries[uid] = [relativePath, letters, size, internaldate]
+
+        if self._durability != 'none':
+            for directory in sorted(directories):
+                self._fsyncDirectory(os.path.join(self._folderPath, directory))
+
+    def select(self, folder: Folder) -> int:
+        """Return number of existing messages, like the IMAP driver.
+
+        The files without UID are not counted."""
+
+        self._folderName = folder.getName()
+        self._folderPath = self._getFolderPath(folder)
+        self._entries = self._loadEntries()
+        return len(self._entries)
 
     def logout(self):
         self._debug('logging out')
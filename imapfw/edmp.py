@@ -28,9 +28,10 @@ The emitter sends events to the receiver with simple method calls.
 
 The code implementing the "doSomething" event is run by the receiver.
 
-The receiver and the emitter support two kinds of communication:
+The receiver and the emitter support three kinds of communication:
     - asynchronous;
-    - synchronous (actually pseudo-synchronous but you don't have to care).
+    - synchronous (actually pseudo-synchronous but you don't have to care);
+    - future (send now, get the result later).
 
 
 The receiver
@@ -60,7 +61,7 @@ The receiver has only two public methods:
     - accept: to define the available events.
     - react: to process the received events.
 
-The `Receiver.react` method will process all the received events. This returns
+The `Receiver.react` method will process the next received event. This returns
 True or False whether it should continue reacting or not.
 
 :Example:
@@ -68,6 +69,10 @@ True or False whether it should continue reacting or not.
 >>> while receiver.react():
 >>>     pass
 
+By default, `react` waits a short time for an event so that the calling loop
+can do other work. Workers with nothing else to do should block until the next
+event with `react(timeout=None)`. They wake up as soon as an event is sent.
+
 Each event reaction ends before the next is processed in the order they are
 sent by the emitter (they are internally put in a queue). The processing is
 sequential. So, it's fine to use a receiver like that:
@@ -134,6 +139,51 @@ If you need the result of the event, it's possible to get this by appending
 
 >>> result = emitter.doSomething_sync(whatever, parameter=optional, to=send)
 
+The call blocks until the receiver replies. Results and errors are sent back on
+the reply queue of the emitter along with the id of the request. The id
+identifies the calling thread so the replies can't be mixed-up between the
+threads sharing an emitter: one of the waiting threads reads the queue at a time
+and hands the replies of the others over to them.
+
+Each worker must have its own emitter to get replies. Get more emitters with
+`receiver.newEmitter()`, before the worker of the receiver is started or from
+the worker of the receiver. The new emitter sends the events to the same
+receiver and gets the replies on its own queue.
+
+Sending events in future mode
+-----------------------------
+
+Appending '_future' to the event name sends the event and returns a `Future`
+right away. The result is retrieved later. This allows to have more than one
+request in flight, e.g. to make two drivers work at the same time.
+
+:Example:
+
+>>> left = leftEmitter.doSomething_future(whatever)
+>>> right = rightEmitter.doSomething_future(whatever)
+>>> leftResult, rightResult = getResults(left, right)
+
+Errors are raised when getting the result.
+
+Sending events in batch
+-----------------------
+
+Each event is put in the queue on its own. For many small events, it's more
+efficient to send them in one envelope with the `batch` context manager. The
+receiver reacts to the events of the envelope one by one, in order.
+
+:Example:
+
+>>> with emitter.batch():
+>>>     for uid in uids:
+>>>         emitter.setFlags(uid, flags)
+
+The envelope is sent when leaving the block or with `emitter.flush()`. Waiting
+for a result (sync or future modes) flushes the batch first.
+
+The batch belongs to the emitter object. Don't use batches with an emitter
+shared between threads.
+
 Predefined events of emitters
 -----------------------------
 
@@ -141,6 +191,7 @@ Predefined events of emitters
   instead of True allowing reacting loop to stop.
 - 'help': print the docstrings of the accepted events. Usefull in shell sessions
   or for debugging.
+- 'batch' and 'flush': see above.
 
 
 Error handling
@@ -153,10 +204,11 @@ The receiver won't raise any unhandled exception while reacting on events. The
 errors are logged-out.
 
 
-Synchronous mode
-----------------
+Synchronous and future modes
+----------------------------
 
-In synchronous mode, any error is logged-out and then passed to the emitter.
+In synchronous and future modes, any error is logged-out and then passed to the
+emitter.
 
 Because queues can't pass exceptions, only the class and the reason are passed
 to the emitter (without the stack trace which was logged-out). The emitter will
@@ -181,6 +233,10 @@ simple APIs. :-)
 However, if you really need to pass objects, consider implementing the
 `emp.serializer.SerializerInterface` class.
 
+Large data like message bodies should be wrapped with
+`runtime.concurrency.createPayload()` so that they are not copied through the
+queues.
+
 
 Effectively using the receiver and emitters
 -------------------------------------------
@@ -206,7 +262,10 @@ There are good demos at the end of the module. ,-)
 
 """
 
-import time
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
 from typing import TypeVar
 
 from imapfw import runtime
@@ -221,6 +280,25 @@ from imapfw.concurrency import Queue
 _SILENT_TIMES = 100
 
 
+def _realTopic(topic: str) -> str:
+    """Remove the suffix of the mode from the topic."""
+
+    for suffix in ['_sync', '_future']:
+        if topic.endswith(suffix):
+            return topic[:-len(suffix)]
+    return topic
+
+
+def _callerId() -> str:
+    """Identify the current worker for the requests expecting a reply."""
+
+    return "%i.%i"% (os.getpid(), threading.get_ident())
+
+
+def _callerPid(callerId: str) -> int:
+    return int(callerId.split('.')[0])
+
+
 class TopicError(Exception): pass
 
 
@@ -237,90 +315,239 @@ def _raiseError(cls_Exception: ExceptionClass, reason: str):
 
 
 class Channel(object):
-    """Queue made iterable."""
+    """Queue made iterable.
+
+    Iterating stops when the queue is empty. If timeout is set, wait up to
+    timeout seconds for each element (forever if None). A None element in the
+    queue always stops the iteration and wakes up a blocking channel."""
 
-    def __init__(self, queue: Queue):
+    def __init__(self, queue: Queue, timeout: float=0):
         self._queue = queue
+        self._timeout = timeout
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        elem = self._queue.get_nowait()
+        elem = self.get(self._timeout)
         if elem is None:
             raise StopIteration
         return elem
 
+    def get(self, timeout: float=0):
+        """Return the next element or None if none is available in time."""
+
+        if timeout == 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout)
+
+
+class Future(object):
+    """The result of an event sent in future mode."""
+
+    def __init__(self, emitter: 'Emitter', requestId: tuple):
+        self._emitter = emitter
+        self._requestId = requestId
+
+        self._reply = None
+
+    def getResult(self):
+        """Block until the reply is received and return the result.
+
+        Raise the error if the receiver failed."""
+
+        if self._reply is None:
+            self._emitter.flush() # The request might be in a batch.
+            self._reply = self._emitter._getReply(self._requestId)
+
+        failed, value = self._reply
+        if failed is True:
+            cls_Exception, reason = value
+            _raiseError(cls_Exception, reason)
+        return value
+
+
+def getResults(*futures: Future) -> list:
+    """Wait for all the futures and return their results in the same order."""
+
+    return [future.getResult() for future in futures]
+
 
 class Emitter(object):
     """Send events."""
 
-    def __init__(self, name: str, event: Queue, result: Queue, error: Queue):
+    def __init__(self, name: str, event: Queue, reply: Queue,
+            replyNumber: int=0):
         self._name = name
         self._eventQueue = event
-        self._resultQueue = result
-        self._errorQueue = error
-
+        self._replyQueue = reply
+        self._replyNumber = replyNumber # Reply queue of the receiver to use.
+
+        self._batch = None # Events waiting to be flushed in batch mode.
+        self._batchDepth = 0
+        self._requestNumber = 0
+        self._pending = set() # Ids of the requests waiting for a reply.
+        self._replies = {} # Replies received before being waited, by id.
+        # Protects _pending, _replies and _reading between the threads.
+        self._repliesCondition = threading.Condition()
+        self._reading = False # A thread is reading the reply queue.
         self._previousTopic = None
         self._previousTopicCount = 0
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_repliesCondition']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._repliesCondition = threading.Condition()
+
     def __getattr__(self, topic: str):
         """Dynamically create methods to send events."""
 
-        def send_event(*args, **kwargs):
-            request = (topic, args, kwargs)
-
-            if self._previousTopic != topic:
-                if self._previousTopicCount > 0:
-                    runtime.ui.debugC(EMT, "emitter [%s] sent %i times %s"%
-                        (self._name, _SILENT_TIMES, self._previousTopic))
-                self._previousTopicCount = 0
-                self._previousTopic = topic
-                runtime.ui.debugC(EMT, "emitter [%s] sends %s"%
-                    (self._name, request))
-            else:
-                self._previousTopicCount += 1
-                if self._previousTopicCount == 2:
-                    runtime.ui.debugC(EMT, "emitter [%s] sends %s again,"
-                        " further sends for this topic made silent"%
-                        (self._name, request))
-                if self._previousTopicCount > (_SILENT_TIMES - 1):
-                    runtime.ui.debugC(EMT,
-                        "emitter [%s] sends for the %ith time %s"%
-                        (self._name, _SILENT_TIMES, self._previousTopic))
-                    self._previousTopicCount = 0
-            self._eventQueue.put(request)
+        def async_(topic):
+            def send_event(*args, **kwargs):
+                self._send(topic, None, args, kwargs)
 
-        def async(topic):
             return send_event
 
         def sync(topic):
             def sync_event(*args, **kwargs):
-                send_event(*args, **kwargs)
-
-                while True:
-                    error = self._errorQueue.get_nowait()
-                    if error is None:
-                        result = self._resultQueue.get_nowait()
-                        if result is None:
-                            time.sleep(SLEEP) # Don't eat all CPU.
-                            continue
-                        if len(result) > 1:
-                            return result
-                        return result[0]
-                    else:
-                        # Error occured.
-                        cls_Exception, reason = error
-                        _raiseError(cls_Exception, reason)
+                return future(topic)(*args, **kwargs).getResult()
 
             return sync_event
 
-        if topic.startswith("cached_") or topic.endswith('_sync'):
+        def future(topic):
+            def future_event(*args, **kwargs):
+                requestId = self._newRequestId()
+                with self._repliesCondition:
+                    self._pending.add(requestId)
+                self._send(topic, requestId, args, kwargs)
+                return Future(self, requestId)
+
+            return future_event
+
+        if topic.endswith('_future'):
+            setattr(self, topic, future(topic))
+        elif topic.startswith("cached_") or topic.endswith('_sync'):
             setattr(self, topic, sync(topic))
         else:
-            setattr(self, topic, async(topic))
+            setattr(self, topic, async_(topic))
         return getattr(self, topic)
 
+    def _newRequestId(self) -> tuple:
+        """Return an id to correlate the request with its reply.
+
+        The emitter might be used from more than one worker so the id is
+        unique accross the workers."""
+
+        self._requestNumber += 1
+        return (_callerId(), self._requestNumber, self._replyNumber)
+
+    def _debugSend(self, topic: str, request: tuple) -> None:
+        """Log the sent event, except when repeated too many times."""
+
+        if self._previousTopic != topic:
+            if self._previousTopicCount > 0:
+                runtime.ui.debugC(EMT, "emitter [%s] sent %i times %s"%
+                    (self._name, _SILENT_TIMES, self._previousTopic))
+            self._previousTopicCount = 0
+            self._previousTopic = topic
+            runtime.ui.debugC(EMT, "emitter [%s] sends %s"%
+                (self._name, request))
+        else:
+            self._previousTopicCount += 1
+            if self._previousTopicCount == 2:
+                runtime.ui.debugC(EMT, "emitter [%s] sends %s again,"
+                    " further sends for this topic made silent"%
+                    (self._name, request))
+            if self._previousTopicCount > (_SILENT_TIMES - 1):
+                runtime.ui.debugC(EMT,
+                    "emitter [%s] sends for the %ith time %s"%
+                    (self._name, _SILENT_TIMES, self._previousTopic))
+                self._previousTopicCount = 0
+
+    def _send(self, topic: str, requestId: tuple, args, kwargs) -> None:
+        request = (topic, requestId, args, kwargs)
+
+        # Don't pay for the debug logs when disabled.
+        if runtime.ui.isDebugEnabled(EMT):
+            self._debugSend(topic, request)
+
+        if self._batch is None:
+            self._eventQueue.put(request)
+        else:
+            self._batch.append(request)
+
+    def _getReply(self, requestId: tuple) -> tuple:
+        """Block until the reply to requestId is received.
+
+        Only one thread reads the reply queue at a time. The replies to the
+        requests of the other threads are handed over to them.
+
+        Return the tuple (failed, value)."""
+
+        with self._repliesCondition:
+            while requestId not in self._replies and self._reading:
+                self._repliesCondition.wait()
+            if requestId in self._replies:
+                self._pending.discard(requestId)
+                return self._replies.pop(requestId)
+            self._reading = True
+
+        try:
+            while True:
+                replyId, failed, value = self._replyQueue.get()
+                with self._repliesCondition:
+                    if replyId == requestId:
+                        self._pending.discard(requestId)
+                        return failed, value
+
+                    if replyId in self._pending:
+                        # Another request in flight for this worker. Keep the
+                        # reply until it's waited.
+                        self._replies[replyId] = (failed, value)
+                        self._repliesCondition.notify_all()
+                        continue
+
+                if _callerPid(replyId[0]) != os.getpid():
+                    # The emitter is shared with another process. Give the
+                    # reply back to it.
+                    runtime.ui.error("emitter [%s] is used by more than one"
+                        " worker, use Receiver.newEmitter()"% self._name)
+                    self._replyQueue.put((replyId, failed, value))
+                # Otherwise, this is the reply to a request which was never
+                # waited (e.g. interrupted). Drop it.
+        finally:
+            with self._repliesCondition:
+                self._reading = False
+                self._repliesCondition.notify_all() # Next reader.
+
+    @contextmanager
+    def batch(self):
+        """Context manager to send the events in one envelope.
+
+        The events are flushed when leaving the outermost batch."""
+
+        if self._batch is None:
+            self._batch = []
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if self._batchDepth < 1:
+                self.flush()
+                self._batch = None
+
+    def flush(self) -> None:
+        """Send the events of the current batch, if any."""
+
+        if self._batch:
+            self._eventQueue.put(self._batch)
+            self._batch = []
+
     def help(self) -> None:
         print("Available events:")
         docstrings = self.str_help_sync()
@@ -333,14 +560,15 @@ class Emitter(object):
 class Receiver(object):
     """Honor events."""
 
-    def __init__(self, name: str, event: Queue, result: Queue, error: Queue):
+    def __init__(self, name: str, event: Queue, reply: Queue):
         self._name = name
+        self._eventQueue = event
         self._eventChan = Channel(event)
-        self._resultQueue = result
-        self._errorQueue = error
+        self._replyQueues = [reply] # By reply number of the emitters.
 
         self._reactMap = {}
         self._cache = {} # Cached values.
+        self._batched = deque() # Events of the batch being processed.
         self._previousTopic = None
         self._previousTopicCount = 0
 
@@ -354,10 +582,7 @@ class Receiver(object):
             docstrings[func.__name__] = func.__doc__
         return docstrings
 
-    def _react(self, topic: str, args, kwargs):
-        func, rargs = self._reactMap[topic]
-        args = rargs + args
-
+    def _debugReact(self, topic: str, func: callable, args, kwargs) -> None:
         # Enable debug retention if too many messages.
         if self._previousTopic != topic:
             if self._previousTopicCount > 0:
@@ -379,81 +604,126 @@ class Receiver(object):
                     (_SILENT_TIMES, topic, func.__name__, args, kwargs))
                 self._previousTopicCount = 0
 
+    def _react(self, topic: str, args, kwargs):
+        func, rargs = self._reactMap[topic]
+        args = rargs + args
+
+        if runtime.ui.isDebugEnabled(EMT):
+            self._debugReact(topic, func, args, kwargs)
+
         return func(*args, **kwargs)
 
+    def _nextEvent(self, timeout: float):
+        """Return the next event, unpacking the batches, or None."""
+
+        if len(self._batched) < 1:
+            event = self._eventChan.get(timeout)
+            if type(event) != list:
+                return event
+            self._batched.extend(event)
+        return self._batched.popleft()
+
+    def _reply(self, requestId: tuple, failed: bool, value) -> None:
+        """Send the result (or the error) of a request back to the emitter."""
+
+        callerId, requestNumber, replyNumber = requestId
+        self._replyQueues[replyNumber].put((requestId, failed, value))
+
     def accept(self, event: str, func: callable, *args) -> None:
         self._reactMap[event] = (func, args)
 
-    def react(self) -> bool:
-        """Process events in order.
+    def _handle(self, event) -> bool:
+        """Process one event.
 
-        The order of events is the order of the **available** events in the
-        queue. This is relevant only when *sending* events concurrently (from
-        different workers)."""
+        Return False on 'stopServing', True if the event was honored, None if
+        it failed and the receiver should continue with the next event."""
 
-        for event in self._eventChan:
-            topic, args, kwargs = event
-            try:
+        topic, requestId, args, kwargs = event
+        try:
 
-                if topic == 'stopServing':
-                    self._debug("marked as stop serving")
-                    return False
+            if topic == 'stopServing':
+                self._debug("marked as stop serving")
+                return False
 
-                # Async mode.
-                if topic in self._reactMap:
-                    self._cache[topic] = self._react(topic, args, kwargs)
-                    return True
+            # Async mode.
+            if topic in self._reactMap:
+                self._cache[topic] = self._react(topic, args, kwargs)
+                return True
 
-                # Sync modes.
-                elif topic.startswith("cached_") or topic.endswith('_sync'):
-                    try:
-                        if topic.startswith("cached_"):
-                            #TODO: warn if arguments.
-                            realTopic = topic[7:]
-                            if realTopic.endswith("_sync"):
-                                realTopic = realTopic[:-5]
-
-                            if realTopic in self._cache:
-                                result = self._cache[realTopic]
-                            else:
-                                raise TopicError("%s: '%s' is called while"
-                                    " no cached value."% (self._name, topic))
+            # Sync and future modes.
+            elif requestId is not None:
+                try:
+                    if topic.startswith("cached_"):
+                        #TODO: warn if arguments.
+                        realTopic = _realTopic(topic[7:])
 
+                        if realTopic in self._cache:
+                            result = self._cache[realTopic]
                         else:
-                            realTopic = topic[:-5] # "_sync"
-
-                            if realTopic in self._reactMap:
-                                result = self._react(realTopic, args, kwargs)
-                            elif realTopic == 'str_help':
-                                result = self._help(realTopic, args, kwargs)
-                            else:
-                                raise TopicError("%s got unkown event '%s'"%
-                                    (self._name, topic))
-
-                        # Send result back to emitter.
-                        if type(result) != tuple:
-                            result = (result,)
-                        self._resultQueue.put(result)
-                        return True
-
-                    except TopicError as e:
-                        runtime.ui.error(str(e))
-                        self._errorQueue.put((AttributeError, str(e)))
-
-                runtime.ui.error("receiver %s unhandled event %s"%
-                    (self._name, event))
-
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                runtime.ui.critical("%s unhandled error occurred while"
-                    " reacting to event %s: %s: %s"%
-                    (self._name, event, e.__class__.__name__, e))
-                runtime.ui.exception(e)
-                if topic.endswith('_sync'):
-                    self._errorQueue.put((e.__class__, str(e)))
-
-        time.sleep(SLEEP) # Don't eat all CPU if caller is looping here.
+                            raise TopicError("%s: '%s' is called while"
+                                " no cached value."% (self._name, topic))
+
+                    else:
+                        realTopic = _realTopic(topic)
+
+                        if realTopic in self._reactMap:
+                            result = self._react(realTopic, args, kwargs)
+                        elif realTopic == 'str_help':
+                            result = self._help(realTopic, args, kwargs)
+                        else:
+                            raise TopicError("%s got unkown event '%s'"%
+                                (self._name, topic))
+
+                    # Send result back to emitter.
+                    self._reply(requestId, False, result)
+                    return True
+
+                except TopicError as e:
+                    runtime.ui.error(str(e))
+                    self._reply(requestId, True, (AttributeError, str(e)))
+
+            runtime.ui.error("receiver %s unhandled event %s"%
+                (self._name, event))
+
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            runtime.ui.critical("%s unhandled error occurred while"
+                " reacting to event %s: %s: %s"%
+                (self._name, event, e.__class__.__name__, e))
+            runtime.ui.exception(e)
+            if requestId is not None:
+                self._reply(requestId, True, (e.__class__, str(e)))
+        return None
+
+    def newEmitter(self) -> 'Emitter':
+        """Return a new emitter to this receiver, with its own reply queue.
+
+        Must be called before the worker of the receiver is started or from
+        this worker: the receiver must know the new reply queue."""
+
+        replyQueue = runtime.concurrency.createQueue()
+        self._replyQueues.append(replyQueue)
+        return Emitter(self._name, self._eventQueue, replyQueue,
+            len(self._replyQueues) - 1)
+
+    def react(self, timeout: float=SLEEP) -> bool:
+        """Process the next event.
+
+        Wait up to timeout seconds for an event. If timeout is None, block until
+        an event is sent. The receiver wakes up as soon as the event is
+        available, including the 'stopServing' event.
+
+        The order of events is the order of the **available** events in the
+        queue. This is relevant only when *sending* events concurrently (from
+        different workers)."""
+
+        event = self._nextEvent(timeout)
+        while event is not None:
+            handled = self._handle(event)
+            if handled is not None:
+                return handled
+            event = self._nextEvent(0) # Continue with next available event.
         return True
 
 
@@ -469,11 +739,10 @@ class SyncEmitter(object):
 
 def newEmitterReceiver(debugName: str) -> (Receiver, Emitter):
     eventQueue = runtime.concurrency.createQueue()
-    resultQueue = runtime.concurrency.createQueue()
-    errorQueue = runtime.concurrency.createQueue()
+    replyQueue = runtime.concurrency.createQueue()
 
-    emitter = Emitter(debugName, eventQueue, resultQueue, errorQueue)
-    receiver = Receiver(debugName, eventQueue, resultQueue, errorQueue)
+    emitter = Emitter(debugName, eventQueue, replyQueue)
+    receiver = Receiver(debugName, eventQueue, replyQueue)
     return receiver, emitter
 
 
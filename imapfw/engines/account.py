@@ -8,7 +8,8 @@ Engines to work with accounts.
 """
 
 from imapfw import runtime
-from imapfw.edmp import Channel
+from imapfw.edmp import Channel, getResults
+from imapfw.state import FolderHistory
 from imapfw.types.folder import Folders
 from imapfw.types.account import loadAccount
 
@@ -18,6 +19,7 @@ from .engine import SyncEngine, EngineInterface
 from imapfw.interface import implements, checkInterfaces
 
 # Annotations.
+from imapfw.annotation import Dict, List, Tuple
 from imapfw.edmp import Emitter
 from imapfw.concurrency import Queue
 from imapfw.types.account import Account
@@ -35,6 +37,44 @@ class SyncAccounts(SyncEngine):
         self.referent = referent
         self.left = left
         self.rght = right
+        self.repositoryNames = None # Of the connected drivers.
+
+    def _getDirtyFolders(self, account: Account, folders: Folders,
+            leftFolders: Folders, rghtFolders: Folders
+            ) -> Tuple[Folders, Dict[str, List]]:
+        """Return the folders which might have changed since the previous sync
+        and their fingerprints on both sides, by folder name.
+
+        A folder is clean if the fingerprints given by both drivers are the
+        same as in the history. The fingerprints are recorded in the history
+        once the folder is synced."""
+
+        statePath = runtime.rascal.getStatePath()
+        if statePath is None:
+            return folders, {}
+
+        # Only the small history is read, not the states of the folders.
+        history = FolderHistory(statePath)
+        history.load()
+
+        accountName = account.getClassName()
+        sides = [{folder.getName(): folder for folder in sideFolders}
+            for sideFolders in [leftFolders, rghtFolders]]
+
+        dirtyFolders = Folders()
+        fingerprints = {} # [left, right] by folder name.
+        for folder in folders:
+            folderFingerprints = []
+            for byName in sides:
+                fingerprint = None
+                if folder.getName() in byName:
+                    fingerprint = byName[folder.getName()].getFingerprint()
+                folderFingerprints.append(fingerprint)
+            if None in folderFingerprints or folderFingerprints != \
+                    history.getFingerprints(accountName, folder):
+                dirtyFolders.append(folder)
+                fingerprints[folder.getName()] = folderFingerprints
+        return dirtyFolders, fingerprints
 
     # Outlined.
     def _syncAccount(self, account: Account):
@@ -43,23 +83,28 @@ class SyncAccounts(SyncEngine):
         accountName = account.getClassName()
         runtime.ui.infoL(3, "merging folders for %s"% accountName)
 
-        # Get the repository instances from the rascal.
-        leftRepository = account.fw_getLeft()
-        rghtRepository = account.fw_getRight()
-
-        self.left.buildDriver(accountName, 'left')
-        self.rght.buildDriver(accountName, 'right')
-
-        # Connect the drivers.
-        self.left.connect()
-        self.rght.connect()
-
-        self.left.getFolders()
-        self.rght.getFolders()
-
-        # Get the folders from both sides so we can feed the folder tasks.
-        leftFolders = self.left.getFolders_sync()
-        rghtFolders = self.rght.getFolders_sync()
+        # Keep the drivers of the previous account if they are for the same
+        # repositories.
+        self.repositoryNames = None # Until connected.
+        leftBuilt, rghtBuilt = getResults(
+            self.left.buildDriver_future(accountName, 'left', reuse=True),
+            self.rght.buildDriver_future(accountName, 'right', reuse=True),
+            )
+
+        # Connect the new drivers and get the folders from both sides so we
+        # can feed the folder tasks, in one envelope per driver.
+        with self.left.batch(), self.rght.batch():
+            if leftBuilt is True:
+                self.left.connect()
+            if rghtBuilt is True:
+                self.rght.connect()
+            futures = (
+                self.left.getFolders_future(),
+                self.rght.getFolders_future(),
+                )
+        leftFolders, rghtFolders = getResults(*futures)
+        self.repositoryNames = (account.fw_getLeft().getClassName(),
+            account.fw_getRight().getClassName())
 
         # Merge the folder lists.
         mergedFolders = Folders()
@@ -87,41 +132,38 @@ class SyncAccounts(SyncEngine):
             runtime.ui.warn("rascal, you asked to sync non-existing folders"
                 " for '%s': %s", accountName, ignoredFolders)
 
+        # Don't bother the folder workers with the unchanged folders.
+        syncFolders, fingerprints = self._getDirtyFolders(account,
+            syncFolders, leftFolders, rghtFolders)
+
         if len(syncFolders) < 1:
             runtime.ui.infoL(3, "%s: no folder to sync"% accountName)
             return # Nothing more to do.
 
-        #TODO: make max_connections mandatory in rascal.
-        maxFolderWorkers = min(
-            len(syncFolders),
-            rghtRepository.conf.get('max_connections'),
-            leftRepository.conf.get('max_connections'))
-
         runtime.ui.infoL(3, "%s syncing folders %s"% (accountName, syncFolders))
 
-        # Syncing folders is not the job of this engine. Use sync mode to ensure
-        # the referent starts syncing of folders before this engine stops.
-        self.referent.syncFolders_sync(
-            accountName, maxFolderWorkers, syncFolders)
-
-        # Wait for all the folders to be synced before processing the next
-        # account.
-        while self.referent.areSyncFoldersDone_sync() is not True:
-            pass
+        # Syncing folders is not the job of this engine: the folders are sent
+        # to the folder workers shared by all the accounts, up to the
+        # max_connections of the repositories. Use sync mode to ensure the
+        # referent starts syncing of folders before this engine stops. Don't
+        # wait for the folders: the scheduler gets the folders of the next
+        # account right away.
+        self.referent.syncFolders_sync(self.workerName, accountName,
+            syncFolders, fingerprints)
 
     def run(self, taskQueue: Queue) -> None:
-        """Sequentially process the accounts."""
+        """Sequentially process the accounts until None is received."""
 
         #
         # Loop over the available account names.
         #
-        for accountName in Channel(taskQueue):
+        for accountName in Channel(taskQueue, None):
             # The syncer let explode errors it can't recover from.
             try:
                 self.processing(accountName)
                 # Get the account instance from the rascal.
                 account = loadAccount(accountName)
-                self._syncAccount(account) # Wait until folders are done.
+                self._syncAccount(account)
                 self.setExitCode(0)
                 #TODO: Here, we only keep max exit code. Would worth using the
                 # rascal at the end of the process for each account.
@@ -133,4 +175,7 @@ class SyncAccounts(SyncEngine):
                 self.setExitCode(10) # See manual.
 
         self.checkExitCode() # Sanity check.
-        self.referent.accountEngineDone(self.getExitCode())
+        # The drivers are leased: tell for which repositories they are
+        # connected, if any.
+        self.referent.accountEngineDone(self.workerName, self.getExitCode(),
+            self.repositoryNames)
@@ -7,9 +7,14 @@ Engines to work with folders/maiboxes.
 
 """
 
+import hashlib
+
 from imapfw import runtime
-from imapfw.edmp import Channel
+from imapfw.edmp import Channel, getResults
+from imapfw.imap import SearchConditions, FetchAttributes
+from imapfw.state import FolderState
 from imapfw.types.account import loadAccount
+from imapfw.types.message import Messages, Message, SYSTEM_FLAGS
 
 from .engine import SyncEngine, EngineInterface, SyncEngineInterface
 
@@ -17,71 +22,368 @@ from .engine import SyncEngine, EngineInterface, SyncEngineInterface
 from imapfw.interface import implements, adapts, checkInterfaces
 
 # Annotations.
+from imapfw.annotation import Dict, List, Tuple
 from imapfw.edmp import Emitter
 from imapfw.concurrency import Queue
 from imapfw.types.folder import Folder
 
 
+COPY_BATCH = 100 # Messages copied per round trip.
+
+
+def getSyncFlags(flags: List[str]) -> List[str]:
+    """Return the flags synced between both sides, sorted.
+
+    Only the system flags are synced: the keywords can't be stored by all the
+    drivers."""
+
+    return sorted(flag for flag in flags if flag in SYSTEM_FLAGS)
+
+
 @checkInterfaces()
 @adapts(SyncEngine)
 @implements(EngineInterface)
 class SyncFolders(SyncEngine):
-    """The engine to sync a folder in a worker."""
+    """The engine to sync folders of any account in a worker."""
 
     def __init__(self, workerName: str, referent: Emitter,
-            left: Emitter, right: Emitter, accountName: str):
+            left: Emitter, right: Emitter):
 
         super(SyncFolders, self).__init__(workerName)
         self.referent = referent
         self.left = left
         self.rght = right
-        self.accountName = accountName
+        self.accountName = None # Account of the current folder.
 
     def _infoL(self, level, msg):
         runtime.ui.infoL(level, "%s %s"% (self.workerName, msg))
 
-    # Outlined.
-    def _syncFolder(self, folder: Folder) -> int:
-        """Sync one folder."""
+    def _applyChanges(self, states: List[FolderState],
+            changes: List[Tuple[Messages, Messages, List[int], Tuple]]
+            ) -> None:
+        """Apply the changes of each side to the other side and record them in
+        the states once applied.
+
+        The flags of the changed messages are set on the other side; if both
+        sides changed the same message, the left side wins. The expunged
+        messages are flagged \\Deleted on the other side, not expunged, and
+        forgotten. The new messages are copied."""
+
+        emitters = (self.left, self.rght)
+        updates = (Messages(), Messages()) # Flags to set, by side.
+        forgotten = ([], []) # UIDs to forget once flagged, by side.
+        for source in (0, 1):
+            destination = 1 - source
+            sourceState, destinationState = states[source], states[destination]
+            newMessages, changedMessages, vanished, _ = changes[source]
+
+            for uid, message in changedMessages.items():
+                if uid in updates[source]:
+                    continue # Changed on both sides.
+                flags = getSyncFlags(message.getAttributes().getFlags())
+                sourceState.setFlags(uid, flags)
+                otherUID = sourceState.getLink(uid)
+                if otherUID is None or \
+                        destinationState.getFlags(otherUID) in (None, flags):
+                    continue
+                update = Message(otherUID)
+                update.getAttributes().setFlags(flags)
+                updates[destination].add(update)
+
+            for uid in vanished:
+                otherUID = sourceState.getLink(uid)
+                sourceState.removeUIDs([uid])
+                if otherUID is None or \
+                        destinationState.getFlags(otherUID) is None:
+                    continue
+                flags = destinationState.getFlags(otherUID)
+                if otherUID in updates[destination]:
+                    flags = updates[destination].getAttributes(otherUID
+                        ).getFlags()
+                update = Message(otherUID)
+                update.getAttributes().setFlags(
+                    getSyncFlags(flags + ['\\Deleted']))
+                updates[destination].add(update)
+                forgotten[destination].append(otherUID)
+
+        # One envelope per driver. Both are sent before waiting.
+        with self.left.batch(), self.rght.batch():
+            futures = [emitter.setFlags_future(update)
+                for emitter, update in zip(emitters, updates)
+                if len(update) > 0]
+        getResults(*futures)
+        for state, update, uids in zip(states, updates, forgotten):
+            for uid, message in update.items():
+                state.setFlags(uid, message.getAttributes().getFlags())
+            state.removeUIDs(uids)
+            state.save()
+
+        for source in (0, 1):
+            destination = 1 - source
+            self._copyMessages(emitters[source], states[source],
+                emitters[destination], states[destination],
+                changes[source][0])
+
+        for state, (_, _, _, (uidnext, modSeq, highestUID)) in zip(states,
+                changes):
+            state.setUIDNext(uidnext)
+            state.setHighestModSeq(modSeq)
+            if highestUID is not None:
+                state.setHighestUID(highestUID)
+            state.save()
+
+    def _copyMessages(self, source: Emitter, sourceState: FolderState,
+            destination: Emitter, destinationState: FolderState,
+            messages: Messages) -> None:
+        """Copy the new messages of the source to the destination, by batches
+        of COPY_BATCH messages.
+
+        The states are saved after each batch so that the messages are not
+        copied again if a later batch fails."""
+
+        uids = sorted(messages.keys())
+        for start in range(0, len(uids), COPY_BATCH):
+            batch = uids[start:start + COPY_BATCH]
+            found, payloads = source.getBodies_sync(
+                Messages(*[messages[uid] for uid in batch]))
+            destinationUIDs = destination.appendMessages_sync(found, payloads)
+
+            for message, destinationUID in zip(found.values(),
+                    destinationUIDs):
+                flags = getSyncFlags(message.getAttributes().getFlags())
+                sourceState.link(message.getUID(), flags, destinationUID)
+                destinationState.link(destinationUID, flags, message.getUID())
+            # The messages not found were expunged meanwhile.
+            sourceState.setHighestUID(batch[-1])
+            sourceState.save()
+            destinationState.save()
+
+    def _getDigests(self, emitter: Emitter, messages: Messages
+            ) -> Dict[str, List[Message]]:
+        """Return the messages found by digest of their bodies, in UID order.
+
+        The bodies are fetched by batches of COPY_BATCH messages. The line
+        endings are normalized: a Maildir might store LF where the IMAP server
+        sends CRLF."""
 
-        # account = loadAccount(self.accountName)
-        # leftRepository = account.fw_getLeft()
-        # rightRepository = account.fw_getRight()
+        digests = {}
+        uids = sorted(messages.keys())
+        for start in range(0, len(uids), COPY_BATCH):
+            found, payloads = emitter.getBodies_sync(
+                Messages(*[messages[uid] for uid in uids[start:start +
+                    COPY_BATCH]]))
+            for message, payload in zip(found.values(), payloads):
+                body = bytes(payload.getView()).replace(b'\r\n', b'\n')
+                payload.release()
+                digest = hashlib.sha1(body).hexdigest()
+                digests.setdefault(digest, []).append(message)
+        return digests
 
-        if self.left.isDriverBuilt_sync() is False:
-            self.left.buildDriver(self.accountName, 'left')
-        if self.rght.isDriverBuilt_sync() is False:
-            self.rght.buildDriver(self.accountName, 'right')
+    def _getChanges(self, leftState: FolderState, rghtState: FolderState
+            ) -> List[Tuple[Messages, Messages, List[int], Tuple]]:
+        """Return the changes of the selected folder since the states, for
+        both sides: (new messages, messages with changed flags, expunged UIDs,
+        (UIDNEXT, HIGHESTMODSEQ, highest UID) to record once the changes are
+        applied).
 
-        self.left.connect()
-        self.rght.connect()
+        With CONDSTORE, only the UIDs above the highest known UID are searched
+        and nothing is searched if UIDNEXT did not change since the previous
+        sync; the flags are only asked for the messages changed since the
+        known HIGHESTMODSEQ. Otherwise, all the messages are listed and the
+        flags of the known ones are compared with the state."""
 
-        self.left.select_sync(folder)
-        self.rght.select_sync(folder)
+        # One envelope per driver. Both are sent before waiting.
+        with self.left.batch(), self.rght.batch():
+            futures = (
+                self.left.getUIDValidity_future(),
+                self.rght.getUIDValidity_future(),
+                self.left.getUIDNext_future(),
+                self.rght.getUIDNext_future(),
+                self.left.getHighestModSeq_future(),
+                self.rght.getHighestModSeq_future(),
+                )
+        (leftUIDValidity, rghtUIDValidity, leftUIDNext, rghtUIDNext,
+                leftModSeq, rghtModSeq) = getResults(*futures)
 
+        sides = (
+            (leftState, self.left, leftUIDValidity, leftUIDNext, leftModSeq),
+            (rghtState, self.rght, rghtUIDValidity, rghtUIDNext, rghtModSeq),
+            )
+        searches, deltas = [], []
+        with self.left.batch(), self.rght.batch():
+            for state, emitter, uidvalidity, uidnext, modSeq in sides:
+                state.checkUIDValidity(uidvalidity)
+                highestUID = state.getHighestUID()
+                knownModSeq = state.getHighestModSeq()
+
+                search = None # Unchanged.
+                delta = None # Unchanged or all the messages listed.
+                conditions = SearchConditions()
+                if highestUID is None or modSeq is None or knownModSeq is None:
+                    search = emitter.searchUID_future(conditions)
+                else:
+                    if uidnext is None or uidnext != state.uidnext:
+                        conditions.setMinUID(highestUID + 1)
+                        search = emitter.searchUID_future(conditions)
+                    if knownModSeq != modSeq:
+                        delta = emitter.getChangedMessages_future(knownModSeq)
+                # Without a minimum UID, all the messages are listed.
+                listed = search is not None and conditions.getMinUID() is None
+                searches.append((search, listed))
+                deltas.append(delta)
+
+        founds = [Messages() if search is None else search.getResult()
+            for search, _ in searches]
+
+        # The flags of the listed messages are compared with the state.
+        flags = []
+        with self.left.batch(), self.rght.batch():
+            for (state, emitter, *_), (_, listed), found in zip(sides,
+                    searches, founds):
+                known = Messages(*[Message(uid) for uid in found.keys()
+                    if state.getFlags(uid) is not None])
+                if listed and len(known) > 0:
+                    attributes = FetchAttributes()
+                    attributes.enableUID()
+                    attributes.enableFLAGS()
+                    flags.append(emitter.getMessages_future(known, attributes))
+                else:
+                    flags.append(None)
+
+        changes = []
+        for side, (_, listed), found, delta, known in zip(sides, searches,
+                founds, deltas, flags):
+            state, _, _, uidnext, modSeq = side
+            newMessages = state.getNewMessages(found)
+            candidates, vanished = Messages(), []
+            if delta is not None:
+                candidates, vanished = delta.getResult()
+            elif known is not None:
+                candidates = known.getResult()
+            if listed:
+                vanished = [uid for uid in state.getUIDs() if uid not in found]
+
+            changedMessages = Messages(*[message
+                for uid, message in candidates.items()
+                if state.getFlags(uid) not in (None,
+                    getSyncFlags(message.getAttributes().getFlags()))])
+
+            highestUID = max(found.keys(), default=None)
+            changes.append((newMessages, changedMessages, vanished,
+                (uidnext, modSeq, highestUID)))
+        return changes
+
+    def _matchMessages(self, states: List[FolderState],
+            changes: List[Tuple[Messages, Messages, List[int], Tuple]]
+            ) -> None:
+        """On the first sync of a folder with messages on both sides, link the
+        messages with the same content instead of copying them.
+
+        The links are recorded in the states and the linked messages are
+        removed from the new messages. If the flags differ, the message is
+        recorded as changed on the left side, so the left side wins."""
+
+        if any(len(state.getUIDs()) > 0 for state in states) or \
+                any(len(newMessages) < 1 for newMessages, *_ in changes):
+            return
+
+        leftDigests = self._getDigests(self.left, changes[0][0])
+        rghtDigests = self._getDigests(self.rght, changes[1][0])
+        leftState, rghtState = states
+        matched = 0
+        for digest, leftMessages in leftDigests.items():
+            # Duplicates on a side are matched in UID order.
+            for leftMessage, rghtMessage in zip(leftMessages,
+                    rghtDigests.get(digest, [])):
+                leftUID, rghtUID = leftMessage.getUID(), rghtMessage.getUID()
+                leftFlags = getSyncFlags(
+                    leftMessage.getAttributes().getFlags())
+                rghtFlags = getSyncFlags(
+                    rghtMessage.getAttributes().getFlags())
+                leftState.link(leftUID, rghtFlags, rghtUID)
+                rghtState.link(rghtUID, rghtFlags, leftUID)
+                if leftFlags != rghtFlags:
+                    changes[0][1].add(leftMessage)
+                changes[0][0].remove(leftMessage)
+                changes[1][0].remove(rghtMessage)
+                matched += 1
+        if matched > 0:
+            self._infoL(2, "%i message(s) already on both sides"% matched)
+
+    def _syncMessages(self, folder: Folder) -> List[FolderState]:
+        """Sync the messages of the selected folder. Return the states of both
+        sides, None if not synced.
+
+        The messages are only synced with a state_path: without a state, all
+        the messages would be copied again at each run."""
+
+        statePath = runtime.rascal.getStatePath()
+        if statePath is None:
+            runtime.ui.warn("%s: no state_path in the rascal, messages of %s"
+                " not synced"% (self.workerName, folder))
+            return None
+
+        account = loadAccount(self.accountName)
+        states = []
+        for repository in (account.fw_getLeft(), account.fw_getRight()):
+            state = FolderState(statePath, self.accountName,
+                repository.getClassName(), folder)
+            state.load()
+            states.append(state)
+
+        changes = self._getChanges(*states)
+        self._matchMessages(states, changes)
+        self._applyChanges(states, changes)
+        return states
+
+    # Outlined.
+    def _syncFolder(self, folder: Folder) -> int:
+        """Sync one folder."""
+
+        # Both drivers work at the same time: requests are sent to both sides
+        # before waiting for the results. The drivers might already be built
+        # and connected for these repositories by a previous task.
+        leftBuilt, rghtBuilt = getResults(
+            self.left.buildDriver_future(self.accountName, 'left', reuse=True),
+            self.rght.buildDriver_future(self.accountName, 'right', reuse=True),
+            )
+        with self.left.batch(), self.rght.batch():
+            if leftBuilt is True:
+                self.left.connect()
+            if rghtBuilt is True:
+                self.rght.connect()
+            futures = (
+                self.left.select_future(folder),
+                self.rght.select_future(folder),
+                )
+        getResults(*futures)
+
+        self._syncMessages(folder)
         return 0
 
     def run(self, taskQueue: Queue) -> None:
         """Runner for the sync folder engine.
 
-        Sequentially process the folders."""
+        Sequentially process the (account name, folder) tasks until None is
+        received. The referent is told when each folder is done."""
 
         #
-        # Loop over the available folder names.
+        # Loop over the available folders.
         #
-        for folder in Channel(taskQueue):
-            self.processing(folder)
+        for self.accountName, folder in Channel(taskQueue, None):
+            self.processing("%s %s"% (self.accountName, folder))
 
             # The engine will let explode errors it can't recover from.
             try:
                 exitCode = self._syncFolder(folder)
-                self.setExitCode(exitCode)
 
             except Exception as e:
                 runtime.ui.error("could not sync folder %s"% folder)
                 runtime.ui.exception(e)
                 #TODO: honor hook!
-                self.setExitCode(10) # See manual.
+                exitCode = 10 # See manual.
+
+            self.setExitCode(exitCode)
+            self.referent.folderDone(self.workerName, exitCode)
 
         self.checkExitCode()
-        self.referent.stop(self.getExitCode())
@@ -0,0 +1,219 @@
+# The MIT License (MIT).
+# Copyright (c) 2016, Nicolas Sebrecht & contributors.
+
+"""
+
+Parser of the FETCH responses.
+
+The items of the FETCH data returned by imaplib2 are parsed one by one into
+MessageAttributes. An item is either bytes or a (bytes, literal) tuple when the
+line ends with a literal; the response of one message might be split across
+more than one item.
+
+The parser doesn't read the socket: imaplib2 buffers the whole response of a
+command before returning it. The memory used is bounded by the size of the
+FETCH batches, not by the parser.
+
+Large sets of messages are fetched by batches of UIDs. The FetchBatchSizer
+adapts the number of UIDs of the next batch to the time and the bytes the
+previous batches took.
+
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+
+from imapfw.types.message import MessageAttributes
+
+# Annotations.
+from imapfw.annotation import Iterable, List, Tuple, Union
+
+
+TOKEN_cre = re.compile(br'\s*(?:'
+    br'(?P<open>\()|'
+    br'(?P<close>\))|'
+    br'"(?P<quoted>(?:[^"\\]|\\.)*)"|'
+    br'\{(?P<literal>\d+)\}|'
+    br'(?P<atom>[^\s()"\[{]+(?:\[[^\]]*\])?(?:<[^>]*>)?)'
+    br')')
+
+INTERNALDATE_cre = re.compile(r'\s*(?P<day>\d{1,2})-(?P<month>[A-Za-z]{3})-'
+    r'(?P<year>\d{4}) (?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2}) '
+    r'(?P<zonen>[-+])(?P<zoneh>\d{2})(?P<zonem>\d{2})')
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+    'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+class FetchParseError(Exception):
+    """Error raised when a FETCH response can't be parsed."""
+
+
+def parseInternaldate(internaldate: str) -> datetime:
+    """Return the timezone aware datetime of an INTERNALDATE.
+
+    E.g.: '15-Nov-2015 00:00:46 +0100'
+    """
+
+    match = INTERNALDATE_cre.match(internaldate)
+    if match is None:
+        raise FetchParseError("invalid INTERNALDATE: %s"% internaldate)
+
+    offset = timedelta(hours=int(match.group('zoneh')),
+        minutes=int(match.group('zonem')))
+    if match.group('zonen') == '-':
+        offset = -offset
+
+    return datetime(
+        int(match.group('year')),
+        MONTHS.index(match.group('month').upper()) + 1,
+        int(match.group('day')),
+        int(match.group('hour')),
+        int(match.group('min')),
+        int(match.group('sec')),
+        tzinfo=timezone(offset),
+        )
+
+
+class FetchBatchSizer(object):
+    """Adapt the number of UIDs per FETCH to the measured responses.
+
+    The size is doubled while the batches are fast and small and halved when
+    a batch is over the targets."""
+
+    def __init__(self, size: int=100, minSize: int=10, maxSize: int=10000,
+            targetSeconds: float=1.0, targetBytes: int=4 * 1024 * 1024):
+        self.size = size
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.targetSeconds = targetSeconds
+        self.targetBytes = targetBytes
+
+    def getSize(self) -> int:
+        return self.size
+
+    def record(self, count: int, seconds: float, nbytes: int) -> None:
+        """Record the time and the bytes of the response of a batch of count
+        UIDs."""
+
+        if seconds > self.targetSeconds or nbytes > self.targetBytes:
+            self.size = max(self.minSize, self.size // 2)
+        elif (count >= self.size and seconds < self.targetSeconds / 2 and
+                nbytes < self.targetBytes / 2):
+            self.size = min(self.maxSize, self.size * 2)
+
+
+def getSize(data: list) -> int:
+    """Return the number of bytes of the FETCH data."""
+
+    size = 0
+    for item in data:
+        if isinstance(item, tuple):
+            size += sum(len(part) for part in item)
+        elif item is not None:
+            size += len(item)
+    return size
+
+
+class FetchParser(object):
+    """Parser of the FETCH data, one item at a time.
+
+    The items come from the data list already buffered by imaplib2. Feed them
+    in order; the messages are returned as soon as their response is
+    complete. A response might continue in the data of the next batch."""
+
+    def __init__(self):
+        self._stack = [] # Lists being parsed, the outermost first.
+
+    def _append(self, value: Union[str, bytes]) -> None:
+        if len(self._stack) > 0:
+            self._stack[-1].append(value)
+
+    def _build(self, items: list) -> Tuple[int, MessageAttributes]:
+        uid = None
+        attributes = MessageAttributes()
+        for key, value in zip(items[0::2], items[1::2]):
+            key = key.upper()
+            if key == 'UID':
+                uid = int(value)
+            elif key == 'FLAGS':
+                attributes.setFlags(value)
+            elif key == 'INTERNALDATE':
+                attributes.setInternaldate(parseInternaldate(value))
+            elif key == 'RFC822.SIZE':
+                attributes.setSize(int(value))
+            elif key == 'MODSEQ':
+                attributes.setModSeq(int(value[0]))
+            elif isinstance(value, bytes) or value is None:
+                # BODY[...], RFC822.HEADER, etc.
+                attributes.setLiteral(key, value)
+        return uid, attributes
+
+    def _parseSegment(self, segment: bytes) -> List[Tuple[int,
+            MessageAttributes]]:
+        done = []
+        pos = 0
+        while pos < len(segment):
+            match = TOKEN_cre.match(segment, pos)
+            if match is None:
+                if segment[pos:].strip() == b'':
+                    break
+                raise FetchParseError("unexpected data: %r"% segment[pos:])
+            pos = match.end()
+
+            if match.group('open') is not None:
+                self._stack.append([])
+
+            elif match.group('close') is not None:
+                if len(self._stack) < 1:
+                    raise FetchParseError("unbalanced parenthesis: %r"%
+                        segment)
+                items = self._stack.pop()
+                if len(self._stack) > 0:
+                    self._stack[-1].append(items)
+                else:
+                    done.append(self._build(items))
+
+            elif match.group('quoted') is not None:
+                value = match.group('quoted')
+                value = value.replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+                self._append(value.decode('UTF-8', 'replace'))
+
+            elif match.group('atom') is not None:
+                # The sequence number before the list is dropped.
+                value = match.group('atom').decode('ASCII', 'replace')
+                if value.upper() == 'NIL':
+                    value = None
+                self._append(value)
+
+            # The literal itself is the second member of the tuple.
+        return done
+
+    def feed(self, item: Union[bytes, tuple]) -> List[Tuple[int,
+            MessageAttributes]]:
+        """Parse one item. Return the (UID, MessageAttributes) of the
+        messages completed by this item."""
+
+        if item is None: # Nothing matched.
+            return []
+        if isinstance(item, tuple):
+            segment, literal = item
+            done = self._parseSegment(segment)
+            self._append(literal)
+            return done
+        return self._parseSegment(item)
+
+    def parse(self, data: list, final: bool=True
+            ) -> Iterable[Tuple[int, MessageAttributes]]:
+        """Yield the (UID, MessageAttributes) of the messages.
+
+        The items are removed from data while parsed so that the parsed items
+        can be freed before the end of the list. If not final, more data is
+        expected and the last response might be incomplete."""
+
+        data.reverse()
+        while len(data) > 0:
+            for uid, attributes in self.feed(data.pop()):
+                yield uid, attributes
+        if final and len(self._stack) > 0:
+            raise FetchParseError("incomplete FETCH response")
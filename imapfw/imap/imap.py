@@ -10,15 +10,22 @@ doesn't care at all.
 
 """
 
+import re
+import time
+from collections import deque
 from importlib import import_module
+from queue import Queue
 
 from imapfw import runtime
 from imapfw.constants import IMAP
 from imapfw.types.folder import Folders, Folder
-from imapfw.types.message import Messages, Message
+from imapfw.types.message import Messages, Message, coalesceUIDs
+from imapfw.types.message import SYSTEM_FLAGS
+
+from .fetch import FetchBatchSizer, FetchParser, getSize
 
 # Annotations.
-from imapfw.annotation import List, Dict, Union
+from imapfw.annotation import Any, Iterable, List, Dict, Tuple, Union
 
 #from .imapc.interface import IMAPcInterface
 
@@ -26,6 +33,17 @@ from imapfw.annotation import List, Dict, Union
 #TODO: use UTF-7.
 ENCODING = 'UTF-8'
 
+FETCH_PIPELINE = 2 # Number of FETCH batches sent ahead.
+STATUS_PIPELINE = 100 # Number of STATUS commands in flight.
+
+STATUS_ITEMS = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+
+LIST_cre = re.compile(r'\((?P<flags>[^)]*)\) (?P<delimiter>"[^"]*"|NIL) '
+    r'(?P<name>.*)')
+STATUS_cre = re.compile(r'(?P<name>"(?:[^"\\]|\\.)*"|\S+) '
+    r'\((?P<items>[^)]*)\)')
+
+
 
 # Exceptions.
 class ImapInternalError(Exception):
@@ -41,6 +59,108 @@ class ImapAbortError(ImapInternalError):
     """Error raised when connexion is unexpectly closed."""
 
 
+def quote(name: str) -> str:
+    return '"%s"'% name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def unquote(name: str) -> str:
+    if len(name) > 1 and name[0] == '"' and name[-1] == '"':
+        return name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return name
+
+
+def parseStatus(data: list) -> Dict[str, Dict[str, int]]:
+    """Return the STATUS items by mailbox name.
+
+    E.g.: [b'"INBOX" (MESSAGES 2 UIDNEXT 3)'] ->
+        {'INBOX': {'MESSAGES': 2, 'UIDNEXT': 3}}
+    """
+
+    statuses = {}
+    literalName = None
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple): # The name is a literal.
+            literalName = item[1].decode(ENCODING)
+            continue
+
+        item = item.decode(ENCODING)
+        if literalName is not None:
+            item = "%s%s"% (quote(literalName), item)
+            literalName = None
+
+        match = STATUS_cre.match(item.strip())
+        if match is None:
+            continue
+        tokens = match.group('items').split()
+        statuses[unquote(match.group('name'))] = {name.upper(): int(value)
+            for name, value in zip(tokens[0::2], tokens[1::2])}
+    return statuses
+
+
+def expandUIDs(uids: str) -> List[int]:
+    """Return the UIDs of a sequence set.
+
+    E.g.: '1,3:5' -> [1, 3, 4, 5]
+    """
+
+    expanded = []
+    for item in uids.split(','):
+        if ':' in item:
+            start, end = sorted(int(uid) for uid in item.split(':'))
+            expanded.extend(range(start, end + 1))
+        else:
+            expanded.append(int(item))
+    return expanded
+
+
+class CountingCompressor(object):
+    """Wrap a zlib compressor to count the bytes before and after."""
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.rawBytes = 0
+        self.compressedBytes = 0
+
+    def compress(self, data: bytes) -> bytes:
+        self.rawBytes += len(data)
+        compressed = self.compressor.compress(data)
+        self.compressedBytes += len(compressed)
+        return compressed
+
+    def flush(self, *args) -> bytes:
+        compressed = self.compressor.flush(*args)
+        self.compressedBytes += len(compressed)
+        return compressed
+
+
+class CountingDecompressor(object):
+    """Wrap a zlib decompressor to count the bytes before and after."""
+
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+        self.rawBytes = 0
+        self.compressedBytes = 0
+
+    @property
+    def unconsumed_tail(self) -> bytes:
+        return self.decompressor.unconsumed_tail
+
+    def decompress(self, data: bytes, *args) -> bytes:
+        raw = self.decompressor.decompress(data, *args)
+        # The unconsumed tail is given again on next call.
+        self.compressedBytes += len(data) - len(self.unconsumed_tail)
+        self.rawBytes += len(raw)
+        return raw
+
+
+def getRatio(counter) -> float:
+    if counter.compressedBytes < 1:
+        return None
+    return counter.rawBytes / counter.compressedBytes
+
+
 class FetchAttributes(object):
     def __init__(self):
         self.attributes = []
@@ -49,6 +169,9 @@ class FetchAttributes(object):
         if not name in self.attributes:
             self.attributes.append(name)
 
+    def enableBODY(self):
+        self._enable('BODY.PEEK[]') # Don't set \Seen.
+
     def enableFLAGS(self):
         self._enable('FLAGS')
 
@@ -58,6 +181,9 @@ class FetchAttributes(object):
     def enableINTERNALDATE(self):
         self._enable('INTERNALDATE')
 
+    def enableRFC822SIZE(self):
+        self._enable('RFC822.SIZE')
+
     def setDefaults(self):
         self.enableUID()
         self.enableFLAGS()
@@ -76,6 +202,12 @@ class SearchConditions(object):
         self.minDate = None # time_struct
         self.minUID = None
 
+    def getMaxSize(self) -> int:
+        return self.maxSize
+
+    def getMinUID(self) -> int:
+        return self.minUID
+
     def setMaxSize(self, maxSize: int) -> None:
         self.maxSize = maxSize
 
@@ -100,6 +232,75 @@ class SearchConditions(object):
         return 'UID 1:*'
 
 
+class Pipeline(object):
+    """Send independent commands without waiting for the previous responses.
+
+    The commands are tagged by imaplib2 and the responses are collected as
+    they complete, in any order. Up to depth commands are in flight; the
+    others wait to be sent.
+
+    The untagged responses of the same kind (e.g. FETCH, STATUS) might be
+    delivered with another command of the pipeline: they must be identified
+    from their content (UID, mailbox name), not from the command."""
+
+    def __init__(self, imap, depth: int=None):
+        self._imap = imap
+        self._depth = depth # None for no limit.
+
+        self._waiting = deque() # (key, method name, args) to send.
+        self._completed = Queue()
+        self._running = 0
+        self._lastDone = time.monotonic()
+
+    def __len__(self):
+        return self._running + len(self._waiting)
+
+    def _sendWaiting(self) -> None:
+        while len(self._waiting) > 0 and (self._depth is None or
+                self._running < self._depth):
+            key, name, args = self._waiting.popleft()
+            self._running += 1
+            getattr(self._imap, name)(*args, callback=self._completed.put,
+                cb_arg=(key, time.monotonic()))
+
+    def getResponse(self) -> Tuple[Any, list, float]:
+        """Wait for the next completed command.
+
+        Return the key of the command, the data and the seconds it took. The
+        time is counted from the end of the previous command since the server
+        handles them one after the other."""
+
+        # (response, cb_arg, error)
+        # e.g. (('OK', [b'"INBOX" (MESSAGES 2)']), ('INBOX', 3.2), None)
+        response, (key, startTime), error = self._completed.get()
+        self._running -= 1
+        now = time.monotonic()
+        seconds = now - max(startTime, self._lastDone)
+        self._lastDone = now
+        self._sendWaiting()
+
+        if error is not None:
+            raise ImapCommandError(str(error[1]))
+        status, data = response
+        if status != 'OK':
+            raise ImapCommandError(str(data))
+        return key, data, seconds
+
+    def getResponses(self) -> Iterable[Tuple[Any, list, float]]:
+        """Yield the responses until no command is left."""
+
+        while len(self) > 0:
+            yield self.getResponse()
+
+    def send(self, key: Any, name: str, *args) -> None:
+        """Send the command of the imaplib2 method name with args.
+
+        The key is returned with the response."""
+
+        self._waiting.append((key, name, args))
+        self._sendWaiting()
+
+
 #TODO: move to imapc/interface.py
 class IMAPcInterface(object):
     pass #TODO
@@ -110,6 +311,13 @@ class IMAPlib2_skater(object):
 
     def __init__(self):
         self.imap = None
+        self.capability = None
+        self.enabled = set() # Extensions enabled with ENABLE.
+        self.fetchBatchSizer = FetchBatchSizer()
+        self.folderName = None # Of the selected folder.
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestModSeq = None
 
     def _debug(self, command: str, msg: str) -> None:
         runtime.ui.debugC(IMAP, "[%s] %s"%
@@ -119,11 +327,112 @@ class IMAPlib2_skater(object):
         runtime.ui.debugC(IMAP, "[%s] response: %s"%
             (command, response))
 
+    def _getSelectResponse(self, code: str) -> int:
+        # (typ, [data])
+        # e.g. ('OK', [b'1448060620'])
+        status, data = self.imap.response(code)
+        self._debugResponse(code, data)
+        if data[0] is None:
+            return None
+        return int(data[-1])
+
+    def _getStatuses(self, folders: Folders,
+            statusItems: str) -> Dict[str, Dict[str, int]]:
+        """Pipeline the STATUS commands of the folders."""
+
+        pipeline = self.pipeline(STATUS_PIPELINE)
+        for folder in folders:
+            pipeline.send(folder.getName(), 'status',
+                quote(folder.getName()).encode(ENCODING), statusItems)
+
+        statuses = {}
+        while len(pipeline) > 0:
+            try:
+                # e.g. [b'"INBOX" (MESSAGES 2 UIDNEXT 3 UIDVALIDITY 1)']
+                name, data, seconds = pipeline.getResponse()
+            except ImapCommandError as e:
+                self._debug("getFolders", "STATUS failed: %s"% e)
+                continue
+            # The responses of other folders might come with this one.
+            statuses.update(parseStatus(data))
+        return statuses
+
+    def appendMessages(self, messages: Messages,
+            bodies: List[bytes]) -> List[int]:
+        """Append the messages to the selected folder, in order. Return their
+        new UIDs.
+
+        Requires UIDPLUS (RFC 4315) to know the UIDs: nothing is appended
+        otherwise."""
+
+        if self.capability is None:
+            self.getCapability()
+        if 'UIDPLUS' not in self.capability:
+            raise ImapCommandError("can't append to %s: UIDPLUS is not"
+                " supported"% self.folderName)
+
+        uids = []
+        for message, body in zip(messages.values(), bodies):
+            attributes = message.getAttributes()
+            flags = ' '.join(flag for flag in attributes.getFlags()
+                if flag != '\\Recent')
+            # (typ, [data])
+            # e.g. ('OK', [b'[APPENDUID 38505 3955] APPEND completed'])
+            response = self.imap.append(self.folderName, flags,
+                attributes.getInternaldate(), body)
+            self._debugResponse("appendMessages", response)
+
+            status, data = response
+            if status != 'OK':
+                raise ImapCommandError(str(data))
+
+            # e.g. ('APPENDUID', [b'38505 3955'])
+            status, data = self.imap.response('APPENDUID')
+            if data[-1] is None:
+                raise ImapCommandError("no APPENDUID for the message %i"%
+                    message.getUID())
+            uids.append(int(data[-1].decode(ENCODING).split(' ')[-1]))
+        return uids
+
     def connect(self, host: str, port: str) -> None:
         from .imaplib3 import imaplib2
 
         self.imap = imaplib2.IMAP4(host, port, debug=3, timeout=2)
 
+    def enable(self, extensions: List[str]) -> List[str]:
+        """Enable the extensions (RFC 5161). Return the enabled ones."""
+
+        self._debug("enable", extensions)
+        # (typ, [data])
+        # e.g. ('OK', [b'Enabled'])
+        response = self.imap.xatom('ENABLE', *extensions)
+        self._debugResponse("enable", response)
+
+        status, data = response
+        if status != 'OK':
+            raise ImapCommandError(str(data))
+
+        # e.g. ('OK', [b'CONDSTORE QRESYNC'])
+        status, data = self.imap.response('ENABLED')
+        enabled = []
+        for item in data:
+            if item is not None:
+                enabled.extend(item.decode(ENCODING).upper().split())
+        self.enabled.update(enabled)
+        return enabled
+
+    def enableCompression(self) -> bool:
+        """Enable COMPRESS=DEFLATE (RFC 4978). Return True if enabled."""
+
+        self._debug("enableCompression", "DEFLATE")
+        self.imap.enable_compression()
+        if self.imap.compressor is None:
+            return False
+
+        self.imap.compressor = CountingCompressor(self.imap.compressor)
+        self.imap.decompressor = CountingDecompressor(self.imap.decompressor)
+        return True
+
     def getCapability(self) -> List[str]:
         # (typ, [data])
         # e.g. ('OK', [b'IMAP4rev1 LITERAL+'])
@@ -137,64 +446,178 @@ class IMAPlib2_skater(object):
             capability.append(cap)
 
         self._debug("getCapability", capability)
+        self.capability = capability
         return capability
 
-    def getFolders(self) -> List[Dict[str, Union[str, bool]]]:
-        folders = Folders()
+    def getChangedMessages(self, modSeq: int) -> Tuple[Messages, List[int]]:
+        """Return the messages of the selected folder with flags changed since
+        modSeq and the expunged UIDs.
 
-        # (typ, [data])
-        # e.g. ('OK', [b'(\\HasNoChildren) "." INBOX.DRAFT'])
-        response = self.imap.list()
-        self._debugResponse('list', response)
+        Requires CONDSTORE. The expunged UIDs are only known with QRESYNC."""
+
+        modifiers = "CHANGEDSINCE %i"% modSeq
+        if 'QRESYNC' in self.enabled:
+            modifiers = "%s VANISHED"% modifiers
+        self._debug("getChangedMessages", modifiers)
+
+        # (typ, [data, ...])
+        # e.g. ('OK', [b'4 (UID 4 MODSEQ (65402) FLAGS (\\Seen))'])
+        response = self.imap.uid('FETCH', '1:*', '(UID FLAGS)',
+            "(%s)"% modifiers)
+        self._debugResponse("getChangedMessages", response)
 
         status, data = response
-        if status == 'OK':
-            for bytes_folderInfo in data:
-                foldersInfo = bytes_folderInfo.decode(ENCODING)
-                lst_foldersInfo = foldersInfo.split(' ')
+        if status != 'OK':
+            raise ImapCommandError(str(data))
+
+        messages = Messages()
+        for uid, attributes in FetchParser().parse(data):
+            message = Message(uid)
+            message.setAttributes(attributes)
+            messages.add(message)
+
+        # e.g. ('OK', [b'(EARLIER) 41,43:116'])
+        vanished = []
+        status, data = self.imap.response('VANISHED')
+        for item in data:
+            if item is not None:
+                vanished.extend(expandUIDs(
+                    item.decode(ENCODING).split(' ')[-1]))
+
+        return messages, vanished
+
+    def getCompressionRatios(self) -> Dict[str, float]:
+        """Return the achieved compression ratios for the sent and received
+        data. None if compression is not enabled."""
+
+        if not isinstance(self.imap.compressor, CountingCompressor):
+            return None
+        return {
+            'sent': getRatio(self.imap.compressor),
+            'received': getRatio(self.imap.decompressor),
+            }
 
-                folderName = ' '.join(lst_foldersInfo[2:]).encode(ENCODING)
-                folder = Folder(folderName)
+    def getFolders(self) -> Folders:
+        """Return the folders with their STATUS items.
 
-                folder.setRoot(lst_foldersInfo[1])
+        The items come with the LIST response if the server supports
+        LIST-STATUS (RFC 5819). Otherwise, the STATUS commands of all the
+        folders are pipelined."""
 
-                childrenInfo = lst_foldersInfo[0]
-                if childrenInfo == "(\\HasNoChildren)":
-                    folder.setHasChildren(False)
-                else:
-                    folder.setHasChildren(True)
+        folders = Folders()
+        if self.capability is None:
+            self.getCapability()
+        statusItems = STATUS_ITEMS[:]
+        if 'CONDSTORE' in self.capability:
+            statusItems.append('HIGHESTMODSEQ')
+        statusItems = "(%s)"% ' '.join(statusItems)
+        listStatus = 'LIST-STATUS' in self.capability
 
-                folders.append(folder)
-            self._debug('getFolders', folders)
-            return folders
+        # (typ, [data])
+        # e.g. ('OK', [b'(\\HasNoChildren) "." INBOX.DRAFT'])
+        if listStatus:
+            # imaplib2 has no support of the return options; they follow the
+            # pattern.
+            response = self.imap.list('""', '"*" RETURN (STATUS %s)'%
+                statusItems)
+        else:
+            response = self.imap.list()
+        self._debugResponse('list', response)
 
-        raise ImapCommandError(str(data))
+        status, data = response
+        if status != 'OK':
+            raise ImapCommandError(str(data))
+
+        selectable = Folders()
+        for bytes_folderInfo in data:
+            if bytes_folderInfo is None: # No folder.
+                continue
+            match = LIST_cre.match(bytes_folderInfo.decode(ENCODING))
+            if match is None:
+                self._debug('getFolders', "ignoring %s"% bytes_folderInfo)
+                continue
+
+            folderName = unquote(match.group('name')).encode(ENCODING)
+            folder = Folder(folderName)
+            folder.setRoot(match.group('delimiter'))
+
+            flags = match.group('flags').upper().split()
+            folder.setHasChildren('\\HASNOCHILDREN' not in flags)
+            if not ('\\NOSELECT' in flags or '\\NONEXISTENT' in flags):
+                selectable.append(folder)
+
+            folders.append(folder)
+
+        if listStatus:
+            # e.g. ('OK', [b'"INBOX" (MESSAGES 2 UIDNEXT 3 UIDVALIDITY 1)'])
+            status, data = self.imap.response('STATUS')
+            statuses = parseStatus(data)
+        else:
+            statuses = self._getStatuses(selectable, statusItems)
+        for folder in folders:
+            status = statuses.get(folder.getName(), {})
+            folder.setStatus(status)
+            # Flags changes are only seen with the HIGHESTMODSEQ.
+            fingerprint = [status.get(name) for name in
+                ['UIDVALIDITY', 'UIDNEXT', 'MESSAGES', 'HIGHESTMODSEQ']]
+            if None not in fingerprint:
+                folder.setFingerprint(fingerprint)
+
+        self._debug('getFolders', folders)
+        return folders
+
+    def getHighestModSeq(self) -> int:
+        """Return the HIGHESTMODSEQ of the selected folder.
+
+        None if CONDSTORE is not enabled or not supported by the folder."""
+
+        return self.highestModSeq
 
     def getMessages(self, messages: Messages,
             attributes: FetchAttributes) -> Messages:
-        self._debug("getMessages", repr(messages))
+        """Fetch the attributes of the messages by batches of UIDs.
 
-        # (typ, [data, ...])
-        # e.g. ('OK', [b'1 (UID 1 FLAGS (\\Seen) INTERNALDATE "15-Nov-2015
-        # 00:00:46 +0100")', b'2 (UID 2 FLAGS () INTERNALDATE "15-Nov-2015
-        # 00:00:46 +0100")'])
-        response = self.imap.uid('FETCH', messages.coalesceUIDs(),
-            str(attributes))
-        self._debugResponse("getMessages", response)
+        Up to FETCH_PIPELINE batches are sent before waiting for the first
+        response. The size of the batches adapts to the responses."""
 
-        status, data = response
-        if status == 'OK':
-            for item in data:
-                item = item.decode(ENCODING)
-                uid = int(item[0])
-                #TODO: item must be of type MessageAttributes.
-                messages.setAttributes(uid, item)
-            return messages
-        raise ImapCommandError(data)
+        self._debug("getMessages", repr(messages))
+
+        uids = sorted(messages.keys())
+        parser = FetchParser() # Responses might interleave across batches.
+        pipeline = self.pipeline()
+        sent = 0
+        while sent < len(uids) or len(pipeline) > 0:
+            while sent < len(uids) and len(pipeline) < FETCH_PIPELINE:
+                batch = uids[sent:sent + self.fetchBatchSizer.getSize()]
+                sent += len(batch)
+                self._debug("getMessages", "batch of %i UIDs"% len(batch))
+                pipeline.send(len(batch), 'uid', 'FETCH', coalesceUIDs(batch),
+                    str(attributes))
+
+            # e.g. [b'1 (UID 1 FLAGS (\\Seen) INTERNALDATE "15-Nov-2015
+            # 00:00:46 +0100")', ...]
+            count, data, seconds = pipeline.getResponse()
+            self.fetchBatchSizer.record(count, seconds, getSize(data))
+
+            final = sent >= len(uids) and len(pipeline) < 1
+            for uid, messageAttributes in parser.parse(data, final):
+                if uid in messages:
+                    messages.setAttributes(uid, messageAttributes)
+        return messages
 
     def getNamespace(self):
         return self.imap.namespace()
 
+    def getUIDNext(self) -> int:
+        """Return the UIDNEXT of the selected folder, if sent by the server."""
+
+        return self.uidnext
+
+    def getUIDValidity(self) -> int:
+        """Return the UIDVALIDITY of the selected folder."""
+
+        return self.uidvalidity
+
     def login(self, user: str, password: str) -> None:
         self._debug("login", "%s, <password>"% user)
 
@@ -211,26 +634,65 @@ class IMAPlib2_skater(object):
         raise ImapCommandError(data)
 
     def logout(self) -> None:
+        ratios = self.getCompressionRatios()
+        if ratios is not None:
+            self._debug("logout", "compression ratios: %s"% ratios)
         self.imap.logout()
 
+    def pipeline(self, depth: int=None) -> Pipeline:
+        """Return a new pipeline of commands for this connection."""
+
+        return Pipeline(self.imap, depth)
+
     def searchUID(self, searchConditions: SearchConditions=SearchConditions()):
         conditions = searchConditions.formatConditions()
         self._debug("searchUID", "%s"% conditions)
 
         # (typ, [data])
         # e.g. ('OK', [b'2']
+        # Nothing found: ('OK', [b'']) or ('OK', [None]).
         response = self.imap.uid('SEARCH', conditions)
         self._debugResponse("searchUID", response)
         status, data = response
         if status == 'OK':
             messages = Messages()
+            if data[0] is None:
+                return messages
             for uid in data[0].decode(ENCODING).split(' '):
-                messages.add(Message(int(uid)))
+                if len(uid) > 0:
+                    messages.add(Message(int(uid)))
             return messages
 
         data = data.decode(ENCODING)
         raise ImapCommandError(data)
 
+    def setFlags(self, messages: Messages) -> None:
+        """Set the system flags of the messages in the selected folder to the
+        flags of their attributes. The other flags (keywords) are kept.
+
+        The messages with the same flags are stored together; the STORE
+        commands are pipelined."""
+
+        byFlags = {} # UIDs by the flags to set.
+        for message in messages.values():
+            flags = tuple(sorted(flag for flag in
+                message.getAttributes().getFlags() if flag in SYSTEM_FLAGS))
+            byFlags.setdefault(flags, []).append(message.getUID())
+
+        pipeline = self.pipeline()
+        for flags, uids in byFlags.items():
+            uids = coalesceUIDs(sorted(uids))
+            removed = [flag for flag in SYSTEM_FLAGS if flag not in flags]
+            self._debug("setFlags", "%s %s"% (uids, flags))
+            if len(flags) > 0:
+                pipeline.send(uids, 'uid', 'STORE', uids, '+FLAGS.SILENT',
+                    "(%s)"% ' '.join(flags))
+            if len(removed) > 0:
+                pipeline.send(uids, 'uid', 'STORE', uids, '-FLAGS.SILENT',
+                    "(%s)"% ' '.join(removed))
+        for uids, data, seconds in pipeline.getResponses():
+            self._debugResponse("setFlags", data)
+
     def select(self, folder: Folder) -> int:
         """Return number of existing messages."""
 
@@ -242,6 +704,12 @@ class IMAPlib2_skater(object):
 
         status, data = response
         if status == 'OK':
+            self.folderName = folder.getName()
+            self.uidvalidity = self._getSelectResponse('UIDVALIDITY')
+            self.uidnext = self._getSelectResponse('UIDNEXT')
+            self.highestModSeq = None
+            if self.enabled & {'CONDSTORE', 'QRESYNC'}:
+                self.highestModSeq = self._getSelectResponse('HIGHESTMODSEQ')
             #TODO: make a collection of UIDs.
             return int(data[0])
 
@@ -4,6 +4,7 @@
 import imp #TODO: use library importlib instead of deprecated imp.
 
 from imapfw.api import types
+from imapfw.toolkit import expandPath
 
 # Annotations.
 from typing import List, TypeVar
@@ -94,6 +95,11 @@ class Rascal(object):
     def getPreHook(self) -> Function:
         return self._getHook('preHook')
 
+    def getStatePath(self) -> str:
+        """Return the directory where to keep data between runs, or None."""
+
+        return expandPath(self._mainConf.get('state_path'))
+
     def getSettings(self, name: str) -> dict:
         literal = getattr(self._rascal, name)
         if not isinstance(literal, dict):
@@ -55,6 +55,7 @@ class DriverRunner(object):
         runtime.ui.info("%s %s"% (self.repositoryName, msg))
 
     def _buildDriver(self, repository: Repository) -> None:
+        self.logout() # The worker might be re-used for another repository.
         self.repositoryName = repository.getClassName()
         self.driver = repository.fw_getDriver()
         self._driverAccept()
@@ -62,15 +63,21 @@ class DriverRunner(object):
         self._info("driver ready!")
 
     def buildDriver(self, accountName: str, side: str,
-            reuse: bool=False) -> None:
-        """Build the driver object in the worker from this account side."""
+            reuse: bool=False) -> bool:
+        """Build the driver object in the worker from this account side.
 
-        if reuse is True and self.driver is not None:
-            return None
+        With reuse, keep the current driver if it is for the same repository.
+        Return True if a new driver was built (and must be connected)."""
 
         account = loadAccount(accountName)
         repository = account.fw_getSide(side)
+
+        if reuse is True and self.driver is not None:
+            if self.repositoryName == repository.getClassName():
+                return False
+
         self._buildDriver(repository)
+        return True
 
     def buildDriverFromRepositoryName(self, repositoryName: str,
             reuse: bool=False) -> None:
@@ -92,7 +99,7 @@ class DriverRunner(object):
         """Logout from server. Allows to be called more than once."""
 
         if self.driver is not None:
-            self.driver.logout_sync()
+            self.driver.logout()
             self._debug("logged out")
             self.driver = None
         return True
@@ -105,5 +112,6 @@ class DriverRunner(object):
                 'isDriverBuilt', 'logout']:
             self.receiver.accept(name, getattr(self, name))
 
-        while self.receiver.react():
+        # Nothing else to do: sleep until the next event.
+        while self.receiver.react(timeout=None):
             pass
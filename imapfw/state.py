@@ -0,0 +1,288 @@
+# The MIT License (MIT).
+# Copyright (c) 2016, Nicolas Sebrecht & contributors.
+
+"""
+
+Data kept from one run to the next. It is stored in the directory set by the
+'state_path' option of the MainConf. Nothing is stored if not set.
+
+- FolderHistory: how long the folders took to sync and their fingerprints,
+  saved by the main worker.
+- FolderState: what was synced of a folder, one file per account, repository
+  and folder so that the folder workers don't share files.
+- MaildirIndex: the messages of a Maildir folder, one file per repository and
+  folder, for the Maildir driver.
+
+"""
+
+import json
+import os
+import threading
+import time
+from urllib.parse import quote
+
+from imapfw import runtime
+
+# Annotations.
+from imapfw.annotation import Dict, List
+from imapfw.types.folder import Folder
+from imapfw.types.message import Messages
+
+
+class FolderHistory(object):
+    """What was learned about the folders during the previous runs.
+
+    Saved by the main worker only, at the end of the run. The account engines
+    load it once per account to skip the folders whose fingerprints did not
+    change. It's small: one entry per folder."""
+
+    def __init__(self, statePath: str=None):
+        self._path = None
+        if statePath is not None:
+            self._path = os.path.join(statePath, 'folders.json')
+
+        self._history = {} # By account name, then by folder name.
+
+    def getEstimate(self, accountName: str, folder: Folder) -> float:
+        """Return the time it took to sync the folder last time.
+
+        None if unknown."""
+
+        try:
+            return self._history[accountName][folder.getName()]['seconds']
+        except KeyError:
+            return None
+
+    def getFingerprints(self, accountName: str, folder: Folder) -> List:
+        """Return the fingerprints of the folder on both sides when last synced
+        without error, see `Folder.getFingerprint`.
+
+        None if unknown."""
+
+        try:
+            return self._history[accountName][folder.getName()].get(
+                'fingerprints')
+        except KeyError:
+            return None
+
+    def load(self) -> None:
+        if self._path is None:
+            return
+        try:
+            with open(self._path, 'r') as fd:
+                self._history = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            runtime.ui.warn("ignoring corrupted history %s: %s"%
+                (self._path, e))
+
+    def record(self, accountName: str, folder: Folder, seconds: float,
+            fingerprints: List=None) -> None:
+        folders = self._history.setdefault(accountName, {})
+        folders[folder.getName()] = {
+            'seconds': seconds,
+            'fingerprints': fingerprints,
+            }
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmpPath = "%s.tmp"% self._path
+        with open(tmpPath, 'w') as fd:
+            json.dump(self._history, fd)
+        os.replace(tmpPath, self._path)
+
+
+class FolderState(object):
+    """What was synced of a folder of a repository, for an account.
+
+    Used by the folder engine to only ask for the changes since the previous
+    sync. A state is thrown away if the UIDVALIDITY of the folder changed.
+    The HIGHESTMODSEQ is only known for the IMAP servers supporting
+    CONDSTORE.
+
+    The messages are recorded with their synced flags and the UID of the same
+    message on the other side (the link), once copied."""
+
+    def __init__(self, statePath: str, accountName: str, repositoryName: str,
+            folder: Folder):
+        self._path = None
+        if statePath is not None:
+            self._path = os.path.join(statePath, 'folders', accountName,
+                repositoryName, "%s.json"% quote(folder.getName(), safe=''))
+
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestUID = None
+        self.highestModSeq = None
+        self.flags = {} # Flags by UID.
+        self.links = {} # UID on the other side by UID.
+
+    def checkUIDValidity(self, uidvalidity: int) -> bool:
+        """Reset the state if the UIDs of the folder are not the same.
+
+        Return False if reset."""
+
+        if uidvalidity == self.uidvalidity:
+            return True
+        self.uidvalidity = uidvalidity
+        self.uidnext = None
+        self.highestUID = None
+        self.highestModSeq = None
+        self.flags = {}
+        self.links = {}
+        return False
+
+    def getFlags(self, uid: int) -> List[str]:
+        """Return the synced flags of the message, None if unknown."""
+
+        return self.flags.get(uid)
+
+    def getHighestModSeq(self) -> int:
+        return self.highestModSeq
+
+    def getHighestUID(self) -> int:
+        return self.highestUID
+
+    def getLink(self, uid: int) -> int:
+        return self.links.get(uid)
+
+    def getNewMessages(self, messages: Messages) -> Messages:
+        """Return the unknown messages with a UID higher than the highest
+        synced UID.
+
+        The messages copied from the other side are known but might be higher:
+        the UIDs below might not be synced yet."""
+
+        return Messages(*[m for m in messages.values()
+            if (self.highestUID is None or m.getUID() > self.highestUID) and
+            m.getUID() not in self.flags])
+
+    def getUIDs(self) -> List[int]:
+        return list(self.flags.keys())
+
+    def link(self, uid: int, flags: List[str], otherUID: int) -> None:
+        """Record a message copied to or from the other side."""
+
+        self.flags[uid] = flags
+        self.links[uid] = otherUID
+
+    def load(self) -> None:
+        if self._path is None:
+            return
+        try:
+            with open(self._path, 'r') as fd:
+                state = json.load(fd)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            runtime.ui.warn("ignoring corrupted state %s: %s"% (self._path, e))
+            return
+
+        self.uidvalidity = state.get('uidvalidity')
+        self.uidnext = state.get('uidnext')
+        self.highestUID = state.get('highestUID')
+        self.highestModSeq = state.get('highestModSeq')
+        self.flags = {int(uid): flags
+            for uid, flags in state.get('flags', {}).items()}
+        self.links = {int(uid): otherUID
+            for uid, otherUID in state.get('links', {}).items()}
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        # The same account might be synced by more than one worker.
+        tmpPath = "%s.%i.%i.tmp"% (self._path, os.getpid(),
+            threading.get_ident())
+        with open(tmpPath, 'w') as fd:
+            json.dump({
+                'uidvalidity': self.uidvalidity,
+                'uidnext': self.uidnext,
+                'highestUID': self.highestUID,
+                'highestModSeq': self.highestModSeq,
+                'flags': self.flags,
+                'links': self.links,
+                }, fd)
+        os.replace(tmpPath, self._path)
+
+    def removeUIDs(self, uids: List[int]) -> None:
+        """Forget the expunged messages."""
+
+        for uid in uids:
+            self.flags.pop(uid, None)
+            self.links.pop(uid, None)
+
+    def setFlags(self, uid: int, flags: List[str]) -> None:
+        self.flags[uid] = flags
+
+    def setHighestModSeq(self, highestModSeq: int) -> None:
+        self.highestModSeq = highestModSeq
+
+    def setHighestUID(self, uid: int) -> None:
+        """Record that the messages up to this UID are synced."""
+
+        if self.highestUID is None or uid > self.highestUID:
+            self.highestUID = uid
+
+    def setUIDNext(self, uidnext: int) -> None:
+        self.uidnext = uidnext
+
+
+class MaildirIndex(object):
+    """The messages of a Maildir folder, for the Maildir driver.
+
+    The entries are [filename, flags, size, internaldate] by UID. The filename
+    is relative to the folder (e.g. 'cur/...'), the flags are the letters of
+    the info part and the internaldate is a timestamp. Both size and
+    internaldate might be None.
+
+    The index is valid while the fingerprint of the folder, the mtimes of cur
+    and new, is the same. The mtimes have a coarse resolution on some
+    filesystems: the index is not saved while they are too recent to be
+    trusted."""
+
+    def __init__(self, statePath: str, repositoryName: str, folderName: str):
+        self._path = None
+        if statePath is not None:
+            self._path = os.path.join(statePath, 'maildir', repositoryName,
+                "%s.json"% quote(folderName, safe=''))
+
+    def load(self, fingerprint: List[int]) -> Dict[int, list]:
+        """Return the entries if the index is up to date, None otherwise."""
+
+        if self._path is None or fingerprint is None:
+            return None
+        try:
+            with open(self._path, 'r') as fd:
+                index = json.load(fd)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            runtime.ui.warn("ignoring corrupted index %s: %s"% (self._path, e))
+            return None
+
+        if index.get('fingerprint') != fingerprint:
+            return None
+        return {int(uid): entry
+            for uid, entry in index.get('entries', {}).items()}
+
+    def save(self, fingerprint: List[int], entries: Dict[int, list]) -> None:
+        if self._path is None or fingerprint is None:
+            return
+        # A change within the same tick as the scan would not change the
+        # mtimes.
+        now = time.time_ns()
+        if any(now - mtime < 2 * 10**9 for mtime in fingerprint):
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmpPath = "%s.%i.%i.tmp"% (self._path, os.getpid(),
+            threading.get_ident())
+        with open(tmpPath, 'w') as fd:
+            json.dump({
+                'fingerprint': fingerprint,
+                'entries': entries,
+                }, fd, separators=(',', ':'))
+        os.replace(tmpPath, self._path)
@@ -1,13 +1,22 @@
 # The MIT License (MIT).
 # Copyright (c) 2015-2006, Nicolas Sebrecht & contributors.
 
+import os
 import unittest
+from unittest import mock
 
 from imapfw import runtime
+from imapfw.rascal import Rascal
 from imapfw.architects.architect import Architect
 from imapfw.architects.engine import EngineArchitect
 from imapfw.architects.driver import DriverArchitect, DriversArchitect
+from imapfw.architects.driver import DriverPool
+from imapfw.architects.account import SyncArchitect, SyncAccountsArchitect
+from imapfw.architects.folder import FolderScheduler
 from imapfw.edmp import Emitter
+from imapfw.state import FolderHistory
+from imapfw.testing import libcore
+from imapfw.types.folder import Folder
 
 
 class TestArchitect(unittest.TestCase):
@@ -76,6 +85,269 @@ class TestDriversArchitect(unittest.TestCase):
         self.assertIsInstance(emitter, Emitter)
         self.assertRaises(KeyError, self.arc.getEmitter, 3)
 
+class TestDriverPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = DriverPool('Pool')
+
+    def test_00_lease_stop(self):
+        driverArch = self.pool.lease('RepositoryA')
+        self.assertIsInstance(driverArch.getEmitter(), Emitter)
+        self.pool.stop()
+
+    def test_01_lease_giveBack(self):
+        driverArch = self.pool.lease('RepositoryA')
+        self.pool.giveBack('RepositoryA', driverArch)
+        # Idle drivers are leased for the same repository only.
+        other = self.pool.lease('RepositoryB')
+        self.assertIsNot(other, driverArch)
+        self.assertIs(self.pool.lease('RepositoryA'), driverArch)
+        self.pool.stop()
+
+    def test_02_lease_kill(self):
+        self.pool.lease('RepositoryA')
+        self.pool.kill()
+
+    def test_03_drop(self):
+        driverArch = self.pool.lease(None)
+        self.pool.drop(driverArch)
+        self.assertNotIn(driverArch, self.pool.driverArchitects)
+        self.pool.stop()
+
+    def test_04_folder_workers(self):
+        scheduler = FolderScheduler(self.pool, None)
+        folderArchitect = scheduler._getIdle(('RepositoryA', 'RepositoryB'))
+        leftArch = folderArchitect.leftArch
+        scheduler.idle.append(folderArchitect)
+        self.assertIs(scheduler._getIdle(('RepositoryA', 'RepositoryB')),
+            folderArchitect)
+
+        # The idle worker of other repositories is replaced and its drivers
+        # are given back for their repositories.
+        scheduler.idle.append(folderArchitect)
+        other = scheduler._getIdle(('RepositoryC', 'RepositoryB'))
+        self.assertIsNot(other, folderArchitect)
+        self.assertEqual(other.repositoryNames, ('RepositoryC', 'RepositoryB'))
+        self.assertIs(other.rightArch, folderArchitect.rightArch)
+        self.assertEqual(list(scheduler.folderArchitects.keys()), ['Folder.1'])
+        self.assertIs(self.pool.lease('RepositoryA'), leftArch)
+
+        scheduler.stop()
+        self.pool.stop()
+
+
+class TestFolderScheduler(unittest.TestCase):
+    class FakeFolderArchitect(object):
+        def __init__(self, workerName):
+            self.workerName = workerName
+            self.repositoryNames = None
+            self.folders = []
+            self.killed = False
+
+        def kill(self):
+            self.killed = True
+
+        def syncFolder(self, accountName, folder, repositoryNames):
+            self.repositoryNames = repositoryNames
+            self.folders.append(folder)
+
+    def setUp(self):
+        rascal = Rascal()
+        rascal.load(os.path.join(libcore.testingPath(), 'rascals',
+            'basic.rascal'))
+        self.previousRascal = runtime.rascal
+        runtime.set_module('rascal', rascal)
+
+        self.scheduler = FolderScheduler(None, None)
+        # Don't start workers.
+        def getIdle(repositoryNames):
+            if len(self.scheduler.idle) > 0:
+                return self.scheduler.idle.pop(0)
+            workerName = "Folder.%i"% self.scheduler.started
+            self.scheduler.started += 1
+            folderArchitect = self.FakeFolderArchitect(workerName)
+            self.scheduler.folderArchitects[workerName] = folderArchitect
+            return folderArchitect
+        self.scheduler._getIdle = getIdle
+
+        self.folders = [Folder(str(i).encode()) for i in range(12)]
+
+    def tearDown(self):
+        runtime.set_module('rascal', self.previousRascal)
+
+    def test_00_schedule_nothing(self):
+        exitCodes = []
+        self.scheduler.schedule('Account.0', 'AccountA', [], exitCodes.append)
+        self.assertEqual(exitCodes, [0])
+
+    def test_01_max_connections(self):
+        exitCodes = []
+        # MaildirA allows 9 connections.
+        self.scheduler.schedule('Account.0', 'AccountA', self.folders,
+            exitCodes.append)
+        self.assertEqual(len(self.scheduler.running), 9)
+        self.assertEqual(len(self.scheduler.pending), 3)
+
+        self.scheduler.folderDone('Folder.0', 0)
+        self.assertEqual(len(self.scheduler.running), 9)
+        self.assertEqual(self.scheduler.folderArchitects['Folder.0'].folders,
+            [Folder(b'0'), Folder(b'9')])
+
+        # Idle workers take the folders of the other accounts.
+        self.scheduler.schedule('Account.1', 'AccountA', [Folder(b'other')],
+            exitCodes.append)
+        for i in range(1, 4):
+            self.scheduler.folderDone('Folder.%i'% i, i)
+        self.assertEqual(len(self.scheduler.pending), 0)
+        self.assertEqual(self.scheduler.folderArchitects['Folder.3'].folders,
+            [Folder(b'3'), Folder(b'other')])
+
+        for workerName in list(self.scheduler.running.keys()):
+            self.scheduler.folderDone(workerName, 0)
+        self.assertEqual(sorted(exitCodes), [0, 3])
+
+    def test_02_cancel(self):
+        exitCodes = []
+        self.scheduler.schedule('Account.0', 'AccountA', self.folders,
+            exitCodes.append)
+        self.scheduler.schedule('Account.1', 'AccountA', [Folder(b'other')],
+            exitCodes.append)
+        folderArchitects = list(self.scheduler.folderArchitects.values())
+        self.scheduler.cancel('Account.0')
+        self.assertEqual(len(self.scheduler.pending), 0)
+        # The workers syncing the folders of the account are killed.
+        for folderArchitect in folderArchitects:
+            self.assertTrue(folderArchitect.killed)
+        # Their connections are available to the other accounts.
+        self.assertEqual(list(self.scheduler.running.keys()), ['Folder.9'])
+        self.assertEqual(self.scheduler.connections['MaildirA'], 1)
+        # Late reports of the killed workers are ignored.
+        self.scheduler.folderDone('Folder.0', 0)
+        self.scheduler.folderDone('Folder.9', 0)
+        self.assertEqual(exitCodes, [0])
+
+    def test_03_same_folder(self):
+        exitCodes = []
+        for key in ['Account.0', 'Account.1']:
+            self.scheduler.schedule(key, 'AccountA', [Folder(b'INBOX')],
+                exitCodes.append)
+        # Not synced twice at the same time.
+        self.assertEqual(len(self.scheduler.running), 1)
+        self.scheduler.folderDone('Folder.0', 0)
+        self.assertEqual(len(self.scheduler.running), 1)
+        self.scheduler.folderDone('Folder.0', 0)
+        self.assertEqual(exitCodes, [0, 0])
+
+    def test_04_longest_first(self):
+        history = FolderHistory()
+        history.record('AccountA', Folder(b'small'), 1.0)
+        history.record('AccountA', Folder(b'large'), 60.0)
+        self.scheduler.history = history
+        # Only one connection.
+        self.scheduler.maxConnections['MaildirA'] = 1
+        self.scheduler.connections['MaildirA'] = 0
+
+        folders = [Folder(b'small'), Folder(b'large'), Folder(b'new')]
+        self.scheduler.schedule('Account.0', 'AccountA', folders,
+            lambda exitCode: None)
+        for i in range(3):
+            self.scheduler.folderDone('Folder.0', 0)
+        self.assertEqual(self.scheduler.folderArchitects['Folder.0'].folders,
+            [Folder(b'new'), Folder(b'large'), Folder(b'small')])
+
+    def test_05_record_fingerprints(self):
+        folders = [Folder(b'INBOX'), Folder(b'spam')]
+        self.scheduler.schedule('Account.0', 'AccountA', folders,
+            lambda exitCode: None,
+            {'INBOX': [[1, 2], [3, 4]], 'spam': [[5, 6], [7, 8]]})
+        self.scheduler.folderDone('Folder.0', 0)
+        self.scheduler.folderDone('Folder.1', 10)
+        history = self.scheduler.history
+        self.assertEqual(history.getFingerprints('AccountA', Folder(b'INBOX')),
+            [[1, 2], [3, 4]])
+        # Not synced: dirty next time.
+        self.assertEqual(history.getFingerprints('AccountA', Folder(b'spam')),
+            None)
+
+
+class TestSyncArchitect(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = mock.Mock()
+        self.driverPool = mock.Mock()
+        self.syncArch = SyncArchitect('Account.0', None, 'SyncAccountEngine',
+            'SyncFolderEngine', self.scheduler, self.driverPool, None)
+        self.syncArch.architect = mock.Mock()
+        self.syncArch.leftArch = mock.Mock()
+        self.syncArch.rightArch = mock.Mock()
+
+    def test_00_folders_after_engine(self):
+        # The engine moves on to the next account without waiting.
+        self.syncArch.syncFolders('AccountA', [Folder(b'a')], {})
+        self.syncArch.syncFolders('AccountB', [Folder(b'b')], {})
+        self.syncArch.accountEngineDone(0, ('MaildirA', 'ImapA'))
+        self.assertEqual(self.syncArch.getExitCode(), -1)
+
+        doneA = self.scheduler.schedule.call_args_list[0][0][3]
+        doneB = self.scheduler.schedule.call_args_list[1][0][3]
+        doneB(2)
+        self.assertEqual(self.syncArch.getExitCode(), -1)
+        doneA(0)
+        self.assertEqual(self.syncArch.getExitCode(), 2)
+
+    def test_01_kill(self):
+        leftArch, rightArch = self.syncArch.leftArch, self.syncArch.rightArch
+        self.syncArch.syncFolders('AccountA', [Folder(b'a')], {})
+        self.syncArch.kill()
+        self.syncArch.architect.kill.assert_called_once_with()
+        self.driverPool.drop.assert_has_calls(
+            [mock.call(leftArch), mock.call(rightArch)])
+        self.scheduler.cancel.assert_called_once_with('Account.0.0')
+        self.assertEqual(self.syncArch.getExitCode(), 10)
+
+
+class TestSyncAccountsArchitect(unittest.TestCase):
+    def setUp(self):
+        rascal = Rascal()
+        rascal.load(os.path.join(libcore.testingPath(), 'rascals',
+            'basic.rascal'))
+        self.previousRascal = runtime.rascal
+        runtime.set_module('rascal', rascal)
+
+        self.arc = SyncAccountsArchitect(['AccountA'])
+        self.arc.driverPool = mock.Mock()
+        self.arc.folderScheduler = mock.Mock()
+        self.syncArch = mock.Mock(workerName='Account.0')
+        self.syncArch.getExitCode.return_value = -1
+        self.arc.syncArchs['Account.0'] = self.syncArch
+
+    def tearDown(self):
+        runtime.set_module('rascal', self.previousRascal)
+
+    def test_00_kill(self):
+        self.syncArch.kill.side_effect = \
+            lambda: setattr(self.syncArch.getExitCode, 'return_value', 10)
+        self.arc.kill()
+        self.syncArch.kill.assert_called_once_with()
+        self.arc.folderScheduler.kill.assert_called_once_with()
+        self.arc.driverPool.kill.assert_called_once_with()
+        self.assertEqual(self.arc.syncArchs, {})
+        self.assertEqual(self.arc.exitCode, 10)
+
+    def test_01_run_error(self):
+        self.arc.receiver = mock.Mock()
+        self.arc.receiver.react.side_effect = KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, self.arc.run)
+        self.syncArch.kill.assert_called_once_with()
+        self.arc.folderScheduler.kill.assert_called_once_with()
+        self.arc.driverPool.kill.assert_called_once_with()
+
+    def test_02_folder_done(self):
+        self.syncArch.getExitCode.return_value = 0
+        self.arc._on_folderDone('Folder.0', 0)
+        self.arc.folderScheduler.folderDone.assert_called_once_with(
+            'Folder.0', 0)
+        self.assertEqual(self.arc.syncArchs, {})
+
+
 class TestEngineArchitect(unittest.TestCase):
     def setUp(self):
         def runner():
@@ -20,8 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import pickle
+import subprocess
+import sys
 import unittest
 
+import imapfw
 from imapfw import runtime
 from imapfw.concurrency.concurrency import *
 
@@ -68,6 +73,82 @@ class TestConcurrency(unittest.TestCase):
 
         worker.kill()
 
+    def test_06_queue_put_get(self):
+        queue = runtime.concurrency.createQueue()
+        queue.put({'data': [1, 2]})
+        queue.put(None)
+        self.assertEqual(queue.get(), {'data': [1, 2]})
+        self.assertEqual(queue.get(), None)
+        self.assertEqual(queue.get_nowait(), None)
+
+    def test_07_queue_validation(self):
+        runtime.concurrency.setQueueValidation(True)
+        queue = runtime.concurrency.createQueue()
+        # Must fail right away.
+        self.assertRaises((pickle.PicklingError, AttributeError),
+            queue.put, lambda: None)
+
+    def test_08_payload(self):
+        def receive(inQueue, outQueue):
+            payload = inQueue.get()
+            data = bytes(payload.getView())
+            payload.release()
+            outQueue.put(data)
+
+        for size in [10, PAYLOAD_MIN_SHARED_SIZE * 2]:
+            inQueue = runtime.concurrency.createQueue()
+            outQueue = runtime.concurrency.createQueue()
+            worker = runtime.concurrency.createWorker('receive', receive,
+                (inQueue, outQueue))
+            worker.start()
+
+            data = b'x' * size
+            payload = runtime.concurrency.createPayload(data)
+            self.assertIsInstance(payload, PayloadInterface)
+            inQueue.put(payload)
+            self.assertEqual(outQueue.get(), data)
+            worker.join()
+
+    def test_09_payload_never_released(self):
+        from multiprocessing.shared_memory import SharedMemory
+
+        # The workers of a run in a new process.
+        code = """if True:
+            from multiprocessing.shared_memory import SharedMemory
+            from imapfw.concurrency.concurrency import *
+
+            def send(queue):
+                concurrency = MultiProcessingBackend()
+                for data in [b'x', b'y']:
+                    queue.put(concurrency.createPayload(
+                        data * PAYLOAD_MIN_SHARED_SIZE))
+
+            concurrency = MultiProcessingBackend()
+            queue = concurrency.createQueue()
+            worker = concurrency.createWorker('send', send, (queue,))
+            worker.start()
+            released, leaked = queue.get(), queue.get()
+            worker.join()
+            # Still available once the sender is done.
+            assert bytes(released.getView()) == b'x' * PAYLOAD_MIN_SHARED_SIZE
+            released.release()
+            shm = SharedMemory(name=leaked._name)
+            assert bytes(shm.buf[:1]) == b'y'
+            shm.close()
+            print(leaked._name)
+            """
+        env = dict(os.environ,
+            PYTHONPATH=os.path.dirname(os.path.dirname(imapfw.__file__)))
+        result = subprocess.run([sys.executable, '-c', code], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn(b'Traceback', result.stderr)
+        # Unlinked twice if the workers don't share the resource tracker.
+        self.assertNotIn(b'No such file', result.stderr)
+        # Unlinked at the end of the run.
+        self.assertRaises(FileNotFoundError, SharedMemory,
+            name=result.stdout.decode().strip())
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
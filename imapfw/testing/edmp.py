@@ -21,6 +21,7 @@
 # THE SOFTWARE.
 
 import unittest
+import threading
 import time
 
 from imapfw import runtime
@@ -47,6 +48,15 @@ class TestEDMP(unittest.TestCase):
         time.sleep(0.1)
         self.assertEqual([x for x in chan], [0, 1, 2])
 
+    def test_channel_timeout(self):
+        queue = self.c.createQueue()
+        chan = Channel(queue, timeout=0.1)
+        self.assertEqual(chan.get(0.1), None)
+
+        queue.put(0)
+        queue.put(None) # Wakes up and stops a blocking channel.
+        self.assertEqual([x for x in Channel(queue, timeout=None)], [0])
+
     def test_newEmitterReceiver(self):
         r, e = newEmitterReceiver('test')
         self.assertIsInstance(r, Receiver)
@@ -114,6 +124,213 @@ class TestEDMP(unittest.TestCase):
         while r.react():
             pass
 
+    def test_react_timeout(self):
+        r, e = newEmitterReceiver('test')
+        self.assertEqual(r.react(timeout=0.1), True)
+
+    def test_react_blocking(self):
+        def onEvent(true):
+            self.assertEqual(true, True)
+
+        def runner(r):
+            while r.react(timeout=None):
+                pass
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        e.event(True)
+        e.stopServing() # Must wake up the receiver.
+        w.join()
+
+    def test_event_sync(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        self.assertEqual(e.event_sync(None), None)
+        self.assertEqual(e.event_sync((1, 2)), (1, 2))
+        e.stopServing()
+        w.join()
+
+    def test_event_sync_shared_emitter(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        def caller(number):
+            results[number] = [e.event_sync(number) for i in range(10)]
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        # Replies must not be mixed-up between the callers.
+        results = {}
+        callers = [threading.Thread(target=caller, args=(i,)) for i in range(3)]
+        for thread in callers:
+            thread.start()
+        for thread in callers:
+            thread.join()
+        e.stopServing()
+        w.join()
+
+        for number in range(3):
+            self.assertEqual(results[number], [number] * 10)
+
+    def test_event_sync_shared_emitter_latency(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        def caller(number):
+            for i in range(100):
+                e.event_sync(number)
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        # The replies are handed over to the waiting callers, no polling.
+        startTime = time.monotonic()
+        callers = [threading.Thread(target=caller, args=(i,)) for i in range(4)]
+        for thread in callers:
+            thread.start()
+        for thread in callers:
+            thread.join()
+        self.assertLess(time.monotonic() - startTime, 2)
+        e.stopServing()
+        w.join()
+
+    def test_newEmitter(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        def caller(number, emitter):
+            results.put((number, [emitter.event_sync(number)
+                for i in range(10)]))
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        emitters = [r.newEmitter() for i in range(3)]
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        # Each worker gets the replies on the queue of its emitter.
+        results = self.c.createQueue()
+        callers = [self.c.createWorker('caller.%i'% i, caller,
+            (i, emitters[i])) for i in range(3)]
+        for worker in callers:
+            worker.start()
+        for worker in callers:
+            worker.join()
+        e.stopServing()
+        w.join()
+
+        for i in range(3):
+            number, values = results.get()
+            self.assertEqual(values, [number] * 10)
+
+    def test_event_future(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        futures = [e.event_future(i) for i in range(3)]
+        # Results can be waited in any order.
+        self.assertEqual(futures[2].getResult(), 2)
+        self.assertEqual(getResults(*futures), [0, 1, 2])
+        e.stopServing()
+        w.join()
+
+    def test_event_errors_future(self):
+        def onEvent():
+            raise RuntimeError('error')
+
+        def runner(r):
+            while r.react():
+                pass
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        future = e.event_future()
+        self.assertRaises(RuntimeError, future.getResult)
+        e.stopServing()
+        w.join()
+
+    def test_event_batch(self):
+        def onEvent(value):
+            values.append(value)
+            return value
+
+        values = []
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        with e.batch():
+            for i in range(3):
+                e.event(i)
+            with e.batch(): # Nested batches are flushed by the outermost.
+                e.event(3)
+            e.stopServing()
+        while r.react():
+            pass
+        self.assertEqual(values, [0, 1, 2, 3])
+
+    def test_event_batch_sync(self):
+        def onEvent(value):
+            return value
+
+        def runner(r):
+            while r.react():
+                pass
+
+        r, e = newEmitterReceiver('test')
+        r.accept('event', onEvent)
+        w = self.c.createWorker('runner', runner, (r,))
+        w.start()
+
+        with e.batch():
+            e.event(0)
+            future = e.event_future(1)
+            # Waiting for a result must flush the batch.
+            self.assertEqual(e.event_sync(2), 2)
+            self.assertEqual(future.getResult(), 1)
+        e.stopServing()
+        w.join()
+
     def test_event_errors(self):
         def onEvent():
             raise RuntimeError('error')
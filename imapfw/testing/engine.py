@@ -0,0 +1,263 @@
+# The MIT License (MIT).
+# Copyright (c) 2016, Nicolas Sebrecht & contributors.
+
+import inspect
+import os
+import tempfile
+import threading
+import unittest
+
+from imapfw import runtime
+from imapfw.api import drivers
+from imapfw.drivers.driver import loadDriver
+from imapfw.edmp import newEmitterReceiver
+from imapfw.engines.account import SyncAccounts
+from imapfw.engines.folder import SyncFolders
+from imapfw.rascal import Rascal
+from imapfw.state import FolderHistory, FolderState
+from imapfw.testing import libcore
+from imapfw.types.account import loadAccount
+from imapfw.types.folder import Folder, Folders
+
+
+class TestSyncFolders(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.statePath = os.path.join(self.tmpDir.name, 'state')
+        self.folder = Folder(b'INBOX')
+        self.paths = {}
+        self.threads = []
+        self.emitters = []
+        for name in ['MaildirA', 'MaildirB']:
+            self.paths[name] = os.path.join(self.tmpDir.name, name, 'INBOX')
+            for directory in ['cur', 'new', 'tmp']:
+                os.makedirs(os.path.join(self.paths[name], directory))
+            self.emitters.append(self._serve(name))
+
+        self.engine = SyncFolders('Folder.0', None, *self.emitters)
+
+    def tearDown(self):
+        for emitter in self.emitters:
+            emitter.stopServing()
+        for thread in self.threads:
+            thread.join()
+        self.tmpDir.cleanup()
+
+    def _serve(self, name):
+        """Serve a driver to the engine like a driver worker."""
+
+        driver = loadDriver(drivers.Maildir, name,
+            {'path': os.path.dirname(self.paths[name]), 'sep': '/'})
+        driver.connect()
+        receiver, emitter = newEmitterReceiver(name)
+        for method, func in inspect.getmembers(driver, inspect.ismethod):
+            if not method.startswith('_'):
+                receiver.accept(method, func)
+
+        def serve():
+            while receiver.react(timeout=None):
+                pass
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return emitter
+
+    def _deliver(self, name, filename, body=None):
+        if body is None:
+            body = b'Subject: %s\r\n'% filename.encode('ASCII')
+        with open(os.path.join(self.paths[name], filename), 'wb') as fd:
+            fd.write(body)
+
+    def _list(self, name):
+        return sorted(os.listdir(os.path.join(self.paths[name], 'cur')) +
+            os.listdir(os.path.join(self.paths[name], 'new')))
+
+    def _states(self):
+        states = []
+        for name in ['MaildirA', 'MaildirB']:
+            state = FolderState(self.statePath, 'AccountA', name, self.folder)
+            state.load()
+            states.append(state)
+        return states
+
+    def _sync(self):
+        for emitter in self.emitters:
+            emitter.select_sync(self.folder)
+        states = self._states()
+        changes = self.engine._getChanges(*states)
+        self.engine._matchMessages(states, changes)
+        self.engine._applyChanges(states, changes)
+        return changes
+
+    def test_00_sync(self):
+        self._deliver('MaildirA', 'cur/1.host,U=1:2,S')
+        self._deliver('MaildirA', 'new/2.host,U=2')
+        self._sync()
+
+        copied = self._list('MaildirB')
+        self.assertEqual(len(copied), 2)
+        self.assertTrue(copied[0].startswith('1.'))
+        self.assertTrue(copied[0].endswith(',U=1,S=29:2,S'))
+        stateA, stateB = self._states()
+        self.assertEqual(stateA.getHighestUID(), 2)
+        self.assertEqual(stateA.getLink(1), 1)
+        self.assertEqual(stateB.getFlags(1), ['\\Seen'])
+
+        # Nothing changed.
+        for newMessages, changedMessages, vanished, _ in self._sync():
+            self.assertEqual(len(newMessages), 0)
+            self.assertEqual(len(changedMessages), 0)
+            self.assertEqual(vanished, [])
+
+        # Flags changed and message removed on A, new message on B.
+        os.rename(os.path.join(self.paths['MaildirA'], 'cur/1.host,U=1:2,S'),
+            os.path.join(self.paths['MaildirA'], 'cur/1.host,U=1:2,FS'))
+        os.unlink(os.path.join(self.paths['MaildirA'], 'new/2.host,U=2'))
+        self._deliver('MaildirB', 'new/3.host,U=3')
+        self._sync()
+
+        flags = [filename.partition(':2,')[2]
+            for filename in self._list('MaildirB')]
+        self.assertEqual(flags, ['FS', 'T', ''])
+        self.assertEqual(len(self._list('MaildirA')), 2)
+        stateA, stateB = self._states()
+        self.assertEqual(stateA.getUIDs(), [1, 2]) # New UID 2.
+        self.assertEqual(stateA.getLink(2), 3)
+        self.assertEqual(stateB.getUIDs(), [1, 3])
+
+    def test_01_failure(self):
+        self._deliver('MaildirA', 'cur/1.host,U=1:2,S')
+        os.rmdir(os.path.join(self.paths['MaildirB'], 'tmp'))
+        with self.assertRaises(FileNotFoundError):
+            self._sync()
+
+        # Nothing was copied: nothing recorded.
+        for state in self._states():
+            self.assertEqual(state.getHighestUID(), None)
+            self.assertEqual(state.getUIDs(), [])
+
+        os.mkdir(os.path.join(self.paths['MaildirB'], 'tmp'))
+        self._sync()
+        self.assertEqual(len(self._list('MaildirB')), 1)
+
+    def test_02_sync_twice(self):
+        self._deliver('MaildirA', 'cur/1.host,U=1:2,S')
+        self._deliver('MaildirB', 'new/1.host,U=1')
+        for i in range(2):
+            self._sync()
+            self.assertEqual(len(self._list('MaildirA')), 2)
+            self.assertEqual(len(self._list('MaildirB')), 2)
+
+    def test_03_both_populated(self):
+        # The same messages on both sides, with other UIDs and line endings.
+        self._deliver('MaildirA', 'cur/1.host,U=1:2,S', b'Subject: a\r\n')
+        self._deliver('MaildirA', 'new/2.host,U=2', b'Subject: b\r\n')
+        self._deliver('MaildirA', 'new/3.host,U=3', b'Subject: only A\r\n')
+        self._deliver('MaildirB', 'new/5.host,U=5', b'Subject: b\n')
+        self._deliver('MaildirB', 'new/6.host,U=6', b'Subject: a\n')
+        self._sync()
+
+        self.assertEqual(len(self._list('MaildirA')), 3)
+        self.assertEqual(len(self._list('MaildirB')), 3)
+        stateA, stateB = self._states()
+        self.assertEqual(stateA.getLink(1), 6)
+        self.assertEqual(stateA.getLink(2), 5)
+        self.assertEqual(stateB.getLink(7), 3) # Copied.
+        # The left side wins.
+        self.assertEqual(stateB.getFlags(6), ['\\Seen'])
+        self.assertIn('6.host,U=6:2,S', self._list('MaildirB'))
+
+        for newMessages, changedMessages, vanished, _ in self._sync():
+            self.assertEqual(len(newMessages), 0)
+            self.assertEqual(len(changedMessages), 0)
+
+    def test_04_without_state_path(self):
+        rascal = Rascal()
+        rascal.load(os.path.join(libcore.testingPath(), 'rascals',
+            'basic.rascal'))
+        previousRascal = runtime.rascal
+        runtime.set_module('rascal', rascal)
+        self.addCleanup(runtime.set_module, 'rascal', previousRascal)
+
+        self._deliver('MaildirA', 'cur/1.host,U=1:2,S')
+        for emitter in self.emitters:
+            emitter.select_sync(self.folder)
+        # Nothing copied: the messages would be copied again at each run.
+        self.assertEqual(self.engine._syncMessages(self.folder), None)
+        self.assertEqual(len(self._list('MaildirB')), 0)
+
+
+class TestSyncAccounts(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        rascal = Rascal()
+        rascal.load(os.path.join(libcore.testingPath(), 'rascals',
+            'basic.rascal'))
+        rascal._mainConf['state_path'] = self.tmpDir.name
+        self.previousRascal = runtime.rascal
+        runtime.set_module('rascal', rascal)
+
+        self.engine = SyncAccounts('Account.0', None, None, None)
+        self.account = loadAccount('AccountA')
+
+    def tearDown(self):
+        runtime.set_module('rascal', self.previousRascal)
+        self.tmpDir.cleanup()
+
+    def _folders(self, *fingerprints):
+        folders = Folders()
+        for name, fingerprint in fingerprints:
+            folder = Folder(name)
+            folder.setFingerprint(fingerprint)
+            folders.append(folder)
+        return folders
+
+    def _saveHistory(self, fingerprints):
+        history = FolderHistory(self.tmpDir.name)
+        history.load()
+        for name, folderFingerprints in fingerprints.items():
+            history.record('AccountA', Folder(name), 1.0, folderFingerprints)
+        history.save()
+
+    def test_00_getDirtyFolders(self):
+        self._saveHistory({
+            b'clean': [[1, 2], [1, 2]],
+            b'changed': [[1, 2], [1, 2]],
+            })
+        leftFolders = self._folders(
+            (b'clean', [1, 2]), (b'changed', [1, 2]), (b'new', [1, 2]))
+        rghtFolders = self._folders(
+            (b'clean', [1, 2]), (b'changed', [1, 3]), (b'new', [1, 2]))
+        # No fingerprint: always dirty.
+        leftFolders.append(Folder(b'unknown'))
+        rghtFolders.append(Folder(b'unknown'))
+
+        dirtyFolders, fingerprints = self.engine._getDirtyFolders(
+            self.account, leftFolders, leftFolders, rghtFolders)
+        self.assertEqual(dirtyFolders,
+            [Folder(b'changed'), Folder(b'new'), Folder(b'unknown')])
+        self.assertEqual(fingerprints, {
+            'changed': [[1, 2], [1, 3]],
+            'new': [[1, 2], [1, 2]],
+            'unknown': [None, None],
+            })
+
+        # Once recorded in the history, the folders are clean.
+        self._saveHistory({name.encode(): folderFingerprints
+            for name, folderFingerprints in fingerprints.items()})
+        dirtyFolders, fingerprints = self.engine._getDirtyFolders(
+            self.account, leftFolders, leftFolders, rghtFolders)
+        self.assertEqual(dirtyFolders, [Folder(b'unknown')])
+
+    def test_01_getDirtyFolders_without_state_path(self):
+        runtime.rascal._mainConf['state_path'] = None
+        folders = self._folders((b'clean', [1, 2]))
+        dirtyFolders, fingerprints = self.engine._getDirtyFolders(
+            self.account, folders, folders, folders)
+        self.assertEqual(dirtyFolders, folders)
+        self.assertEqual(fingerprints, {})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
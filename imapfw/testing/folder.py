@@ -45,6 +45,12 @@ class TestFolder(unittest.TestCase):
     def test_folders_equal(self):
         self.assertEqual(self.foldersX, self.foldersY)
 
+    def test_folder_status(self):
+        self.assertEqual(self.folderA.getStatus('UIDNEXT'), None)
+        self.folderA.setStatus({'MESSAGES': 2, 'UIDNEXT': 3})
+        self.assertEqual(self.folderA.getStatus('UIDNEXT'), 3)
+        self.assertEqual(self.folderA, self.folderB)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,322 @@
+# The MIT License (MIT).
+# Copyright (c) 2016, Nicolas Sebrecht & contributors.
+
+import random
+import threading
+import time
+import unittest
+import zlib
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from imapfw.api import drivers
+from imapfw.drivers.driver import loadDriver
+from imapfw.imap.fetch import FetchBatchSizer, FetchParser, FetchParseError
+from imapfw.imap.imap import expandUIDs, getRatio
+from imapfw.imap.imap import CountingCompressor, CountingDecompressor
+from imapfw.imap.imap import IMAPlib2_skater, ImapCommandError
+from imapfw.imap.imap import Pipeline, parseStatus
+from imapfw.types.message import Message, Messages
+
+
+class ScriptedImaplib2(object):
+    """Record the commands and answer with the scripted responses.
+
+    The responses are (status, data) by command name. The data of the
+    response codes are given in order, by code."""
+
+    def __init__(self, responses: dict=None, codes: dict=None):
+        self.commands = []
+        self.compressor = None
+        self.decompressor = None
+        self.responses = responses or {}
+        self.codes = codes or {}
+
+    def _command(self, name, *args, callback=None, cb_arg=None):
+        self.commands.append((name,) + args)
+        response = self.responses.get(name, ('OK', [None]))
+        if callback is not None:
+            callback((response, cb_arg, None))
+            return None
+        return response
+
+    def append(self, *args, **kwargs):
+        return self._command('APPEND', *args, **kwargs)
+
+    def capability(self):
+        return self._command('CAPABILITY')
+
+    def enable_compression(self):
+        self._command('COMPRESS', 'DEFLATE')
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+            zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+    def login(self, *args):
+        return self._command('LOGIN', *args)
+
+    def response(self, code):
+        data = self.codes.get(code, [])
+        if len(data) < 1:
+            return code, [None]
+        return code, data.pop(0)
+
+    def uid(self, command, *args, **kwargs):
+        return self._command("UID %s"% command, *args, **kwargs)
+
+    def xatom(self, name, *args):
+        return self._command(name, *args)
+
+
+class TestImap(unittest.TestCase):
+    def test_00_expandUIDs(self):
+        self.assertEqual(expandUIDs('1'), [1])
+        self.assertEqual(expandUIDs('1,3:5,9:8'), [1, 3, 4, 5, 8, 9])
+
+    def test_01_compression_counters(self):
+        compressor = CountingCompressor(
+            zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15))
+        decompressor = CountingDecompressor(zlib.decompressobj(-15))
+        self.assertEqual(getRatio(compressor), None)
+
+        data = b'* 1 FETCH (UID 1 FLAGS (\\Seen))\r\n' * 100
+        compressed = compressor.compress(data)
+        compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.assertEqual(compressor.compressedBytes, len(compressed))
+
+        # Read by small chunks like imaplib2 does.
+        raw = decompressor.decompress(compressed, 1024)
+        while decompressor.unconsumed_tail:
+            raw += decompressor.decompress(decompressor.unconsumed_tail, 1024)
+
+        self.assertEqual(raw, data)
+        self.assertEqual(decompressor.rawBytes, len(data))
+        self.assertEqual(decompressor.compressedBytes, len(compressed))
+        self.assertGreater(getRatio(compressor), 10)
+        self.assertEqual(getRatio(compressor), getRatio(decompressor))
+
+    def test_02_fetch_batch_sizer(self):
+        sizer = FetchBatchSizer(size=100, minSize=10, maxSize=400,
+            targetSeconds=1.0, targetBytes=1000)
+        sizer.record(50, 0.1, 100) # Not full.
+        self.assertEqual(sizer.getSize(), 100)
+        for i in range(3):
+            sizer.record(sizer.getSize(), 0.1, 100)
+        self.assertEqual(sizer.getSize(), 400)
+
+        sizer.record(400, 2.0, 100) # Slow.
+        self.assertEqual(sizer.getSize(), 200)
+        for i in range(10):
+            sizer.record(200, 0.1, 2000) # Big.
+        self.assertEqual(sizer.getSize(), 10)
+
+    def test_03_pipeline(self):
+        class FakeImaplib2(object):
+            """Complete the commands from other threads in any order."""
+
+            def __init__(self):
+                self.threads = []
+
+            def status(self, mailbox, names, callback, cb_arg):
+                def complete():
+                    time.sleep(random.random() / 100)
+                    data = [b'"%s" (%s 1)'% (mailbox.encode(), names.encode())]
+                    callback((('OK', data), cb_arg, None))
+                thread = threading.Thread(target=complete)
+                thread.start()
+                self.threads.append(thread)
+
+        imap = FakeImaplib2()
+        pipeline = Pipeline(imap, depth=3)
+        for i in range(10):
+            pipeline.send(i, 'status', "folder%i"% i, 'MESSAGES')
+        self.assertEqual(len(pipeline), 10)
+        self.assertEqual(len(imap.threads), 3)
+
+        responses = {}
+        for key, data, seconds in pipeline.getResponses():
+            responses[key] = data
+        self.assertEqual(len(pipeline), 0)
+        self.assertEqual(len(imap.threads), 10)
+        self.assertEqual(responses[7], [b'"folder7" (MESSAGES 1)'])
+
+    def test_04_parseStatus(self):
+        statuses = parseStatus([
+            b'"INBOX" (MESSAGES 2 UIDNEXT 3 UIDVALIDITY 1)',
+            (b'{9}', b'Sent "Me"'), b' (MESSAGES 5)',
+            b'Trash (UIDNEXT 4 HIGHESTMODSEQ 99)',
+            ])
+        self.assertEqual(statuses, {
+            'INBOX': {'MESSAGES': 2, 'UIDNEXT': 3, 'UIDVALIDITY': 1},
+            'Sent "Me"': {'MESSAGES': 5},
+            'Trash': {'UIDNEXT': 4, 'HIGHESTMODSEQ': 99},
+            })
+        self.assertEqual(parseStatus([None]), {})
+
+    def test_05_appendMessages(self):
+        skater = IMAPlib2_skater()
+        skater.imap = ScriptedImaplib2(codes={
+            'APPENDUID': [[b'38505 10'], [b'38505 11']]})
+        skater.capability = ['IMAP4rev1']
+        skater.folderName = 'INBOX'
+
+        seen, recent = Message(1), Message(2)
+        seen.getAttributes().setFlags(['\\Seen', '$Label1'])
+        recent.getAttributes().setFlags(['\\Recent'])
+        messages = Messages(seen, recent)
+        bodies = [b'Subject: 1\r\n', b'Subject: 2\r\n']
+        self.assertRaises(ImapCommandError, skater.appendMessages,
+            messages, bodies)
+        self.assertEqual(skater.imap.commands, [])
+
+        skater.capability.append('UIDPLUS')
+        self.assertEqual(skater.appendMessages(messages, bodies), [10, 11])
+        self.assertEqual(skater.imap.commands, [
+            ('APPEND', 'INBOX', '\\Seen $Label1', None, b'Subject: 1\r\n'),
+            ('APPEND', 'INBOX', '', None, b'Subject: 2\r\n'),
+            ])
+
+    def test_06_setFlags(self):
+        skater = IMAPlib2_skater()
+        skater.imap = ScriptedImaplib2()
+
+        messages = Messages(*[Message(uid) for uid in [1, 2, 3]])
+        for uid in [1, 2]:
+            messages.getAttributes(uid).setFlags(['\\Seen', '\\Recent',
+                '$Label1'])
+        skater.setFlags(messages)
+        self.assertEqual(skater.imap.commands, [
+            ('UID STORE', '1:2', '+FLAGS.SILENT', '(\\Seen)'),
+            ('UID STORE', '1:2', '-FLAGS.SILENT',
+                '(\\Answered \\Deleted \\Draft \\Flagged)'),
+            ('UID STORE', '3', '-FLAGS.SILENT',
+                '(\\Answered \\Deleted \\Draft \\Flagged \\Seen)'),
+            ])
+
+    def test_07_getChangedMessages(self):
+        skater = IMAPlib2_skater()
+        skater.imap = ScriptedImaplib2({
+            'UID FETCH': ('OK', [
+                b'4 (UID 4 MODSEQ (65402) FLAGS (\\Seen))',
+                b'9 (UID 12 MODSEQ (65405) FLAGS ())',
+                ])},
+            {'VANISHED': [[b'(EARLIER) 41,43:45']]})
+
+        skater.enabled.add('QRESYNC')
+        messages, vanished = skater.getChangedMessages(65400)
+        self.assertEqual(skater.imap.commands, [
+            ('UID FETCH', '1:*', '(UID FLAGS)',
+                '(CHANGEDSINCE 65400 VANISHED)'),
+            ])
+        self.assertEqual(sorted(messages.keys()), [4, 12])
+        self.assertEqual(messages.getAttributes(4).getFlags(), ['\\Seen'])
+        self.assertEqual(messages.getAttributes(12).getFlags(), [])
+        self.assertEqual(vanished, [41, 43, 44, 45])
+
+        # Without QRESYNC, the expunged messages are unknown.
+        skater.enabled.clear()
+        messages, vanished = skater.getChangedMessages(65400)
+        self.assertEqual(skater.imap.commands[-1],
+            ('UID FETCH', '1:*', '(UID FLAGS)', '(CHANGEDSINCE 65400)'))
+        self.assertEqual(vanished, [])
+
+    def test_08_searchUID(self):
+        skater = IMAPlib2_skater()
+        skater.imap = ScriptedImaplib2({'UID SEARCH': ('OK', [b'2 5'])})
+        self.assertEqual(sorted(skater.searchUID().keys()), [2, 5])
+
+        # Empty folder.
+        for data in [b'', None]:
+            skater.imap = ScriptedImaplib2({'UID SEARCH': ('OK', [data])})
+            self.assertEqual(len(skater.searchUID()), 0)
+
+
+class TestImapDriver(unittest.TestCase):
+    def _connect(self, capability, **conf):
+        conf.update({'host': 'localhost', 'port': '143', 'username': 'me',
+            'password': 'secret', 'backend': 'imaplib3'})
+        driver = loadDriver(drivers.Imap, 'ImapA', conf)
+        imap = ScriptedImaplib2({'CAPABILITY': ('OK', [capability])},
+            {'ENABLED': [[b'CONDSTORE QRESYNC']]})
+        with mock.patch('imapfw.imap.imaplib3.imaplib2.IMAP4',
+                return_value=imap):
+            driver.connect()
+        return driver, imap
+
+    def test_00_connect(self):
+        driver, imap = self._connect(b'IMAP4rev1 CONDSTORE QRESYNC')
+        self.assertEqual(imap.commands, [
+            ('LOGIN', 'me', 'secret'),
+            ('CAPABILITY',),
+            ('ENABLE', 'CONDSTORE', 'QRESYNC'),
+            ])
+        self.assertEqual(driver.imap.enabled, {'CONDSTORE', 'QRESYNC'})
+
+        driver, imap = self._connect(b'IMAP4rev1')
+        self.assertNotIn('ENABLE', [command[0] for command in imap.commands])
+        self.assertEqual(driver.imap.enabled, set())
+
+    def test_01_connect_compress(self):
+        capability = b'IMAP4rev1 COMPRESS=DEFLATE'
+        driver, imap = self._connect(capability)
+        self.assertNotIn(('COMPRESS', 'DEFLATE'), imap.commands)
+        self.assertEqual(driver.getCompressionRatios(), None)
+
+        driver, imap = self._connect(capability, compress=True)
+        self.assertEqual(imap.commands, [
+            ('LOGIN', 'me', 'secret'),
+            ('CAPABILITY',),
+            ('COMPRESS', 'DEFLATE'),
+            ])
+        self.assertIsInstance(imap.compressor, CountingCompressor)
+        self.assertIsInstance(imap.decompressor, CountingDecompressor)
+
+        # Not supported by the server.
+        driver, imap = self._connect(b'IMAP4rev1', compress=True)
+        self.assertNotIn(('COMPRESS', 'DEFLATE'), imap.commands)
+
+
+class TestFetchParser(unittest.TestCase):
+    def test_00_metadata(self):
+        data = [
+            b'1 (UID 12 FLAGS (\\Seen $Label1) INTERNALDATE'
+            b' "15-Nov-2015 00:00:46 +0100" RFC822.SIZE 1234)',
+            b'2 (FLAGS () UID 345 MODSEQ (65402))',
+            ]
+        messages = dict(FetchParser().parse(data))
+        self.assertEqual(data, [])
+        self.assertEqual(sorted(messages.keys()), [12, 345])
+
+        attributes = messages[12]
+        self.assertEqual(attributes.getFlags(), ['\\Seen', '$Label1'])
+        self.assertEqual(attributes.getSize(), 1234)
+        self.assertEqual(attributes.getInternaldate(), datetime(2015, 11, 15,
+            0, 0, 46, tzinfo=timezone(timedelta(hours=1))))
+        self.assertEqual(messages[345].getFlags(), [])
+        self.assertEqual(messages[345].getModSeq(), 65402)
+
+    def test_01_literals(self):
+        parser = FetchParser()
+        header = b'1 (UID 7 BODY[HEADER.FIELDS (FROM)] {13}'
+        self.assertEqual(parser.feed((header, b'From: a@b.c\r\n')), [])
+        self.assertEqual(parser.feed(
+            (b' BODY[TEXT]<0> {5}', b'hello')), [])
+        ((uid, attributes),) = parser.feed(b' FLAGS (\\Seen))')
+
+        self.assertEqual(uid, 7)
+        self.assertEqual(attributes.getLiteral('BODY[HEADER.FIELDS (FROM)]'),
+            b'From: a@b.c\r\n')
+        self.assertEqual(attributes.getLiteral('BODY[TEXT]<0>'), b'hello')
+        self.assertEqual(attributes.getFlags(), ['\\Seen'])
+
+    def test_02_errors(self):
+        self.assertEqual(list(FetchParser().parse([None])), [])
+        parser = FetchParser()
+        self.assertEqual(list(parser.parse([b'1 (UID 1'], False)), [])
+        self.assertEqual(len(list(parser.parse([b' FLAGS ())']))), 1)
+        with self.assertRaises(FetchParseError):
+            list(FetchParser().parse([b'1 (UID 1 FLAGS (\\Seen)']))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
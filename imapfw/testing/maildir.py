@@ -20,14 +20,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import errno
+import io
 import unittest
 import os
+import tempfile
+from datetime import datetime, timezone
+from unittest import mock
 
 from imapfw import runtime
 from imapfw.api import drivers
+from imapfw.concurrency.concurrency import InlinePayload
 from imapfw.drivers.driver import loadDriver
+from imapfw.error import DriverFatalError
+from imapfw.imap import SearchConditions
 from imapfw.testing import libcore
 from imapfw.types.folder import Folders, Folder
+from imapfw.types.message import Messages, Message
 
 
 class TestMaildirDriver(unittest.TestCase):
@@ -56,6 +65,192 @@ class TestMaildirDriver(unittest.TestCase):
             )
         self.assertEqual(folders, expected)
 
+    def test_getFolders_fingerprint(self):
+        folders = self.driverB.getFolders()
+        for folder in folders:
+            fingerprint = folder.getFingerprint()
+            self.assertEqual(len(fingerprint), 2)
+            self.assertEqual(fingerprint, self.driverB.getFolders()[
+                folders.index(folder)].getFingerprint())
+
+    def test_getFolders_scan_threads(self):
+        conf = { 'sep': '/', 'scan_threads': 1 }
+        conf['path'] = os.path.join(libcore.testingPath(), 'maildirs',
+            'recursive_B')
+        driver = loadDriver(drivers.Maildir, 'MaildirB', conf)
+        self.assertEqual(
+            [folder.getName() for folder in driver.getFolders()],
+            [folder.getName() for folder in self.driverB.getFolders()])
+
+    def test_searchUID_of_recursive_A(self):
+        self.driverA.select(Folder(b'/'))
+        messages = self.driverA.searchUID()
+        self.assertEqual(list(messages.keys()), [207316])
+        self.assertEqual(messages.getAttributes(207316).getFlags(), ['\\Seen'])
+
+    def test_searchUID_from_filenames(self):
+        with tempfile.TemporaryDirectory() as path:
+            for directory in ['cur', 'new', 'tmp']:
+                os.makedirs(os.path.join(path, 'INBOX', directory))
+            for filename in [
+                    'cur/1.host,U=1,S=120:2,FS',
+                    'cur/2.host,U=2:2,',
+                    'cur/3.host:2,S', # No UID.
+                    'new/4.host,U=4,S=4000',
+                    ]:
+                open(os.path.join(path, 'INBOX', filename), 'w').close()
+
+            driver = loadDriver(drivers.Maildir, 'MaildirC',
+                {'path': path, 'sep': '/'})
+            self.assertEqual(driver.select(Folder(b'INBOX')), 3)
+
+            messages = driver.searchUID()
+            self.assertEqual(sorted(messages.keys()), [1, 2, 4])
+            self.assertEqual(messages.getAttributes(1).getFlags(),
+                ['\\Flagged', '\\Seen'])
+            self.assertEqual(messages.getAttributes(1).getSize(), 120)
+            self.assertEqual(messages.getAttributes(4).getFlags(), [])
+
+            conditions = SearchConditions()
+            conditions.setMinUID(2)
+            conditions.setMaxSize(1000)
+            messages = driver.searchUID(conditions)
+            self.assertEqual(list(messages.keys()), [2])
+
+            messages = driver.getMessages(Messages(Message(1), Message(9)),
+                None)
+            self.assertEqual(messages.getAttributes(1).getSize(), 120)
+
+    def test_appendMessages(self):
+        internaldate = datetime(2015, 11, 15, 0, 0, 46, tzinfo=timezone.utc)
+        for durability in ['message', 'batch', 'none']:
+            with tempfile.TemporaryDirectory() as path:
+                for directory in ['cur', 'new', 'tmp']:
+                    os.makedirs(os.path.join(path, 'INBOX', directory))
+
+                driver = loadDriver(drivers.Maildir, 'MaildirC',
+                    {'path': path, 'sep': '/', 'durability': durability})
+                driver.connect()
+                driver.select(Folder(b'INBOX'))
+
+                seen, unseen = Message(3), Message(5)
+                seen.getAttributes().setFlags(['\\Seen', '\\Answered'])
+                seen.getAttributes().setInternaldate(internaldate)
+                uids = driver.appendMessages(Messages(seen, unseen),
+                    [InlinePayload(b'Subject: 3\r\n'),
+                    InlinePayload(b'Subject: 5\r\n')])
+                self.assertEqual(uids, [1, 2]) # New UIDs.
+
+                self.assertEqual(os.listdir(os.path.join(path, 'INBOX',
+                    'tmp')), [])
+                self.assertEqual(len(os.listdir(os.path.join(path, 'INBOX',
+                    'new'))), 1)
+                messages = driver.searchUID()
+                self.assertEqual(sorted(messages.keys()), [1, 2])
+                attributes = messages.getAttributes(1)
+                self.assertEqual(attributes.getFlags(),
+                    ['\\Answered', '\\Seen'])
+                self.assertEqual(attributes.getSize(), 12)
+                self.assertEqual(attributes.getInternaldate(), internaldate)
+                self.assertEqual(messages.getAttributes(2).getFlags(), [])
+
+                driver.select(Folder(b'INBOX')) # Scan the files.
+                messages = driver.searchUID()
+                self.assertEqual(sorted(messages.keys()), [1, 2])
+                self.assertEqual(messages.getAttributes(1).getFlags(),
+                    attributes.getFlags())
+                self.assertEqual(messages.getAttributes(1).getInternaldate(),
+                    internaldate)
+
+                # The next UIDs follow.
+                uids = driver.appendMessages(Messages(Message(3)),
+                    [InlinePayload(b'Subject: 3\r\n')])
+                self.assertEqual(uids, [3])
+
+    def test_appendMessages_write_error(self):
+        class FullFile(io.BufferedWriter):
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+        opened = []
+        def openFile(path, mode):
+            opened.append(path)
+            if len(opened) == 3:
+                return FullFile(io.FileIO(path, mode))
+            return open(path, mode)
+
+        for durability, written in [('message', 2), ('batch', 0),
+                ('none', 2)]:
+            with tempfile.TemporaryDirectory() as path:
+                for directory in ['cur', 'new', 'tmp']:
+                    os.makedirs(os.path.join(path, 'INBOX', directory))
+
+                driver = loadDriver(drivers.Maildir, 'MaildirC',
+                    {'path': path, 'sep': '/', 'durability': durability})
+                driver.connect()
+                driver.select(Folder(b'INBOX'))
+
+                messages = Messages(*[Message(uid) for uid in range(1, 6)])
+                payloads = [InlinePayload(b'Subject: %i\r\n'% uid)
+                    for uid in range(1, 6)]
+                del opened[:]
+                with mock.patch('imapfw.drivers.maildir.open', openFile,
+                        create=True):
+                    with self.assertRaises(OSError):
+                        driver.appendMessages(messages, payloads)
+
+                self.assertEqual(len(opened), 3)
+                self.assertEqual(os.listdir(os.path.join(path, 'INBOX',
+                    'tmp')), [])
+                self.assertEqual(len(os.listdir(os.path.join(path, 'INBOX',
+                    'new'))), written)
+                for payload in payloads:
+                    self.assertIsNone(payload._data) # Released.
+
+    def test_getBodies_setFlags(self):
+        with tempfile.TemporaryDirectory() as path:
+            for directory in ['cur', 'new', 'tmp']:
+                os.makedirs(os.path.join(path, 'INBOX', directory))
+            for filename, body in [
+                    ('cur/1.host,U=1:2,Sa', b'Subject: 1\r\n'),
+                    ('new/2.host,U=2', b'Subject: 2\r\n'),
+                    ]:
+                with open(os.path.join(path, 'INBOX', filename), 'wb') as fd:
+                    fd.write(body)
+
+            driver = loadDriver(drivers.Maildir, 'MaildirC',
+                {'path': path, 'sep': '/'})
+            driver.connect()
+            driver.select(Folder(b'INBOX'))
+
+            messages, payloads = driver.getBodies(Messages(Message(2),
+                Message(1), Message(3)))
+            self.assertEqual(list(messages.keys()), [2, 1])
+            self.assertEqual([bytes(payload.getView())
+                for payload in payloads], [b'Subject: 2\r\n',
+                b'Subject: 1\r\n'])
+            self.assertEqual(messages.getAttributes(1).getFlags(),
+                ['\\Seen'])
+
+            flagged, unseen = Message(2), Message(1)
+            flagged.getAttributes().setFlags(['\\Flagged', '\\Recent'])
+            driver.setFlags(Messages(flagged, unseen, Message(3)))
+            self.assertEqual(sorted(os.listdir(os.path.join(path, 'INBOX',
+                'cur'))), ['1.host,U=1:2,a', '2.host,U=2:2,F'])
+
+            driver.select(Folder(b'INBOX')) # Scan the files.
+            messages = driver.searchUID()
+            self.assertEqual(messages.getAttributes(1).getFlags(), [])
+            self.assertEqual(messages.getAttributes(2).getFlags(),
+                ['\\Flagged'])
+
+    def test_durability_conf(self):
+        with tempfile.TemporaryDirectory() as path:
+            driver = loadDriver(drivers.Maildir, 'MaildirC',
+                {'path': path, 'durability': 'sometimes'})
+            with self.assertRaises(DriverFatalError):
+                driver.connect()
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
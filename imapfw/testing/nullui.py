@@ -30,5 +30,6 @@ class NullUI(object):
     def format(self, *args): pass
     def info(self, *args): pass
     def infoL(self, level, *args): pass
+    def isDebugEnabled(self, category): return False
     def setInfoLevel(self, level): pass
     def warn(self, *args): pass
@@ -0,0 +1,171 @@
+# The MIT License (MIT).
+# Copyright (c) 2016, Nicolas Sebrecht & contributors.
+
+import os
+import tempfile
+import time
+import unittest
+
+from imapfw.state import FolderHistory, FolderState, MaildirIndex
+from imapfw.types.folder import Folder
+from imapfw.types.message import Message, Messages
+
+
+class TestFolderHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.statePath = os.path.join(self.tmpDir.name, 'state')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_00_unknown(self):
+        history = FolderHistory(self.statePath)
+        history.load()
+        self.assertEqual(history.getEstimate('AccountA', Folder(b'INBOX')),
+            None)
+
+    def test_01_save_load(self):
+        history = FolderHistory(self.statePath)
+        history.record('AccountA', Folder(b'INBOX'), 12.5, [[1, 2], [3, 4]])
+        history.record('AccountA', Folder(b'spam'), 1.5)
+        history.save()
+
+        history = FolderHistory(self.statePath)
+        history.load()
+        self.assertEqual(history.getEstimate('AccountA', Folder(b'INBOX')),
+            12.5)
+        self.assertEqual(history.getFingerprints('AccountA',
+            Folder(b'INBOX')), [[1, 2], [3, 4]])
+        self.assertEqual(history.getFingerprints('AccountA',
+            Folder(b'spam')), None)
+        self.assertEqual(history.getFingerprints('AccountB',
+            Folder(b'INBOX')), None)
+
+    def test_02_disabled(self):
+        history = FolderHistory()
+        history.record('AccountA', Folder(b'INBOX'), 12.5)
+        history.save()
+        self.assertEqual(os.listdir(self.tmpDir.name), [])
+
+
+class TestFolderState(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.statePath = os.path.join(self.tmpDir.name, 'state')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _messages(self, *uids):
+        messages = []
+        for uid in uids:
+            message = Message(uid)
+            message.getAttributes().setFlags(['\\Seen'])
+            messages.append(message)
+        return Messages(*messages)
+
+    def _sync(self, state, *uids):
+        for uid in uids:
+            state.link(uid, ['\\Seen'], uid + 100)
+            state.setHighestUID(uid)
+
+    def _state(self):
+        return FolderState(self.statePath, 'AccountA', 'RepositoryA',
+            Folder(b'INBOX/sub'))
+
+    def test_00_new_messages(self):
+        state = self._state()
+        state.checkUIDValidity(1)
+        self.assertEqual(len(state.getNewMessages(self._messages(1, 2))), 2)
+
+        self._sync(state, 1, 2)
+        self.assertEqual(state.getHighestUID(), 2)
+        newMessages = state.getNewMessages(self._messages(2, 3))
+        self.assertEqual(list(newMessages.keys()), [3])
+
+        # Copied from the other side: known but above the highest UID.
+        state.link(5, [], 10)
+        newMessages = state.getNewMessages(self._messages(3, 4, 5))
+        self.assertEqual(list(newMessages.keys()), [3, 4])
+
+    def test_01_uidvalidity(self):
+        state = self._state()
+        self.assertFalse(state.checkUIDValidity(1))
+        self._sync(state, 1, 2)
+        self.assertTrue(state.checkUIDValidity(1))
+        self.assertEqual(state.getHighestUID(), 2)
+
+        self.assertFalse(state.checkUIDValidity(2))
+        self.assertEqual(state.getHighestUID(), None)
+        self.assertEqual(state.flags, {})
+        self.assertEqual(state.getLink(1), None)
+
+    def test_02_save_load(self):
+        state = self._state()
+        state.checkUIDValidity(1)
+        state.setUIDNext(3)
+        self._sync(state, 1, 2)
+        state.save()
+
+        state = self._state()
+        state.load()
+        self.assertTrue(state.checkUIDValidity(1))
+        self.assertEqual(state.uidnext, 3)
+        self.assertEqual(state.getHighestUID(), 2)
+        self.assertEqual(state.flags, {1: ['\\Seen'], 2: ['\\Seen']})
+        self.assertEqual(state.getLink(2), 102)
+
+    def test_03_modseq_vanished(self):
+        state = self._state()
+        state.checkUIDValidity(1)
+        state.setHighestModSeq(10)
+        self._sync(state, 1, 2, 3)
+        state.removeUIDs([2, 5])
+        state.save()
+
+        state = self._state()
+        state.load()
+        self.assertEqual(state.getHighestModSeq(), 10)
+        self.assertEqual(state.getUIDs(), [1, 3])
+        self.assertEqual(state.getLink(2), None)
+
+        state.checkUIDValidity(2)
+        self.assertEqual(state.getHighestModSeq(), None)
+
+
+class TestMaildirIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.statePath = os.path.join(self.tmpDir.name, 'state')
+        self.entries = {
+            1: ['cur/1446000000.1.host,U=1,S=120:2,S', 'S', 120, 1446000000],
+            2: ['new/host,U=2', '', None, None],
+            }
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_00_save_load(self):
+        index = MaildirIndex(self.statePath, 'MaildirA', 'INBOX/sub')
+        self.assertEqual(index.load([1, 2]), None)
+        index.save([1, 2], self.entries)
+
+        index = MaildirIndex(self.statePath, 'MaildirA', 'INBOX/sub')
+        self.assertEqual(index.load([1, 2]), self.entries)
+        self.assertEqual(index.load([1, 3]), None) # Folder changed.
+        self.assertEqual(index.load(None), None) # Folder removed.
+
+    def test_01_recent_mtimes(self):
+        index = MaildirIndex(self.statePath, 'MaildirA', 'INBOX')
+        index.save([1, time.time_ns()], self.entries)
+        self.assertEqual(os.listdir(self.tmpDir.name), [])
+
+    def test_02_disabled(self):
+        index = MaildirIndex(None, 'MaildirA', 'INBOX')
+        index.save([1, 2], self.entries)
+        self.assertEqual(index.load([1, 2]), None)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
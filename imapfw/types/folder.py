@@ -26,7 +26,7 @@ from functools import total_ordering
 from imapfw.interface import implements, Interface, checkInterfaces
 
 # Annotations.
-from imapfw.annotation import Union
+from imapfw.annotation import Dict, List, Union
 
 
 ENCODING = 'UTF-8'
@@ -46,6 +46,10 @@ class FolderInterface(Interface):
 
     scope = Interface.PUBLIC
 
+    def getFingerprint(self) -> List[int]:
+        """Return a cheap value which changes whenever the content of the
+        folder changes. None if unknown."""
+
     def hasChildren(self) -> bool:
         """Return True of False whether this folder has children."""
 
@@ -55,15 +59,26 @@ class FolderInterface(Interface):
     def getRoot(self, encoding: str=ENCODING) -> str:
         """Return the path to the folder."""
 
+    def getStatus(self, name: str) -> int:
+        """Return a STATUS item of the folder (e.g. 'UIDNEXT'), None if
+        unknown."""
+
     def setName(self, name: Union[str, bytes], encoding: str=None) -> None:
         """Set the folder base name."""
 
+    def setFingerprint(self, fingerprint: List[int]) -> None:
+        """Set the fingerprint of the folder, as known by the driver."""
+
     def setHasChildren(self, hasChildren: bool) -> None:
         """Set if folder has children."""
 
     def setRoot(self, root: str, encoding: str=ENCODING) -> None:
         """Set the path to the folder."""
 
+    def setStatus(self, status: Dict[str, int]) -> None:
+        """Set the STATUS items of the folder: MESSAGES, UIDNEXT, UIDVALIDITY
+        and HIGHESTMODSEQ, as far as known by the driver."""
+
 
 @total_ordering
 @checkInterfaces()
@@ -75,6 +90,8 @@ class Folder(object):
 
         self._hasChildren = None
         self._root = None
+        self._status = {}
+        self._fingerprint = None
 
     def __bytes__(self):
         return self._name
@@ -91,12 +108,18 @@ class Folder(object):
     def __str__(self):
         return self.getName()
 
+    def getFingerprint(self) -> List[int]:
+        return self._fingerprint
+
     def getName(self, encoding: str=ENCODING) -> str:
         return self._name.decode(encoding)
 
     def getRoot(self, encoding: str=ENCODING) -> str:
         return self._root.decode(encoding)
 
+    def getStatus(self, name: str) -> int:
+        return self._status.get(name)
+
     def hasChildren(self) -> bool:
         return self._hasChildren
 
@@ -113,6 +136,9 @@ class Folder(object):
         else:
             self._name = name.encode(encoding)
 
+    def setFingerprint(self, fingerprint: List[int]) -> None:
+        self._fingerprint = fingerprint
+
     def setHasChildren(self, hasChildren: bool) -> None:
         self._hasChildren = hasChildren
 
@@ -122,6 +148,9 @@ class Folder(object):
         else:
             self._root = root.encode(encoding)
 
+    def setStatus(self, status: Dict[str, int]) -> None:
+        self._status = status
+
 
 class Folders(UserList):
     """A list of Folder instances."""
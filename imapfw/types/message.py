@@ -3,11 +3,16 @@
 
 from functools import total_ordering
 from collections import UserDict
+from datetime import datetime
 
 from imapfw.interface import implements, Interface, checkInterfaces
 
 # Annotations.
-from imapfw.annotation import List
+from imapfw.annotation import Iterable, List
+
+
+# The flags of RFC 3501 the clients can set.
+SYSTEM_FLAGS = ['\\Answered', '\\Deleted', '\\Draft', '\\Flagged', '\\Seen']
 
 
 #TODO: interface.
@@ -15,20 +20,40 @@ class MessageAttributes(object):
     def __init__(self):
         self.flags = []
         self.internaldate = None
+        self.size = None
+        self.modseq = None
+        self.literals = {} # By FETCH item name, e.g. 'BODY[HEADER]'.
 
     def getFlags(self) -> List[str]:
         return self.flags
 
-    def getInternaldate(self):
+    def getInternaldate(self) -> datetime:
         return self.internaldate
 
+    def getLiteral(self, name: str) -> bytes:
+        return self.literals.get(name)
+
+    def getModSeq(self) -> int:
+        return self.modseq
+
+    def getSize(self) -> int:
+        return self.size
+
     def setFlags(self, flags: List[str]) -> None:
         self.flags = flags
 
-    def setInternaldate(self, internaldate: str):
-        #TODO: make python date
+    def setInternaldate(self, internaldate: datetime) -> None:
         self.internaldate = internaldate
 
+    def setLiteral(self, name: str, literal: bytes) -> None:
+        self.literals[name] = literal
+
+    def setModSeq(self, modseq: int) -> None:
+        self.modseq = modseq
+
+    def setSize(self, size: int) -> None:
+        self.size = size
+
 
 #TODO: interface.
 @total_ordering
@@ -73,6 +98,38 @@ class Message(object):
         self.attributes = attributes
 
 
+def coalesceUIDs(uids: Iterable[int]) -> str:
+    """Return a string of coalesced continous ranges and UIDs.
+
+    E.g.: [1, 3, 4, 5, 6, 7, 9] -> '1,3:7,9'
+    """
+
+    coalesced = [] # UIDs and coalesced sub-sequences ['1', '3:7', '9'].
+
+    def coalesce(start, end):
+        if start == end:
+            return str(start) # Non-coalesced UID: '1'.
+        return "%s:%s"% (start, end) # Coalesced sub-sequence: '3:7'.
+
+    start = None
+    end = None
+    for uid in uids:
+        if start is None:
+            # First item.
+            start, end = uid, uid
+            continue
+
+        if uid == end + 1:
+            end = uid
+            continue
+
+        coalesced.append(coalesce(start, end))
+        start, end = uid, uid # Current uid is the next item to coalesce.
+    coalesced.append(coalesce(start, end))
+
+    return ','.join(coalesced) # '1,3:7,9'
+
+
 #TODO: interface.
 class Messages(UserDict):
     """A collection of messages, by UID."""
@@ -91,30 +148,7 @@ class Messages(UserDict):
         E.g.: '1,3:7,9'
         """
 
-        uids = [] # List of UIDs and coalesced sub-sequences ['1', '3:7', '9'].
-
-        def coalesce(start, end):
-            if start == end:
-                return str(start) # Non-coalesced UID: '1'.
-            return "%s:%s"% (start, end) # Coalesced sub-sequence: '3:7'.
-
-        start = None
-        end = None
-        for uid in self.keys():
-            if start is None:
-                # First item.
-                start, end = uid, uid
-                continue
-
-            if uid == end + 1:
-                end = uid
-                continue
-
-            uids.append(coalesce(start, end))
-            start, end = uid, uid # Current uid is the next item to coalesce.
-        uids.append(coalesce(start, end))
-
-        return ','.join(uids) # '1,3:7,9'
+        return coalesceUIDs(self.keys())
 
     def getAttributes(self, uid: int) -> MessageAttributes:
         return self.data[uid].getAttributes()
@@ -43,16 +43,17 @@ logging_config = {
 
 
 class UIinterface(object):
-    def critical(self):     raise NotImplementedError
-    def debug(self):        raise NotImplementedError
-    def debugC(self):       raise NotImplementedError
-    def error(self):        raise NotImplementedError
-    def exception(self):    raise NotImplementedError
-    def format(self):       raise NotImplementedError
-    def info(self):         raise NotImplementedError
-    def infoL(self):        raise NotImplementedError
-    def setInfoLevel(self): raise NotImplementedError
-    def warn(self):         raise NotImplementedError
+    def critical(self):         raise NotImplementedError
+    def debug(self):            raise NotImplementedError
+    def debugC(self):           raise NotImplementedError
+    def error(self):            raise NotImplementedError
+    def exception(self):        raise NotImplementedError
+    def format(self):           raise NotImplementedError
+    def info(self):             raise NotImplementedError
+    def infoL(self):            raise NotImplementedError
+    def isDebugEnabled(self):   raise NotImplementedError
+    def setInfoLevel(self):     raise NotImplementedError
+    def warn(self):             raise NotImplementedError
 
 
 class UIbackendInterface(object):
@@ -87,7 +88,7 @@ class TTY(UIinterface, UIbackendInterface):
         self._safeLog('debug', *args)
 
     def debugC(self, category: str, *args) -> None:
-        if self._debugCategories.get(category) is True:
+        if self.isDebugEnabled(category):
             self._safeLog('debug', "%s %s [%s]",
                 self._currentWorkerName(),
                 self.format(*args),
@@ -121,6 +122,13 @@ class TTY(UIinterface, UIbackendInterface):
         if level <= self._infoLevel:
             self.info(*args)
 
+    def isDebugEnabled(self, category: str) -> bool:
+        """Return True if debugging is enabled for this category.
+
+        Allows callers to not build costly debug messages for nothing."""
+
+        return self._debugCategories.get(category) is True
+
     def setCurrentWorkerNameFunction(self, func: Function) -> None:
         self._currentWorkerName = func
 